@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+
+
+def setup(database=None, **extra):
+    # Same configuration as runtests.py, on a migrated in-memory database unless another one is given;
+    # that one is only used through test_database().
+    settings.configure(
+        DEBUG=False,
+        ALLOWED_HOSTS=['testserver'],
+        DATABASES={
+            'default': database or {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            }
+        },
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'django.contrib.admin',
+            'feeds'
+        ),
+        REST_FRAMEWORK={
+            'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',)
+        },
+        USE_TZ=True,
+        TIME_ZONE='UTC',
+        ROOT_URLCONF='feeds.urls',
+        **extra
+    )
+    django.setup()
+
+    if database is None:
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0)
+
+
+@contextmanager
+def test_database():
+    # A scratch "test_" copy of the configured database, dropped afterwards.
+    from django.db import connection
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield connection.vendor
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
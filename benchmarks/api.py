@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from benchmarks import setup, test_database
+
+BATCH_SIZE = 5000
+ENDPOINTS = ("feeds", "posts", "patch")
+
+
+def chunks(objects, size=BATCH_SIZE):
+    chunk = []
+    for obj in objects:
+        chunk.append(obj)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bulk_create(model, objects):
+    for chunk in chunks(objects):
+        model.objects.bulk_create(chunk)
+
+
+def generate(users, feeds_per_user, links, posts, seed=0):
+    # Link popularity follows a Zipf law and posts per feed a log-normal one. The newest posts of a feed are unread,
+    # as many as an exponential draw with a mean of ten, the rest has been read.
+    from django.contrib.auth.models import User
+    from django.utils.timezone import now
+    from feeds.models import Feed, FeedLink, Item, Link, Post
+
+    rnd = random.Random(seed)
+    start = now()
+
+    bulk_create(User, (User(username="user{}".format(x), password="!") for x in range(users)))
+    bulk_create(Link, (Link(url="https://site{}.test.com/feed/".format(x)) for x in range(links)))
+    user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+    link_ids = list(Link.objects.order_by('id').values_list('id', flat=True))
+
+    bulk_create(Feed, (
+        Feed(name="Feed {}".format(position), user_id=user_id, position=position, postLimit=20)
+        for user_id in user_ids for position in range(rnd.randint(1, 2 * feeds_per_user - 1))
+    ))
+    feed_users = dict(Feed.objects.order_by('id').values_list('id', 'user_id'))
+    feed_ids = list(feed_users)
+    popularity = [1 / (rank + 1) for rank in range(len(link_ids))]
+    feed_links = dict(zip(feed_ids, rnd.choices(link_ids, weights=popularity, k=len(feed_ids))))
+    bulk_create(FeedLink, (FeedLink(feed_id=feed_id, link_id=link_id, position=0, reg_exp="")
+                           for feed_id, link_id in feed_links.items()))
+
+    weights = [rnd.lognormvariate(0, 1) for _ in feed_ids]
+    total = sum(weights)
+    sizes = {feed_id: max(1, int(posts * weight / total)) for feed_id, weight in zip(feed_ids, weights)}
+
+    # feeds following the same link share its items, so a link needs as many items as its largest feed has posts
+    link_sizes = {}
+    for feed_id, link_id in feed_links.items():
+        link_sizes[link_id] = max(link_sizes.get(link_id, 0), sizes[feed_id])
+    bulk_create(Item, (
+        Item(link_id=link_id, title="Post {}".format(x), url="https://site{}.test.com/post/{}".format(link_id, x),
+             post_date=start - timedelta(minutes=30 * x))
+        for link_id, size in link_sizes.items() for x in range(size)
+    ))
+    items = {}
+    for item_id, link_id in Item.objects.order_by('id').values_list('id', 'link_id').iterator():
+        items.setdefault(link_id, []).append(item_id)
+
+    def feed_posts(feed_id):
+        unread = int(rnd.expovariate(1 / 10))
+        link_items = items[feed_links[feed_id]]
+        for x in range(sizes[feed_id]):
+            yield Post(feed_id=feed_id, user_id=feed_users[feed_id], item_id=link_items[x],
+                       add_date=start - timedelta(minutes=30 * x), view=x >= unread)
+
+    bulk_create(Post, (post for feed_id in feed_ids for post in feed_posts(feed_id)))
+    return {
+        "users": len(user_ids),
+        "feeds": len(feed_ids),
+        "links": len(link_ids),
+        "items": Item.objects.count(),
+        "posts": Post.objects.count(),
+    }
+
+
+def percentile_ms(timings, q):
+    if not timings:
+        return None
+    return round(timings[min(len(timings) - 1, int(q * len(timings)))] * 1000, 2)
+
+
+def drive(request, count, threads):
+    # Runs `count` requests spread over `threads` threads, each with its own client and database connection.
+    from django.db import connection
+    from rest_framework.test import APIClient
+
+    timings = []
+    # the status code of every failed response, or the class of the exception raised instead
+    errors = Counter()
+    lock = threading.Lock()
+    remaining = [count]
+
+    def worker(number):
+        client = APIClient()
+        rnd = random.Random(number)
+        try:
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        return
+                    remaining[0] -= 1
+                started = time.perf_counter()
+                error = None
+                try:
+                    response = request(client, rnd)
+                    if response.status_code >= 400:
+                        error = str(response.status_code)
+                except Exception as e:
+                    error = type(e).__name__
+                elapsed = time.perf_counter() - started
+                with lock:
+                    timings.append(elapsed)
+                    if error is not None:
+                        errors[error] += 1
+        finally:
+            connection.close()
+
+    workers = [threading.Thread(target=worker, args=(x,)) for x in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        "requests": len(timings),
+        "errors": sum(errors.values()),
+        "error_causes": dict(errors.most_common()),
+        "throughput": round(len(timings) / wall, 2) if wall else 0,
+        "p50_ms": percentile_ms(timings, 0.5),
+        "p95_ms": percentile_ms(timings, 0.95),
+        "p99_ms": percentile_ms(timings, 0.99),
+    }
+
+
+def endpoint_requests(sample, seed=0):
+    from django.contrib.auth.models import User
+    from django.core.urlresolvers import reverse
+    from django.utils.timezone import now
+    from feeds.models import Feed, Post
+
+    rnd = random.Random(seed)
+    users = {x.pk: x for x in User.objects.all()}
+    feeds = list(Feed.objects.values_list('id', 'user_id'))
+    last = Post.objects.order_by('-id').values_list('id', flat=True).first()
+    posts = list(Post.objects.filter(id__in=[rnd.randint(1, last) for _ in range(sample)])
+                 .values_list('id', 'feed__user_id'))
+    current = (now() - timedelta(days=7)).timestamp()
+
+    def get_feeds(client, rnd):
+        client.force_authenticate(users[rnd.choice(feeds)[1]])
+        return client.get(reverse("feeds-list"), format='json')
+
+    def get_posts(client, rnd):
+        feed_id, user_id = rnd.choice(feeds)
+        client.force_authenticate(users[user_id])
+        return client.get(reverse("posts-list"), data={"name": feed_id, "new": "true", "current": current},
+                          format='json')
+
+    def patch_post(client, rnd):
+        post_id, user_id = rnd.choice(posts)
+        client.force_authenticate(users[user_id])
+        return client.patch(reverse("posts-detail", kwargs={"pk": post_id}), data={"view": True}, format='json')
+
+    return {"feeds": get_feeds, "posts": get_posts, "patch": patch_post}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure latency and throughput of the read APIs on a large dataset.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--feeds", type=int, default=20, help="Mean number of feeds per user.")
+    parser.add_argument("--links", type=int, default=2000)
+    parser.add_argument("--posts", type=int, default=1000000)
+    parser.add_argument("--requests", type=int, default=500, help="Requests per endpoint.")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--database", type=json.loads,
+                        help="Django DATABASES entry as JSON; a test_ database is created next to it and dropped "
+                             "afterwards. Defaults to a SQLite file in the temporary directory.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    database = args.database
+    if database is None:
+        # a file, as in-memory SQLite databases are not shared by the threads of the driver
+        path = os.path.join(tempfile.gettempdir(), "feeds-benchmark.sqlite3")
+        database = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path, 'TEST': {'NAME': path}}
+    setup(database)
+
+    with test_database() as vendor:
+        started = time.perf_counter()
+        dataset = generate(args.users, args.feeds, args.links, args.posts, args.seed)
+        dataset["seconds"] = round(time.perf_counter() - started, 2)
+        handlers = endpoint_requests(args.requests, args.seed)
+        endpoints = {name: drive(handlers[name], args.requests, args.threads) for name in args.endpoints}
+
+    results = {
+        "benchmark": "api",
+        "vendor": vendor,
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "database")},
+        "dataset": dataset,
+        "endpoints": endpoints,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
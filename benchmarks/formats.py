@@ -0,0 +1,48 @@
+import argparse
+import json
+import time
+
+from benchmarks import setup
+from benchmarks.serialization import create_posts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare payload size and encode time of the API formats.")
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--feeds", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    setup()
+    from rest_framework.test import APIClient
+    from feeds.models import Feed
+    from feeds.renderers import msgpack
+
+    user = create_posts(args.posts)
+    Feed.objects.bulk_create(Feed(name="Feed {}".format(x), user=user, position=x + 1) for x in range(args.feeds))
+    client = APIClient()
+    client.force_authenticate(user)
+
+    formats = {
+        "json": {"HTTP_ACCEPT": "application/json"},
+        "json+gzip": {"HTTP_ACCEPT": "application/json", "HTTP_ACCEPT_ENCODING": "gzip"},
+    }
+    if msgpack:
+        formats["msgpack"] = {"HTTP_ACCEPT": "application/msgpack"}
+        formats["msgpack+gzip"] = {"HTTP_ACCEPT": "application/msgpack", "HTTP_ACCEPT_ENCODING": "gzip"}
+
+    results = []
+    for path in ("/posts/", "/feeds/"):
+        for name, headers in formats.items():
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                response = client.get(path, **headers)
+                body = b"".join(response.streaming_content) if response.streaming else response.content
+                timings.append(time.perf_counter() - started)
+            results.append({"path": path, "format": name, "bytes": len(body), "seconds": round(min(timings), 4)})
+    print(json.dumps({"posts": args.posts, "feeds": args.feeds, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import json
+from collections import Counter
+from io import StringIO
+from unittest.mock import patch
+
+from benchmarks import setup
+
+
+def rss(entries, updated=False):
+    items = "".join(
+        "<item><title>Post {}</title><link>https://test.com/feed/Post{}</link><pubDate>{}</pubDate></item>".format(
+            "{} (updated)".format(x) if updated and x == 0 else x, x,
+            "2100-01-01T00:00:00" if updated and x == 0 else "2018-01-31T11:{:02}:00".format(x % 60)
+        )
+        for x in range(entries)
+    )
+    return '<?xml version="1.0" encoding="UTF-8" ?><rss version="2.0"><channel><title>Feed</title>' \
+           '<link>https://test.com/feed/</link><description>Feed</description>{}</channel></rss>'.format(items)
+
+
+def refresh(body):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from feeds.views import get_posts
+
+    with patch("feed_reader.feed_reader.open_url", lambda *args, **kwargs: StringIO(body)):
+        with CaptureQueriesContext(connection) as queries:
+            get_posts()
+    return Counter(
+        " ".join(x['sql'].split()[:3]).replace('"', '') for x in queries.captured_queries
+        if x['sql'].startswith(("INSERT", "UPDATE"))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure item storage and writes when many feeds follow one link.")
+    parser.add_argument("--feeds", type=int, default=100)
+    parser.add_argument("--entries", type=int, default=20)
+    args = parser.parse_args()
+
+    setup()
+    from django.contrib.auth.models import User
+    from feeds.models import Feed, FeedLink, Item, Link, Post
+
+    link = Link.objects.create(url="https://test.com/feed/")
+    for x in range(args.feeds):
+        user = User.objects.create(username="user{}".format(x))
+        feed = Feed.objects.create(name="Feed", user=user, position=0, postLimit=args.entries)
+        FeedLink.objects.create(feed=feed, link=link, position=0, reg_exp="")
+
+    first = refresh(rss(args.entries))
+    # A changed title is written once to the shared item, whatever the number of feeds following the link.
+    second = refresh(rss(args.entries, updated=True))
+
+    content = sum(len(x.title) + len(x.url) + len(x.post_date.isoformat()) for x in Item.objects.all())
+    posts = Post.objects.count()
+    items = Item.objects.count()
+    print(json.dumps({
+        "feeds": args.feeds,
+        "entries": args.entries,
+        "posts": posts,
+        "items": items,
+        "content_bytes": content,
+        "denormalized_content_bytes": content * posts // items,
+        "first_refresh_writes": first,
+        "update_refresh_writes": second,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import argparse
+import json
+import random
+import resource
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from benchmarks import setup
+
+RSS = '<?xml version="1.0" encoding="UTF-8" ?><rss version="2.0"><channel><title>Feed {}</title>' \
+      '<link>https://test.com/feed{}/</link><description>Feed</description>{}</channel></rss>'
+RSS_ITEM = '<item><title>{}</title><link>{}</link><pubDate>{}</pubDate></item>'
+ATOM = '<?xml version="1.0" encoding="UTF-8" ?><feed xmlns="http://www.w3.org/2005/Atom"><title>Feed {}</title>' \
+       '<link href="https://test.com/feed{}/"/>{}</feed>'
+ATOM_ITEM = '<entry><title>{}</title><link href="{}"/><published>{}</published></entry>'
+
+# Keeps the posts of every second number, for the feed links given a filter.
+REG_EXP = r"Post \d*[02468]( |$)"
+
+
+class SyntheticFeeds:
+    # Feeds of `items` entries each; every round `churn` of them are replaced by newer entries and `updates` of the
+    # remaining ones get a new title. `overlap` of the entries point to urls shared by all the feeds.
+
+    def __init__(self, links, items, kind="rss", overlap=0.0, churn=0.1, updates=0.0, seed=0):
+        from django.utils.timezone import now
+
+        self.links, self.items, self.kind = links, items, kind
+        self.overlap, self.churn, self.updates = overlap, churn, updates
+        self.random = random.Random(seed)
+        self.start = now() - timedelta(days=1)
+        self.clock = self.start + timedelta(seconds=items)
+        self.round = 0
+        self.entries = [self.initial_entries(x) for x in range(links)]
+
+    def entry(self, link, number, date):
+        shared = number % 100 < self.overlap * 100
+        url = "https://shared.test.com/post/{}".format(number) if shared else \
+            "https://test.com/feed{}/Post{}".format(link, number)
+        return {"number": number, "title": "Post {}".format(number), "url": url, "date": date}
+
+    def initial_entries(self, link):
+        return [self.entry(link, number, self.start + timedelta(seconds=number))
+                for number in range(self.items - 1, -1, -1)]
+
+    def advance(self):
+        # The loop only takes entries newer than the posts it added, which it dates with the time it ran. RSS dates
+        # have whole seconds, so new and retitled entries are dated on the next second after both that time and the
+        # previous round.
+        from django.utils.timezone import now
+
+        self.round += 1
+        replaced = int(round(self.items * self.churn))
+        published = max(self.clock, now().replace(microsecond=0)) + timedelta(seconds=1)
+        for link, entries in enumerate(self.entries):
+            newest = entries[0]["number"] if entries else -1
+            fresh = [self.entry(link, number, published) for number in range(newest + replaced, newest, -1)]
+            kept = entries[:self.items - len(fresh)]
+            for entry in self.random.sample(kept, int(len(kept) * self.updates)):
+                entry["title"] = "Post {} (update {})".format(entry["number"], self.round)
+                entry["date"] = published
+            self.entries[link] = fresh + kept
+        self.clock = published
+
+    def kind_of(self, link):
+        if self.kind == "mixed":
+            return "atom" if link % 2 else "rss"
+        return self.kind
+
+    def render(self, link):
+        if self.kind_of(link) == "atom":
+            body = "".join(ATOM_ITEM.format(x["title"], x["url"], x["date"].isoformat()) for x in self.entries[link])
+            return ATOM.format(link, link, body)
+        body = "".join(RSS_ITEM.format(x["title"], x["url"], x["date"].strftime("%a, %d %b %Y %H:%M:%S %z"))
+                       for x in self.entries[link])
+        return RSS.format(link, link, body)
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.documents.get(self.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+    # Local stand-in for the sites of the feeds, answering after `latency` seconds.
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(("127.0.0.1", 0), FeedHandler)
+        self.latency = latency
+        self.documents = {}
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def url(self, link):
+        return "http://127.0.0.1:{}/feeds/{}.xml".format(self.server_address[1], link)
+
+    def publish(self, feeds):
+        self.documents = {"/feeds/{}.xml".format(x): feeds.render(x).encode() for x in range(feeds.links)}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def create_links(server, links, followers, items, filtered):
+    from django.contrib.auth.models import User
+    from feeds.models import Feed, FeedLink, Link
+
+    users = [User.objects.create(username="user{}".format(x)) for x in range(followers)]
+    for x in range(links):
+        link = Link.objects.create(url=server.url(x))
+        for user in users:
+            feed = Feed.objects.create(name="Feed {}".format(x), user=user, position=x, postLimit=items)
+            reg_exp = REG_EXP if (x + user.pk) % 100 < filtered * 100 else ""
+            FeedLink.objects.create(feed=feed, link=link, position=0, reg_exp=reg_exp)
+
+
+def run_round(trace_memory):
+    from feeds.models import LoopRun
+    from feeds.views import get_posts
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result = get_posts()
+    wall = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    run = LoopRun.objects.get(pk=result["run"])
+    links = list(run.links.all())
+    queries = sorted(x.queries for x in links)
+    return {
+        "wall_seconds": round(wall, 4),
+        "links": len(links),
+        "errors": sum(1 for x in links if x.error),
+        "added": result["added"],
+        "updated": result["updated"],
+        "deleted": result["deleted"],
+        "fetch_seconds": round(sum(x.fetch_time or 0 for x in links), 4),
+        "parse_seconds": round(sum(x.parse_time or 0 for x in links), 4),
+        "reconcile_seconds": round(sum(x.reconcile_time or 0 for x in links), 4),
+        "queries_per_link": round(sum(queries) / len(queries), 2) if queries else 0,
+        "max_queries_per_link": queries[-1] if queries else 0,
+        "peak_traced_bytes": peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the refresh loop against generated feeds served locally.")
+    parser.add_argument("--links", type=int, default=50)
+    parser.add_argument("--items", type=int, default=20, help="Entries of every feed.")
+    parser.add_argument("--followers", type=int, default=1, help="Feeds following every link.")
+    parser.add_argument("--format", choices=("rss", "atom", "mixed"), default="mixed")
+    parser.add_argument("--overlap", type=float, default=0.0, help="Share of entries with urls shared by all feeds.")
+    parser.add_argument("--filtered", type=float, default=0.0, help="Share of feed links with a title filter.")
+    parser.add_argument("--churn", type=float, default=0.1, help="Share of entries replaced every round.")
+    parser.add_argument("--updates", type=float, default=0.0, help="Share of kept entries retitled every round.")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the server waits before answering.")
+    parser.add_argument("--trace-memory", action="store_true", help="Report tracemalloc peaks (slows the loop).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    setup(FEEDS_LOOP_HISTORY=args.rounds)
+    feeds = SyntheticFeeds(args.links, args.items, args.format, args.overlap, args.churn, args.updates, args.seed)
+    rounds = []
+    with FeedServer(args.latency) as server:
+        create_links(server, args.links, args.followers, args.items, args.filtered)
+        for x in range(args.rounds):
+            if x:
+                feeds.advance()
+            server.publish(feeds)
+            rounds.append(run_round(args.trace_memory))
+
+    results = {
+        "benchmark": "loop",
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "rounds": rounds,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
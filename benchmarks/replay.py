@@ -0,0 +1,46 @@
+import argparse
+import json
+
+from benchmarks import setup
+from benchmarks.loop import run_round
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded feed responses through the refresh loop.")
+    parser.add_argument("directory", help="Recordings of feed_reader.transports.RecordingTransport.")
+    parser.add_argument("--followers", type=int, default=1, help="Feeds following every recorded link.")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--trace-memory", action="store_true", help="Report tracemalloc peaks (slows the loop).")
+    parser.add_argument("--output", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    setup(FEEDS_LOOP_HISTORY=args.rounds, FEEDS_TRANSPORT='feed_reader.transports.ReplayTransport',
+          FEEDS_TRANSPORT_OPTIONS={'directory': args.directory})
+    from django.contrib.auth.models import User
+    from feed_reader.transports import recorded_urls
+    from feeds.models import Feed, FeedLink, Link
+
+    urls = recorded_urls(args.directory)
+    users = [User.objects.create(username="user{}".format(x)) for x in range(args.followers)]
+    for position, url in enumerate(urls):
+        link = Link.objects.create(url=url)
+        for user in users:
+            feed = Feed.objects.create(name=url, user=user, position=position)
+            FeedLink.objects.create(feed=feed, link=link, position=0, reg_exp="")
+
+    # the first round stores every entry, the later ones measure a loop in which nothing changed
+    rounds = [run_round(args.trace_memory) for _ in range(args.rounds)]
+    results = {
+        "benchmark": "replay",
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "links": len(urls),
+        "rounds": rounds,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import json
+import time
+from datetime import timedelta
+
+from benchmarks import setup
+
+
+def create_posts(count):
+    from django.contrib.auth.models import User
+    from django.utils.timezone import now
+    from feeds.models import Feed, Item, Post
+
+    user = User.objects.create(username="bench")
+    feed = Feed.objects.create(name="Feed", user=user, position=0)
+    start = now()
+    Item.objects.bulk_create(
+        Item(title="Post {}".format(x), url="https://test.com/feed/Post{}".format(x),
+             post_date=start - timedelta(minutes=x))
+        for x in range(count)
+    )
+    Post.objects.bulk_create(
+        Post(feed=feed, user=user, item_id=item_id, add_date=start - timedelta(minutes=x), view=x % 3 == 0)
+        for x, item_id in enumerate(Item.objects.order_by('id').values_list('id', flat=True))
+    )
+    return user
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the serializer and values paths of the post list.")
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    setup()
+    from rest_framework.renderers import JSONRenderer
+    from feeds.models import Post
+    from feeds.serializers import PostSerializer, values_representation
+
+    create_posts(args.posts)
+    queryset = Post.objects.select_related('item')
+    renderer = JSONRenderer()
+
+    serializer_time, serializer_body = measure(
+        lambda: renderer.render({"count": args.posts, "results": PostSerializer(queryset.all(), many=True).data}),
+        args.repeat
+    )
+    values_time, values_body = measure(
+        lambda: renderer.render({"count": args.posts, "results": values_representation(PostSerializer, queryset.all())}),
+        args.repeat
+    )
+    print(json.dumps({
+        "posts": args.posts,
+        "serializer_seconds": round(serializer_time, 4),
+        "values_seconds": round(values_time, 4),
+        "speedup": round(serializer_time / values_time, 2),
+        "identical": serializer_body == values_body,
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,22 @@ from urllib.parse import unquote
 
 import iso8601
 from bs4 import BeautifulSoup
-from django.utils.timezone import datetime, now, make_aware, is_naive
-from feeds.models import Post, FeedLink
+from django.utils.timezone import datetime, make_aware, is_naive
+from django.db.models import Max
+from feeds.models import FeedLink, Item
+from feeds.profiling import profiled
+from feed_reader.transports import get_transport
 
 
-def scan_url(url):
-    url = unquote(a2b_base64(url).decode())
+def decode_url(url):
+    return unquote(a2b_base64(url).decode())
 
+
+def scan_url(url, timeout=None):
+    return scan_site(decode_url(url), timeout)
+
+
+def scan_site(url, timeout=None):
     req = urllib.request.Request(
         url,
         data=None,
@@ -20,22 +29,25 @@ def scan_url(url):
             'User-Agent': 'feed-reader'
         })
 
-    site = urllib.request.urlopen(req)
+    site = open_url(req, timeout)
     stream = site.read()
     soup = BeautifulSoup(stream, "html")
     links = soup.head.find_all("link", {"type": "application/rss+xml"})
     return [x.get('href') for x in links]
 
 
-def extract_feeds(url):
-    url = unquote(a2b_base64(url).decode())
+def extract_feeds(url, timeout=None):
+    return extract_feed(decode_url(url), timeout)
+
+
+def extract_feed(url, timeout=None):
     req = urllib.request.Request(
         url,
         data=None,
         headers={
             'User-Agent': 'feed-reader'
         })
-    site = urllib.request.urlopen(req)
+    site = open_url(req, timeout)
     stream = site.read()
     soup = BeautifulSoup(stream, "xml")
     channel = soup.find("channel")
@@ -49,22 +61,46 @@ def extract_feeds(url):
     return {"name": title, "url": url}
 
 
+def open_url(req, timeout=None):
+    return get_transport().open(req, timeout)
+
+
 class FeedDownloader:
-    def __init__(self, url):
+    def __init__(self, url, timeout=None):
         self.url = url
+        self.timeout = timeout
         self.max_posts = get_greatest_limit(url)
+        self.moved_to = None
+        self.status = None
+        self.hub = None
+        self.topic = None
 
     def get_posts(self):
+        return self.parse(self.fetch())
 
+    # the loop, on demand refreshes and WebSub pushes fetch and parse separately
+    @profiled('FeedDownloader.fetch')
+    def fetch(self):
         req = urllib.request.Request(
             self.url,
             data=None,
             headers={
                 'User-Agent': 'feed-reader'
             })
-        site = urllib.request.urlopen(req)
-        stream = site.read()
+        site = open_url(req, self.timeout)
+        self.status = getattr(site, 'status', None)
+        if getattr(site, 'permanent_redirect', False):
+            self.moved_to = site.geturl()
+        return site.read()
+
+    @profiled('FeedDownloader.parse')
+    def parse(self, stream):
         soup = BeautifulSoup(stream, "xml")
+        hub = soup.find("link", rel="hub")
+        if hub is not None:
+            self.hub = hub.get("href")
+            topic = soup.find("link", rel="self")
+            self.topic = topic.get("href") if topic is not None else self.url
         items = soup.findAll("item")
         if len(items) == 0:
             items = soup.findAll("entry")
@@ -96,14 +132,14 @@ class FeedDownloader:
 
             if is_naive(post_date):
                 post_date = make_aware(post_date)
-            post = Post(title=title, url=link, post_date=post_date, add_date=now(), view=False)
+            post = Item(title=title, url=link, post_date=post_date)
             posts += [post]
 
         return posts
 
 
 def get_greatest_limit(url):
-    links = FeedLink.objects.filter(link__url=url)
-    if len(links) > 0:
-        return max([x.feed.postLimit for x in links])
+    limit = FeedLink.objects.filter(link__url=url).aggregate(limit=Max('feed__postLimit'))['limit']
+    if limit is not None:
+        return limit
     return 10
@@ -0,0 +1,229 @@
+import base64
+import hashlib
+import http.client
+import io
+import json
+import os
+import socket
+import threading
+import urllib.request
+from contextlib import contextmanager
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_TRANSPORT = 'feed_reader.transports.UrllibTransport'
+PERMANENT_REDIRECTS = (301, 308)
+
+
+class Response:
+    # What the transports return: the body, the final url and whether only permanent redirects led there.
+
+    def __init__(self, url, body=b"", status=200, headers=None, permanent_redirect=False):
+        self.url = url
+        self.body = body.encode() if isinstance(body, str) else body
+        self.status = status
+        self.headers = dict(headers or {})
+        self.permanent_redirect = permanent_redirect
+
+    def read(self):
+        return self.body
+
+    def geturl(self):
+        return self.url
+
+    def error(self):
+        reason = http.client.responses.get(self.status, "Error")
+        return HTTPError(self.url, self.status, reason, self.headers, io.BytesIO(self.body))
+
+
+class Transport:
+    # Fetches a urllib.request.Request; failures are raised as urllib's URLError and HTTPError.
+
+    def open(self, request, timeout=None):
+        raise NotImplementedError
+
+
+class RedirectHandler(urllib.request.HTTPRedirectHandler):
+    # marks responses that were reached through permanent redirects only
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return super().redirect_request(req, fp, 307 if code == 308 else code, msg, headers, newurl)
+
+    def http_error_302(self, req, fp, code, msg, headers):
+        response = super().http_error_302(req, fp, code, msg, headers)
+        response.permanent_redirect = code in PERMANENT_REDIRECTS and getattr(response, 'permanent_redirect', True)
+        return response
+
+    http_error_301 = http_error_303 = http_error_307 = http_error_308 = http_error_302
+
+
+class UrllibTransport(Transport):
+
+    def open(self, request, timeout=None):
+        return urllib.request.build_opener(RedirectHandler).open(request, timeout=timeout)
+
+
+class Urllib3Transport(Transport):
+    # Keeps connections to the hosts alive between fetches.
+
+    def __init__(self, redirects=10, **pool_options):
+        import urllib3
+
+        self.urllib3 = urllib3
+        self.redirects = redirects
+        self.pool = urllib3.PoolManager(**pool_options)
+
+    def open(self, request, timeout=None):
+        exceptions = self.urllib3.exceptions
+        retries = self.urllib3.Retry(total=self.redirects, connect=0, read=0, redirect=self.redirects)
+        try:
+            response = self.pool.urlopen(
+                request.get_method(), request.full_url, body=request.data, headers=dict(request.header_items()),
+                timeout=timeout, retries=retries
+            )
+        except exceptions.HTTPError as e:
+            reason = getattr(e, 'reason', None) or e
+            if isinstance(reason, exceptions.TimeoutError):
+                reason = socket.timeout(str(reason))
+            raise URLError(reason)
+
+        url = request.full_url
+        history = response.retries.history if response.retries else ()
+        for redirect in history:
+            url = urljoin(url, redirect.redirect_location)
+        permanent = bool(history) and all(x.status in PERMANENT_REDIRECTS for x in history)
+        result = Response(url, response.data, response.status, response.headers, permanent)
+        if response.status >= 400:
+            raise result.error()
+        return result
+
+
+class MemoryTransport(Transport):
+    # Answers from a dict of url to body, Response or exception, and keeps the (url, timeout) of every request.
+
+    def __init__(self, responses=None):
+        self.responses = dict(responses or {})
+        self.requests = []
+
+    def open(self, request, timeout=None):
+        self.requests.append((request.full_url, timeout))
+        response = self.responses.get(request.full_url)
+        if response is None:
+            raise URLError("no response for {}".format(request.full_url))
+        if isinstance(response, Exception):
+            raise response
+        if not isinstance(response, Response):
+            response = Response(request.full_url, response)
+        if response.status >= 400:
+            raise response.error()
+        return response
+
+
+def get_key(request):
+    data = request.data or b""
+    return hashlib.sha1(b"\n".join((request.get_method().encode(), request.full_url.encode(), data))).hexdigest()
+
+
+class RecordingTransport(Transport):
+    # Fetches through another transport and writes every answer, errors included, to `directory`.
+
+    def __init__(self, directory, transport=DEFAULT_TRANSPORT):
+        self.directory = directory
+        self.transport = import_string(transport)() if isinstance(transport, str) else transport
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, request, timeout=None):
+        record = {"method": request.get_method(), "url": request.full_url}
+        try:
+            response = self.transport.open(request, timeout)
+            body = response.read()
+        except HTTPError as e:
+            record.update(status=e.code, final_url=e.geturl() or request.full_url,
+                          body=base64.b64encode(e.read() or b"").decode())
+            self.save(request, record)
+            raise
+        except URLError as e:
+            record.update(error=str(e.reason), timeout=isinstance(e.reason, socket.timeout))
+            self.save(request, record)
+            raise
+        response = Response(getattr(response, 'geturl', lambda: request.full_url)(), body,
+                            getattr(response, 'status', 200), getattr(response, 'headers', None),
+                            getattr(response, 'permanent_redirect', False))
+        record.update(status=response.status, final_url=response.url, headers=dict(response.headers),
+                      permanent_redirect=response.permanent_redirect, body=base64.b64encode(body).decode())
+        self.save(request, record)
+        return response
+
+    def save(self, request, record):
+        with open(os.path.join(self.directory, get_key(request) + '.json'), 'w') as f:
+            json.dump(record, f)
+
+
+class ReplayTransport(Transport):
+    # Answers from the files of a RecordingTransport, without touching the network.
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def open(self, request, timeout=None):
+        try:
+            with open(os.path.join(self.directory, get_key(request) + '.json')) as f:
+                record = json.load(f)
+        except OSError:
+            raise URLError("not recorded: {}".format(request.full_url))
+        if "error" in record:
+            raise URLError(socket.timeout(record["error"]) if record.get("timeout") else record["error"])
+        response = Response(record["final_url"], base64.b64decode(record["body"]), record["status"],
+                            record.get("headers"), record.get("permanent_redirect", False))
+        if response.status >= 400:
+            raise response.error()
+        return response
+
+
+def recorded_urls(directory):
+    # the urls fetched successfully by GET in a directory of recordings
+    urls = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.json'):
+            with open(os.path.join(directory, filename)) as f:
+                record = json.load(f)
+            if record["method"] == "GET" and record.get("status") == 200:
+                urls.append(record["url"])
+    return urls
+
+
+transports = {}
+# the transports set by use_transport(), for the thread that set them only
+local = threading.local()
+
+
+def get_overrides():
+    if not hasattr(local, 'overrides'):
+        local.overrides = []
+    return local.overrides
+
+
+def get_transport():
+    # FEEDS_TRANSPORT is the dotted path of the transport class, FEEDS_TRANSPORT_OPTIONS its keyword arguments
+    overrides = get_overrides()
+    if overrides:
+        return overrides[-1]
+    path = getattr(settings, 'FEEDS_TRANSPORT', DEFAULT_TRANSPORT)
+    options = getattr(settings, 'FEEDS_TRANSPORT_OPTIONS', {})
+    key = (path, json.dumps(options, sort_keys=True))
+    if key not in transports:
+        transports[key] = import_string(path)(**options)
+    return transports[key]
+
+
+@contextmanager
+def use_transport(transport):
+    overrides = get_overrides()
+    overrides.append(transport)
+    try:
+        yield transport
+    finally:
+        overrides.remove(transport)
@@ -1,23 +1,104 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
-from feeds.models import Feed, Link, Post, FeedLink
+from feeds.models import DiscoveryJob, Feed, Item, Link, LoopRun, LoopRunLink, Post, FeedLink, Subscription
+
+# Below this many rows the exact count is cheap enough.
+ESTIMATE_THRESHOLD = 10000
+
+
+def estimate_count(queryset):
+    # the row count the database keeps in its statistics, or the highest rowid on SQLite
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute("SELECT table_rows FROM information_schema.tables "
+                           "WHERE table_schema = DATABASE() AND table_name = %s", [table])
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT MAX(rowid) FROM {}".format(connection.ops.quote_name(table)))
+        else:
+            return None
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+class EstimatedCountPaginator(Paginator):
+    # Counting a table of millions of rows for every changelist page is replaced by the database's estimate,
+    # filtered changelists are still counted exactly.
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class FeedLinkInline(admin.TabularInline):
     model = FeedLink
+    raw_id_fields = ("link",)
     extra = 1
 
 
-class FeedAdmin(admin.ModelAdmin):
+class FeedAdmin(LargeTableAdmin):
     inlines = (FeedLinkInline,)
     list_display = ("__str__", 'position',)
+    list_select_related = ("user",)
+    raw_id_fields = ("user",)
+
+
+class FeedLinkAdmin(LargeTableAdmin):
+    list_display = ("__str__", "reg_exp", "position")
+    list_select_related = ("feed__user", "link")
+    raw_id_fields = ("feed", "link")
+
+
+class ItemAdmin(LargeTableAdmin):
+    list_display = ("title", "link", "post_date")
+    list_select_related = ("link",)
+    raw_id_fields = ("link",)
+
+
+class LoopRunLinkInline(admin.TabularInline):
+    model = LoopRunLink
+    raw_id_fields = ("link",)
+    extra = 0
+
+
+class LoopRunAdmin(admin.ModelAdmin):
+    inlines = (LoopRunLinkInline,)
+    list_display = ("started", "duration", "added", "updated", "deleted", "deferred")
+
 
+class PostAdmin(LargeTableAdmin):
+    list_display = ("__str__", "post_date", "add_date", "view")
+    list_select_related = ("feed__user", "item")
+    list_filter = ("view",)
+    raw_id_fields = ("feed", "item")
+    date_hierarchy = "add_date"
+    ordering = ("-add_date",)
 
-class PostAdmin(admin.ModelAdmin):
-    list_display = ("__str__","post_date","add_date")
+    def post_date(self, obj):
+        return obj.item.post_date
+    post_date.admin_order_field = "item__post_date"
 
 
 admin.site.register(Feed, FeedAdmin)
 admin.site.register(Link)
+admin.site.register(Item, ItemAdmin)
 admin.site.register(Post, PostAdmin)
-admin.site.register(FeedLink)
+admin.site.register(FeedLink, FeedLinkAdmin)
+admin.site.register(Subscription)
+admin.site.register(DiscoveryJob)
+admin.site.register(LoopRun, LoopRunAdmin)
@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
+
+
+class FeedsConfig(AppConfig):
+    name = 'feeds'
+
+    def ready(self):
+        from feeds.links import set_key
+        from feeds.models import Item, Link
+        from feeds.search import index_item, remove_item
+
+        post_save.connect(index_item, sender=Item, dispatch_uid='feeds_index_item')
+        post_delete.connect(remove_item, sender=Item, dispatch_uid='feeds_remove_item')
+        post_save.connect(set_key, sender=Link, dispatch_uid='feeds_link_key')
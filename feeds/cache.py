@@ -0,0 +1,38 @@
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import caches
+
+STATS_KEYS = {"hits": "feeds:cache:hits", "misses": "feeds:cache:misses"}
+
+
+def get_cache():
+    return caches[getattr(settings, 'FEEDS_CACHE', 'default')]
+
+
+def get_or_set(name, version, compute, extra=""):
+    # Keys embed the user's change version, so bumping it invalidates every entry of that user.
+    cache = get_cache()
+    key = "feeds:{}:{}:{}:{}".format(name, version.user_id, version.version, md5(extra.encode()).hexdigest())
+    value = cache.get(key)
+    if value is None:
+        _count(cache, "misses")
+        value = compute()
+        cache.set(key, value, getattr(settings, 'FEEDS_CACHE_TIMEOUT', 300))
+    else:
+        _count(cache, "hits")
+    return value
+
+
+def stats():
+    cache = get_cache()
+    values = cache.get_many(list(STATS_KEYS.values()))
+    return {name: values.get(key, 0) for name, key in STATS_KEYS.items()}
+
+
+def _count(cache, name):
+    if not cache.add(STATS_KEYS[name], 1, None):
+        try:
+            cache.incr(STATS_KEYS[name])
+        except ValueError:
+            cache.set(STATS_KEYS[name], 1, None)
@@ -0,0 +1,24 @@
+from django.db import connections
+from django.db.models import Max
+
+from feeds.models import PostChange
+
+
+def record_changes(posts):
+    # logs a change of every post of the queryset with a single INSERT ... SELECT
+    sql, params = posts.order_by().values_list('feed__user_id', 'id').query.sql_with_params()
+    connection = connections[posts.db]
+    quote = connection.ops.quote_name
+    columns = [PostChange._meta.get_field(x).column for x in ('user', 'post')]
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO {} ({}, {}) {}".format(
+            quote(PostChange._meta.db_table), quote(columns[0]), quote(columns[1]), sql
+        ), params)
+
+
+def compact_changes(user_ids):
+    # Only the latest change of a post is kept: a client whose cursor is before an older change of the post is
+    # also before the latest one, so nothing it would be sent is lost.
+    changes = PostChange.objects.filter(user__in=user_ids)
+    latest = changes.values('user', 'post').annotate(last=Max('id')).values('last')
+    changes.exclude(id__in=latest).delete()
@@ -0,0 +1,61 @@
+import re
+import zlib
+from functools import wraps
+
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.routers import DefaultRouter
+
+re_accepts_gzip = re.compile(r'\bgzip\b')
+
+MIN_SIZE = 200
+STREAM_SIZE = 64 * 1024
+
+
+def gzip_chunks(content, chunk_size=STREAM_SIZE):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    content = memoryview(content)
+    for start in range(0, len(content), chunk_size):
+        data = compressor.compress(content[start:start + chunk_size])
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gzip_response(view):
+    # Large bodies are compressed chunk by chunk while being sent, so only the rendered body is held in memory.
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if response.streaming or response.status_code != 200 or response.has_header('Content-Encoding'):
+            return response
+        if hasattr(response, 'render'):
+            response.render()
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < MIN_SIZE or not re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            return response
+
+        if response.has_header('ETag') and not response['ETag'].startswith('W/'):
+            response['ETag'] = 'W/' + response['ETag']
+        if len(response.content) < STREAM_SIZE:
+            response.content = b"".join(gzip_chunks(response.content))
+        else:
+            compressed = StreamingHttpResponse(gzip_chunks(response.content), status=response.status_code)
+            for header, value in response.items():
+                compressed[header] = value
+            response = compressed
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+        response['Content-Encoding'] = 'gzip'
+        return response
+    return wrapper
+
+
+class CompressedRouter(DefaultRouter):
+
+    def get_urls(self):
+        urls = super().get_urls()
+        for pattern in urls:
+            pattern.callback = gzip_response(pattern.callback)
+        return urls
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from feed_reader.feed_reader import extract_feed, scan_site
+from feeds.models import DiscoveryJob
+
+DISCOVERERS = {
+    DiscoveryJob.SCAN: scan_site,
+    DiscoveryJob.EXTRACT: extract_feed,
+}
+
+
+def get_timeout():
+    return getattr(settings, 'FEEDS_DISCOVERY_TIMEOUT', 10)
+
+
+def get_active_key(kind, url):
+    return hashlib.sha1("{} {}".format(kind, url).encode()).hexdigest()
+
+
+def get_job(kind, url):
+    # jobs for the same url are shared: a pending, running or recently finished one is reused
+    ttl = timedelta(seconds=getattr(settings, 'FEEDS_DISCOVERY_TTL', 60 * 60))
+    job = DiscoveryJob.objects.filter(kind=kind, url=url).filter(
+        Q(status__in=(DiscoveryJob.PENDING, DiscoveryJob.RUNNING)) |
+        Q(status=DiscoveryJob.DONE, finished__gte=now() - ttl)
+    ).order_by('-id').first()
+    if job is not None:
+        return job, False
+    # `active` is unique while a job is pending or running, so of concurrent requests only one creates it
+    key = get_active_key(kind, url)
+    try:
+        with transaction.atomic():
+            return DiscoveryJob.objects.create(kind=kind, url=url, active=key), True
+    except IntegrityError:
+        job = DiscoveryJob.objects.filter(active=key).first()
+        if job is None:
+            # the job finished in the meantime
+            return get_job(kind, url)
+        return job, False
+
+
+def claim_job():
+    # jobs left running by a worker that died are picked up again
+    stale = now() - timedelta(seconds=3 * get_timeout())
+    candidates = DiscoveryJob.objects.filter(
+        Q(status=DiscoveryJob.PENDING) | Q(status=DiscoveryJob.RUNNING, started__lt=stale)
+    ).order_by('id').values_list('id', 'status', 'started')
+    for pk, status, started in candidates[:10]:
+        if DiscoveryJob.objects.filter(pk=pk, status=status, started=started).update(
+                status=DiscoveryJob.RUNNING, started=now()):
+            return DiscoveryJob.objects.get(pk=pk)
+    return None
+
+
+def run_job(job):
+    # any error fails the job, a job left running would keep its worker busy until it is reclaimed as stale
+    try:
+        result = DISCOVERERS[job.kind](job.url, get_timeout())
+    except Exception as e:
+        job.status, job.error = DiscoveryJob.FAILED, (str(e) or e.__class__.__name__)[:255]
+    else:
+        job.status, job.result = DiscoveryJob.DONE, json.dumps(result)
+    job.finished = now()
+    job.active = None
+    job.save()
+    return job
+
+
+def run_pending(limit=None):
+    done = 0
+    while limit is None or done < limit:
+        job = claim_job()
+        if job is None:
+            break
+        run_job(job)
+        done += 1
+    return done
+
+
+def wait_for_job(job, timeout):
+    deadline = time.monotonic() + timeout
+    interval = getattr(settings, 'FEEDS_POLL_INTERVAL', 1)
+    while job.status in (DiscoveryJob.PENDING, DiscoveryJob.RUNNING):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+        job.refresh_from_db()
+    return job
@@ -0,0 +1,96 @@
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+
+
+class QueryCount:
+
+    def __init__(self, capture=False):
+        self.count = 0
+        self.capture = capture
+        self.queries = []
+
+
+class QueryCounting:
+    # reports every query to the count_queries() blocks open on its connection
+
+    def execute(self, sql, params=None):
+        started = time.monotonic()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.record(sql, started)
+
+    def executemany(self, sql, param_list):
+        started = time.monotonic()
+        try:
+            return super().executemany(sql, param_list)
+        finally:
+            self.record(sql, started)
+
+    def record(self, sql, started):
+        duration = time.monotonic() - started
+        for counter in getattr(self.db, 'query_counters', ()):
+            counter.count += 1
+            if counter.capture:
+                counter.queries.append({"sql": sql, "time": "%.3f" % duration})
+
+
+class CountingCursorWrapper(QueryCounting, CursorWrapper):
+    pass
+
+
+class CountingDebugCursorWrapper(QueryCounting, CursorDebugWrapper):
+    pass
+
+
+@contextmanager
+def count_queries(capture=False):
+    # Every query run on the connection while the block is open is counted as it runs, by wrapping the cursors the
+    # connection makes. Query logging is left as it is: formatting and keeping every query would cost the loop more
+    # than the count, and the log only keeps the last 9000 queries anyway.
+    db = connections[DEFAULT_DB_ALIAS]
+    result = QueryCount(capture)
+    if not hasattr(db, 'query_counters'):
+        db.query_counters = []
+    db.query_counters.append(result)
+    db.make_cursor = lambda cursor: CountingCursorWrapper(cursor, db)
+    db.make_debug_cursor = lambda cursor: CountingDebugCursorWrapper(cursor, db)
+    try:
+        yield result
+    finally:
+        db.query_counters.remove(result)
+        if not db.query_counters:
+            del db.make_cursor
+            del db.make_debug_cursor
+
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LISTS = re.compile(r"IN \((?:(?:\?|%s), )*(?:\?|%s)\)")
+
+
+def query_signature(sql):
+    # the query with its literals replaced, so the same query run for different rows shares one signature
+    return IN_LISTS.sub("IN (...)", LITERALS.sub("?", sql))
+
+
+def duplicated_queries(queries):
+    signatures = Counter(query_signature(x['sql']) for x in queries)
+    return [(signature, count) for signature, count in signatures.most_common() if count > 1]
+
+
+def measure_queries(action, prepare, sizes):
+    # runs action() once for every data size prepared by prepare(size), each size inside a rolled back transaction
+    results = {}
+    for size in sizes:
+        with transaction.atomic():
+            prepare(size)
+            with count_queries(capture=True) as queries:
+                action()
+            results[size] = queries
+            transaction.set_rollback(True)
+    return results
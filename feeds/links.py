@@ -0,0 +1,115 @@
+from collections import defaultdict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.db import transaction
+from django.db.models import F
+
+from feeds.models import FeedLink, Item, Link, LinkKey, Post, PostChange
+from feeds.versions import bump_versions
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+TRACKING_PARAMS = {'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'yclid'}
+
+
+def normalize_url(url):
+    url = url.strip()
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port
+    except ValueError:
+        return url
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return url
+
+    netloc = parts.hostname.lower()
+    if port and port != DEFAULT_PORTS[scheme]:
+        netloc = "{}:{}".format(netloc, port)
+    if parts.username:
+        userinfo = parts.username if parts.password is None else "{}:{}".format(parts.username, parts.password)
+        netloc = "{}@{}".format(userinfo, netloc)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if not key.lower().startswith('utm_') and key.lower() not in TRACKING_PARAMS]
+    return urlunsplit((scheme, netloc, parts.path.rstrip('/'), urlencode(query), ''))
+
+
+def url_key(url):
+    # http and https urls of the same feed share a key, everything else is compared after normalization
+    url = normalize_url(url)
+    scheme, _, rest = url.partition('://')
+    return rest if scheme in DEFAULT_PORTS else url
+
+
+def set_key(sender, instance, **kwargs):
+    LinkKey.objects.update_or_create(link=instance, defaults={'key': url_key(instance.url)})
+
+
+def get_link(url):
+    # an existing link for the same feed is reused, https first, otherwise the url is stored as entered
+    url = url.strip()
+    links = sorted(Link.objects.filter(key__key=url_key(url)),
+                   key=lambda x: (not x.url.lower().startswith('https://'), x.pk))
+    if links:
+        return links[0]
+    return Link.objects.create(url=url)
+
+
+@transaction.atomic
+def merge_links(link, duplicates):
+    duplicates = [x for x in duplicates if x.pk != link.pk]
+    if not duplicates:
+        return link
+    users = set(FeedLink.objects.filter(link__in=[link] + duplicates).values_list('feed__user_id', flat=True))
+
+    followed = set(FeedLink.objects.filter(link=link).values_list('feed_id', flat=True))
+    for feed_link in FeedLink.objects.filter(link__in=duplicates).order_by('-position'):
+        if feed_link.feed_id in followed:
+            feed_link.delete()
+            FeedLink.objects.filter(feed=feed_link.feed_id, position__gt=feed_link.position).update(
+                position=F('position') - 1
+            )
+        else:
+            followed.add(feed_link.feed_id)
+            feed_link.link = link
+            feed_link.save()
+
+    # items of the same url become one, the link's own item first
+    items = {}
+    moved = defaultdict(list)
+    rows = Item.objects.filter(link__in=[link] + duplicates).values_list('id', 'url', 'link_id')
+    for item_id, url, link_id in sorted(rows, key=lambda x: (x[2] != link.pk, x[0])):
+        if url in items:
+            moved[items[url]].append(item_id)
+        else:
+            items[url] = item_id
+    for item_id, duplicate_ids in moved.items():
+        posts = Post.objects.filter(item__in=duplicate_ids)
+        PostChange.objects.bulk_create(PostChange(post=x, user_id=user_id)
+                                       for x, user_id in posts.values_list('id', 'feed__user_id'))
+        posts.update(item=item_id)
+    # a feed that followed several of the links now has a post per link for these items, a read one is kept
+    kept = set()
+    extra = []
+    for post_id, feed_id, item_id in Post.objects.filter(item__in=list(moved)).order_by('-view', 'id').values_list(
+            'id', 'feed_id', 'item_id'):
+        if (feed_id, item_id) in kept:
+            extra.append(post_id)
+        kept.add((feed_id, item_id))
+    Post.objects.filter(id__in=extra).delete()
+    Item.objects.filter(link__in=duplicates, post=None).delete()
+    Item.objects.filter(link__in=duplicates).update(link=link)
+
+    Link.objects.filter(pk__in=[x.pk for x in duplicates]).delete()
+    bump_versions(users)
+    return link
+
+
+def move_link(link, url):
+    # a feed moved permanently, its followers and items go with it and it is fetched from the new url from now on
+    target = get_link(url)
+    if target.pk != link.pk:
+        target = merge_links(target, [link])
+    if target.url != url:
+        target.url = url
+        target.save()
+    return target
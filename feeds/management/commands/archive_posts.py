@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now
+
+from feeds.models import ArchivedPost, Feed, Item, Post
+from feeds.versions import bump_versions
+
+FIELDS = {
+    'id': 'id',
+    'item__title': 'title',
+    'item__url': 'url',
+    'item__post_date': 'post_date',
+    'add_date': 'add_date',
+    'view': 'view',
+    'seen': 'seen',
+    'mentioned': 'mentioned',
+}
+
+
+class Command(BaseCommand):
+    help = "Moves old viewed posts into the archive table, one committed batch at a time."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help="Archive posts added more than DAYS ago.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--feed', type=int, action='append', help="Only archive the given feed ids.")
+
+    def handle(self, *args, **options):
+        cutoff = now() - timedelta(days=options['days'])
+        feeds = Feed.objects.order_by('id')
+        if options['feed']:
+            feeds = feeds.filter(id__in=options['feed'])
+
+        total = 0
+        for feed in feeds:
+            moved = self.archive_feed(feed, cutoff, options['batch_size'])
+            if moved:
+                bump_versions([feed.user_id])
+                self.stdout.write("{}: archived {} posts".format(feed, moved))
+            total += moved
+        self.stdout.write("Archived {} posts".format(total))
+
+    def archive_feed(self, feed, cutoff, batch_size):
+        # The newest 2 * postLimit posts are what get_posts reconciles against, so they stay in the hot table.
+        kept = Post.objects.filter(feed=feed).order_by('-add_date').values_list('add_date', flat=True)
+        kept = list(kept[2 * feed.postLimit - 1:2 * feed.postLimit])
+        if not kept:
+            return 0
+        posts = Post.objects.filter(feed=feed, view=True, add_date__lt=min(cutoff, kept[0])).order_by('id')
+
+        moved = 0
+        while True:
+            with transaction.atomic():
+                batch = list(posts.values('item_id', *FIELDS)[:batch_size])
+                if not batch:
+                    return moved
+                ArchivedPost.objects.bulk_create(
+                    ArchivedPost(feed=feed, **{FIELDS[key]: x[key] for key in FIELDS}) for x in batch
+                )
+                Post.objects.filter(id__in=[x['id'] for x in batch]).delete()
+                Item.objects.filter(id__in={x['item_id'] for x in batch}, post=None).delete()
+            moved += len(batch)
@@ -0,0 +1,30 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from feeds.links import merge_links, url_key
+from feeds.models import Link
+
+
+class Command(BaseCommand):
+    help = "Merges links that point at the same feed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report the links that would be merged.")
+
+    def handle(self, *args, **options):
+        groups = defaultdict(list)
+        for link in Link.objects.order_by('id'):
+            groups[url_key(link.url)].append(link)
+
+        merged = 0
+        for links in groups.values():
+            # https wins over http, then the oldest link
+            links.sort(key=lambda x: (not x.url.lower().startswith('https://'), x.pk))
+            link, duplicates = links[0], links[1:]
+            if duplicates:
+                self.stdout.write("{}: {}".format(link.url, ", ".join(x.url for x in duplicates)))
+            merged += len(duplicates)
+            if not options['dry_run']:
+                merge_links(link, duplicates)
+        self.stdout.write("{} {} links".format("Found" if options['dry_run'] else "Merged", merged))
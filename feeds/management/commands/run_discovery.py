@@ -0,0 +1,46 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from feeds import discovery
+
+
+class Command(BaseCommand):
+    help = "Runs the pending discovery jobs, each fetch bounded by FEEDS_DISCOVERY_TIMEOUT."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit once no job is pending.")
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--interval', type=float, default=1, help="Seconds to sleep while no job is pending.")
+
+    def handle(self, *args, **options):
+        self.ran = 0
+        self.lock = threading.Lock()
+        if options['workers'] <= 1:
+            self.work(options['once'], options['interval'])
+        else:
+            threads = [threading.Thread(target=self.run_worker, args=(options['once'], options['interval']))
+                       for _ in range(options['workers'])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.stdout.write("Ran {} discovery jobs".format(self.ran))
+
+    def run_worker(self, once, interval):
+        try:
+            self.work(once, interval)
+        finally:
+            connection.close()
+
+    def work(self, once, interval):
+        while True:
+            ran = discovery.run_pending()
+            with self.lock:
+                self.ran += ran
+            if once:
+                return
+            if not ran:
+                time.sleep(interval)
@@ -0,0 +1,92 @@
+import os
+import socket
+import time
+from functools import wraps
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+from django.conf.urls import RegexURLResolver
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+if prometheus_client:
+    FETCH_SECONDS = prometheus_client.Histogram(
+        'feeds_fetch_seconds', "Time spent downloading a feed.", ['host'])
+    FETCH_RESPONSES = prometheus_client.Counter(
+        'feeds_fetch_responses_total', "Feed downloads by host and status code.", ['host', 'status'])
+    FETCH_BYTES = prometheus_client.Counter(
+        'feeds_fetch_bytes_total', "Bytes of feeds downloaded.", ['host'])
+    PARSE_SECONDS = prometheus_client.Histogram(
+        'feeds_parse_seconds', "Time spent parsing a downloaded feed.")
+    LOOP_POSTS = prometheus_client.Counter(
+        'feeds_loop_posts_total', "Posts changed by the refresh loop and pushes.", ['action'])
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'feeds_request_seconds', "Latency of the feeds API by route.", ['route', 'method'])
+
+
+def get_status(error=None, response=None):
+    if isinstance(error, HTTPError):
+        return str(error.code)
+    if isinstance(error, socket.timeout) or isinstance(getattr(error, 'reason', None), socket.timeout):
+        return 'timeout'
+    if error is not None:
+        return 'error'
+    return str(getattr(response, 'status', None) or 'ok')
+
+
+def observe_fetch(url, seconds, status, size):
+    if prometheus_client:
+        host = urlsplit(url).hostname or ''
+        FETCH_SECONDS.labels(host).observe(seconds)
+        FETCH_RESPONSES.labels(host, status).inc()
+        FETCH_BYTES.labels(host).inc(size)
+
+
+def observe_parse(seconds):
+    if prometheus_client:
+        PARSE_SECONDS.observe(seconds)
+
+
+def count_posts(added=0, updated=0, deleted=0):
+    if prometheus_client:
+        for action, count in (('added', added), ('updated', updated), ('deleted', deleted)):
+            LOOP_POSTS.labels(action).inc(count)
+
+
+def timed(view, route):
+    @wraps(view)
+    def timed_view(request, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            REQUEST_SECONDS.labels(route, request.method).observe(time.monotonic() - started)
+    return timed_view
+
+
+def instrument(patterns):
+    # times every view of the url patterns, labelled with the url name
+    if prometheus_client:
+        for pattern in patterns:
+            if isinstance(pattern, RegexURLResolver):
+                instrument(pattern.url_patterns)
+            else:
+                pattern.callback = timed(pattern.callback, pattern.name or pattern.regex.pattern)
+    return patterns
+
+
+def is_multiprocess():
+    return bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir'))
+
+
+def render():
+    if is_multiprocess():
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry)
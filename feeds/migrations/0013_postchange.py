@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_changes(apps, schema_editor):
+    Post = apps.get_model('feeds', 'Post')
+    PostChange = apps.get_model('feeds', 'PostChange')
+    PostChange.objects.bulk_create(
+        PostChange(user_id=user_id, post=post_id)
+        for post_id, user_id in Post.objects.order_by('id').values_list('id', 'feed__user_id').iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('feeds', '0012_userversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('post', models.IntegerField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='postchange',
+            index_together=set([('user', 'id')]),
+        ),
+        migrations.RunPython(backfill_changes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("CREATE VIRTUAL TABLE feeds_post_fts USING fts5(title)")
+        schema_editor.execute("INSERT INTO feeds_post_fts(rowid, title) SELECT id, title FROM feeds_post")
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX feeds_post_title_search ON feeds_post USING gin (to_tsvector('simple', title))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE feeds_post_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX feeds_post_title_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0013_postchange'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0014_post_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPost',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('title', models.CharField(max_length=255)),
+                ('url', models.CharField(max_length=511)),
+                ('post_date', models.DateTimeField()),
+                ('add_date', models.DateTimeField()),
+                ('view', models.BooleanField()),
+                ('seen', models.BooleanField(default=True)),
+                ('mentioned', models.BooleanField(default=False)),
+                ('feed', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='feeds.Feed')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedpost',
+            index=models.Index(fields=['feed', 'add_date'], name='feeds_archive_feed_add_date'),
+        ),
+    ]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_items(apps, schema_editor):
+    # Posts with the same link, url, title and date share one item. The link is only known
+    # for feeds with a single link; the rest are re-attached by the next refresh loop.
+    FeedLink = apps.get_model('feeds', 'FeedLink')
+    Item = apps.get_model('feeds', 'Item')
+    Post = apps.get_model('feeds', 'Post')
+
+    links = {}
+    for feed_id, link_id in FeedLink.objects.values_list('feed_id', 'link_id'):
+        links.setdefault(feed_id, []).append(link_id)
+
+    groups = {}
+    for id_, feed_id, title, url, post_date in Post.objects.order_by('id').values_list(
+            'id', 'feed_id', 'title', 'url', 'post_date').iterator():
+        feed_links = links.get(feed_id, [])
+        link_id = feed_links[0] if len(feed_links) == 1 else None
+        groups.setdefault((link_id, title, url, post_date), []).append(id_)
+
+    for (link_id, title, url, post_date), ids in groups.items():
+        item = Item.objects.create(link_id=link_id, title=title, url=url, post_date=post_date)
+        for start in range(0, len(ids), 500):
+            Post.objects.filter(id__in=ids[start:start + 500]).update(item=item)
+
+
+def copy_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE feeds_post_fts")
+        schema_editor.execute("CREATE VIRTUAL TABLE feeds_item_fts USING fts5(title)")
+        schema_editor.execute("INSERT INTO feeds_item_fts(rowid, title) SELECT id, title FROM feeds_item")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX feeds_post_title_search")
+        schema_editor.execute(
+            "CREATE INDEX feeds_item_title_search ON feeds_item USING gin (to_tsvector('simple', title))"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0015_archivedpost'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Item',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=255)),
+                ('url', models.CharField(max_length=511)),
+                ('post_date', models.DateTimeField()),
+                ('link', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='feeds.Link')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['link', 'url'], name='feeds_item_link_url'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['link', 'title'], name='feeds_item_link_title'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='item',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='feeds.Item'),
+        ),
+        migrations.RunPython(backfill_items, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='post',
+            name='post_date',
+        ),
+        migrations.RemoveField(
+            model_name='post',
+            name='title',
+        ),
+        migrations.RemoveField(
+            model_name='post',
+            name='url',
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='feeds.Item'),
+        ),
+        migrations.RunPython(copy_search_index, migrations.RunPython.noop),
+    ]
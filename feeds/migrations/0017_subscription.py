@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0016_item'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Subscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hub', models.CharField(max_length=511)),
+                ('topic', models.CharField(max_length=511)),
+                ('secret', models.CharField(max_length=40)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('link', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='subscription', to='feeds.Link')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0018_discoveryjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeferredLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deferred', models.DateTimeField(auto_now_add=True)),
+                ('link', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='deferral', to='feeds.Link')),
+            ],
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0019_deferredlink'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoopRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField()),
+                ('duration', models.FloatField()),
+                ('prune_time', models.FloatField(default=0)),
+                ('added', models.IntegerField(default=0)),
+                ('updated', models.IntegerField(default=0)),
+                ('deleted', models.IntegerField(default=0)),
+                ('deferred', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LoopRunLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=511)),
+                ('duration', models.FloatField(default=0)),
+                ('fetch_time', models.FloatField(default=0)),
+                ('parse_time', models.FloatField(default=0)),
+                ('reconcile_time', models.FloatField(default=0)),
+                ('size', models.IntegerField(default=0)),
+                ('items', models.IntegerField(default=0)),
+                ('feed_links', models.IntegerField(default=0)),
+                ('queries', models.IntegerField(default=0)),
+                ('error', models.CharField(blank=True, default='', max_length=255)),
+                ('link', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='feeds.Link')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='links', to='feeds.LoopRun')),
+            ],
+        ),
+    ]
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# a copy of feeds.links.url_key as it was when this migration was written, so that later changes to the app's
+# normalization do not change how old databases migrate
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+TRACKING_PARAMS = {'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'yclid'}
+
+
+def normalize_url(url):
+    url = url.strip()
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port
+    except ValueError:
+        return url
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return url
+
+    netloc = parts.hostname.lower()
+    if port and port != DEFAULT_PORTS[scheme]:
+        netloc = "{}:{}".format(netloc, port)
+    if parts.username:
+        userinfo = parts.username if parts.password is None else "{}:{}".format(parts.username, parts.password)
+        netloc = "{}@{}".format(userinfo, netloc)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if not key.lower().startswith('utm_') and key.lower() not in TRACKING_PARAMS]
+    return urlunsplit((scheme, netloc, parts.path.rstrip('/'), urlencode(query), ''))
+
+
+def url_key(url):
+    url = normalize_url(url)
+    scheme, _, rest = url.partition('://')
+    return rest if scheme in DEFAULT_PORTS else url
+
+
+def fill_keys(apps, schema_editor):
+    Link = apps.get_model('feeds', 'Link')
+    LinkKey = apps.get_model('feeds', 'LinkKey')
+    LinkKey.objects.bulk_create(
+        LinkKey(link_id=pk, key=url_key(url)) for pk, url in Link.objects.values_list('id', 'url')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0022_linkrefresh'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, max_length=511)),
+                ('link', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='key', to='feeds.Link')),
+            ],
+        ),
+        migrations.RunPython(fill_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils.crypto import get_random_string
+
+import feeds.models
+
+
+def fill_tokens(apps, schema_editor):
+    Subscription = apps.get_model('feeds', 'Subscription')
+    for pk in Subscription.objects.values_list('id', flat=True):
+        Subscription.objects.filter(pk=pk).update(token=get_random_string(40))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0023_linkkey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='token',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.RunPython(fill_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='subscription',
+            name='token',
+            field=models.CharField(default=feeds.models.new_token, max_length=40, unique=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='pending',
+            field=models.CharField(blank=True, default='', max_length=11),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='pending_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+    ]
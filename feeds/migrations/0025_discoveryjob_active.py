@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0024_subscription_intent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discoveryjob',
+            name='active',
+            field=models.CharField(blank=True, max_length=40, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_users(apps, schema_editor):
+    Feed = apps.get_model('feeds', 'Feed')
+    Post = apps.get_model('feeds', 'Post')
+    for feed_id, user_id in Feed.objects.values_list('id', 'user_id'):
+        Post.objects.filter(feed_id=feed_id).update(user_id=user_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('feeds', '0025_discoveryjob_active'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(fill_users, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='post',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['user', 'add_date', 'id'], name='feeds_post_user_add_date_id'),
+        ),
+    ]
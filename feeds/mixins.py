@@ -0,0 +1,76 @@
+from calendar import timegm
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from feeds import cache
+from feeds.serializers import values_representation
+from feeds.versions import bump_versions, get_version
+
+
+class ConditionalMixin:
+    # Validators come from the user's change version, so a 304 is answered
+    # before any of the view's queries or serializers run (but the object lookup of detail routes).
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        # the validators are per user, not per object, so the object is looked up first: a missing post or one of
+        # another user is a 404 whatever If-None-Match says
+        self.object = self.get_object()
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
+
+    def get_object(self):
+        return getattr(self, 'object', None) or super().get_object()
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+
+        version = self.user_version = get_version(request.user)
+        etag = quote_etag("{}-{}".format(version.version, request.accepted_renderer.format))
+        last_modified = timegm(version.modified.utctimetuple()) if version.modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if (request.method not in SAFE_METHODS and request.user.is_authenticated
+                and 200 <= response.status_code < 300):
+            bump_versions([request.user.pk])
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class CachedListMixin:
+
+    def list(self, request, *args, **kwargs):
+        version = getattr(self, 'user_version', None) or get_version(request.user)
+        data = cache.get_or_set(
+            self.basename, version, lambda: list(super(CachedListMixin, self).list(request, *args, **kwargs).data),
+            extra=request.get_full_path()
+        )
+        return Response(data)
+
+
+class ValuesListMixin:
+    # Plain JSON and MessagePack list responses skip the serializer fields and are built from .values_list() rows.
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format not in ('json', 'msgpack') or 'indent' in (request.accepted_media_type or ''):
+            return super().list(request, *args, **kwargs)
+        data = values_representation(self.get_serializer_class(), self.filter_queryset(self.get_queryset()))
+        if data is None:
+            return super().list(request, *args, **kwargs)
+        page = self.paginate_queryset(data)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(data)
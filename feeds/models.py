@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.utils.crypto import get_random_string
 
 
 class Feed(models.Model):
@@ -20,6 +23,55 @@ class Link(models.Model):
         return self.url
 
 
+class LinkKey(models.Model):
+    # the normalized url links are deduplicated by, the link's url itself is fetched as entered
+    link = models.OneToOneField(Link, related_name="key")
+    key = models.CharField(max_length=511, db_index=True)
+
+    def __str__(self):
+        return self.key
+
+
+def new_token():
+    return get_random_string(40)
+
+
+class Subscription(models.Model):
+    link = models.OneToOneField(Link, related_name="subscription")
+    hub = models.CharField(max_length=511)
+    topic = models.CharField(max_length=511)
+    secret = models.CharField(max_length=40)
+    lease_expires = models.DateTimeField(blank=True, null=True)
+    # identifies the subscription in the callback url
+    token = models.CharField(max_length=40, unique=True, default=new_token)
+    # the mode of the last request sent to the hub, verifiable until `pending_until`; no new request is sent before
+    # then, and every unverified attempt doubles the wait
+    pending = models.CharField(max_length=11, blank=True, default="")
+    pending_until = models.DateTimeField(blank=True, null=True)
+    attempts = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "{} via {}".format(self.topic, self.hub)
+
+
+class DeferredLink(models.Model):
+    link = models.OneToOneField(Link, related_name="deferral")
+    deferred = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{} deferred at {}".format(self.link, self.deferred)
+
+
+class LinkRefresh(models.Model):
+    # on-demand refreshes of a link: `started` is held while one request fetches it
+    link = models.OneToOneField(Link, related_name="refresh")
+    fetched = models.DateTimeField(blank=True, null=True)
+    started = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return "{} refreshed at {}".format(self.link, self.fetched)
+
+
 class FeedLink(models.Model):
     link = models.ForeignKey(Link)
     feed = models.ForeignKey(Feed, related_name="links")
@@ -33,7 +85,52 @@ class FeedLink(models.Model):
         return "{}'s {}".format(self.feed, self.link.url)
 
 
+class Item(models.Model):
+    link = models.ForeignKey(Link, null=True, blank=True, on_delete=models.SET_NULL)
+    title = models.CharField(max_length=255)
+    url = models.CharField(max_length=511)
+    post_date = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['link', 'url'], name='feeds_item_link_url'),
+            models.Index(fields=['link', 'title'], name='feeds_item_link_title'),
+        ]
+
+    def __str__(self):
+        return self.title
+
+
 class Post(models.Model):
+    feed = models.ForeignKey(Feed)
+    # a copy of feed.user, so that a user's timeline is one scan of the (user, add_date, id) index
+    user = models.ForeignKey(User)
+    item = models.ForeignKey(Item)
+    add_date = models.DateTimeField()
+    view = models.BooleanField()
+    seen = models.BooleanField(default=True)
+    mentioned = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['feed', 'add_date'], name='feeds_post_feed_add_date'),
+            # the admin orders, filters and browses posts by date across all feeds
+            models.Index(fields=['add_date'], name='feeds_post_add_date'),
+            models.Index(fields=['view', 'add_date'], name='feeds_post_view_add_date'),
+            models.Index(fields=['user', 'add_date', 'id'], name='feeds_post_user_add_date_id'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.user_id is None:
+            self.user_id = Feed.objects.values_list('user_id', flat=True).get(pk=self.feed_id)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return str(self.feed) + " " + self.item.title
+
+
+class ArchivedPost(models.Model):
+    id = models.IntegerField(primary_key=True)
     feed = models.ForeignKey(Feed)
     title = models.CharField(max_length=255)
     url = models.CharField(max_length=511)
@@ -43,5 +140,92 @@ class Post(models.Model):
     seen = models.BooleanField(default=True)
     mentioned = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['feed', 'add_date'], name='feeds_archive_feed_add_date'),
+        ]
+
     def __str__(self):
         return str(self.feed) + " " + self.title
+
+
+class UserVersion(models.Model):
+    user = models.OneToOneField(User, related_name="feeds_version")
+    version = models.IntegerField(default=0)
+    modified = models.DateTimeField()
+
+    def __str__(self):
+        return "{}'s version {}".format(self.user.username, self.version)
+
+
+class PostChange(models.Model):
+    user = models.ForeignKey(User)
+    post = models.IntegerField()
+
+    class Meta:
+        index_together = (('user', 'id'),)
+
+    def __str__(self):
+        return "{}'s change of post {}".format(self.user.username, self.post)
+
+
+class DiscoveryJob(models.Model):
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    SCAN, EXTRACT = 'scan', 'extract'
+
+    kind = models.CharField(max_length=10, choices=((SCAN, SCAN), (EXTRACT, EXTRACT)))
+    url = models.CharField(max_length=2047)
+    status = models.CharField(max_length=10, default=PENDING, choices=(
+        (PENDING, PENDING), (RUNNING, RUNNING), (DONE, DONE), (FAILED, FAILED)
+    ))
+    result = models.TextField(blank=True, default="")
+    error = models.CharField(max_length=255, blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    active = models.CharField(max_length=40, blank=True, null=True, unique=True)
+
+    class Meta:
+        index_together = (('kind', 'url'), ('status', 'id'))
+
+    def __str__(self):
+        return "{} {} ({})".format(self.kind, self.url, self.status)
+
+
+class LoopRun(models.Model):
+    started = models.DateTimeField()
+    duration = models.FloatField()
+    prune_time = models.FloatField(default=0)
+    added = models.IntegerField(default=0)
+    updated = models.IntegerField(default=0)
+    deleted = models.IntegerField(default=0)
+    deferred = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "Loop run at {}".format(self.started)
+
+
+class LoopRunLink(models.Model):
+    run = models.ForeignKey(LoopRun, related_name="links")
+    link = models.ForeignKey(Link, null=True, blank=True, on_delete=models.SET_NULL)
+    url = models.CharField(max_length=511)
+    duration = models.FloatField(default=0)
+    fetch_time = models.FloatField(default=0)
+    parse_time = models.FloatField(default=0)
+    reconcile_time = models.FloatField(default=0)
+    size = models.IntegerField(default=0)
+    items = models.IntegerField(default=0)
+    feed_links = models.IntegerField(default=0)
+    queries = models.IntegerField(default=0)
+    error = models.CharField(max_length=255, blank=True, default="")
+
+    def __str__(self):
+        return "{} in {}".format(self.url, self.run)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def record_post_change(sender, instance, **kwargs):
+    user_id = Feed.objects.filter(pk=instance.feed_id).values_list('user_id', flat=True).first()
+    if user_id is not None:
+        PostChange.objects.create(user_id=user_id, post=instance.pk)
@@ -0,0 +1,100 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Max
+
+from feeds.models import Post, PostChange
+
+_condition = threading.Condition()
+# The change log is polled by one waiter of the process at a time; `latest` holds the newest change id of every user
+# it found changes for, `notified` counts the notify() calls of this process.
+_state = {"last": None, "polled": 0.0, "polling": False, "notified": 0}
+_latest = {}
+
+
+def notify():
+    with _condition:
+        _state["notified"] += 1
+        _condition.notify_all()
+
+
+def pending_changes(user, since, limit=500):
+    changes = list(PostChange.objects.filter(user=user, id__gt=since).order_by('id').values_list('id', 'post')[:limit])
+    posts = Post.objects.filter(id__in={post for _, post in changes}).values_list('id', 'feed_id')
+    return {
+        "cursor": changes[-1][0] if changes else since,
+        "posts": sorted(x for x, _ in posts),
+        "feeds": sorted({x for _, x in posts}),
+    }
+
+
+def latest_changes(after):
+    return list(PostChange.objects.filter(id__gt=after).values_list('user').annotate(last=Max('id')).order_by())
+
+
+def get_start(since):
+    # the first poll of the process starts at the client's cursor, capped at the newest change so that a cursor from
+    # the future cannot skip the changes still to come
+    newest = PostChange.objects.aggregate(last=Max('id'))['last'] or 0
+    return min(since, newest)
+
+
+def poll(since):
+    rows = []
+    start = _state["last"]
+    try:
+        if start is None:
+            start = get_start(since)
+        rows = latest_changes(start)
+    finally:
+        with _condition:
+            # the cursor only moves to changes that were read
+            if _state["last"] is None and start is not None:
+                _state["last"] = start
+            for user_id, last in rows:
+                _latest[user_id] = max(last, _latest.get(user_id, 0))
+                _state["last"] = max(last, _state["last"])
+            _state["polled"] = time.monotonic()
+            _state["polling"] = False
+            _condition.notify_all()
+
+
+def get_mark(user_id):
+    return _latest.get(user_id), _state["notified"]
+
+
+def wait_for_mark(user_id, mark, deadline, interval):
+    # True once the user's changes or a notify() moved past `mark`, False at the deadline and None when it is this
+    # waiter's turn to poll the change log
+    with _condition:
+        while get_mark(user_id) == mark:
+            current = time.monotonic()
+            if current >= deadline:
+                return False
+            due = _state["polled"] + interval
+            if not _state["polling"] and current >= due:
+                _state["polling"] = True
+                return None
+            _condition.wait((deadline if _state["polling"] else min(deadline, due)) - current)
+        return True
+
+
+def wait_for_changes(user, since, timeout):
+    # Waiters in this process are woken by notify(). Changes made by other processes are found by a poll of the
+    # change log that runs once per FEEDS_POLL_INTERVAL for the whole process, whatever the number of waiters; only
+    # the waiters of the users it found changes for query their changes again.
+    deadline = time.monotonic() + timeout
+    interval = getattr(settings, 'FEEDS_POLL_INTERVAL', 1)
+    mark = get_mark(user.pk)
+    changes = pending_changes(user, since)
+    while changes["cursor"] == since:
+        woken = wait_for_mark(user.pk, mark, deadline, interval)
+        if woken is None:
+            poll(since)
+        elif woken:
+            mark = get_mark(user.pk)
+            changes = pending_changes(user, since)
+        else:
+            break
+    return changes
@@ -1,4 +1,4 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 from rest_framework.response import Response
 
 
@@ -12,3 +12,19 @@ class CountPagination(PageNumberPagination):
             'count': len(data),
             'results': data
         })
+
+
+class TimelinePagination(CursorPagination):
+    # the timeline filters on Post.user, a copy of the feed's user, so a page is one scan of the (user, add_date, id)
+    # index
+    ordering = ('-add_date', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class LoopRunPagination(CursorPagination):
+    ordering = '-id'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
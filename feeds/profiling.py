@@ -0,0 +1,145 @@
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.utils.timezone import now
+
+from feeds.instrumentation import count_queries
+
+PROFILE_ID = re.compile(r'^[\w-]+$')
+
+active = threading.local()
+
+
+def get_directory():
+    return getattr(settings, 'FEEDS_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'feeds-profiles'))
+
+
+def should_profile(request=None):
+    # a request carrying FEEDS_PROFILE_SECRET in the X-Feeds-Profile header is always profiled,
+    # everything else is sampled at FEEDS_PROFILE_RATE (0 to 1, off by default)
+    secret = getattr(settings, 'FEEDS_PROFILE_SECRET', None)
+    if secret and request is not None:
+        header = request.META.get('HTTP_X_FEEDS_PROFILE', '')
+        if hmac.compare_digest(header.encode(), secret.encode()):
+            return True
+    rate = getattr(settings, 'FEEDS_PROFILE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+@contextmanager
+def profile(name, request=None):
+    # only the outermost profiled call records, the profiler of a thread cannot be nested
+    if getattr(active, 'name', None) or not should_profile(request):
+        yield
+        return
+    active.name = name
+    profiler = cProfile.Profile()
+    started = time.monotonic()
+    try:
+        with count_queries(capture=True) as queries:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+    finally:
+        active.name = None
+        save(name, profiler, time.monotonic() - started, queries.queries)
+
+
+def profiled(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ProfiledMixin:
+
+    def dispatch(self, request, *args, **kwargs):
+        with profile("{}.{}".format(type(self).__name__, request.method.lower()), request):
+            response = super().dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+            return response
+
+
+def save(name, profiler, duration, queries):
+    directory = get_directory()
+    os.makedirs(directory, exist_ok=True)
+    created = now()
+    pk = "{:%Y%m%dT%H%M%S%f}-{}-{}".format(created, re.sub(r'[^\w]+', '-', name), os.getpid())
+    info = {"id": pk, "name": name, "created": created.isoformat(), "duration": duration}
+    profiler.dump_stats(os.path.join(directory, pk + '.prof'))
+    with open(os.path.join(directory, pk + '.json'), 'w') as f:
+        json.dump(dict(info, queries=[{"sql": x["sql"], "time": x["time"]} for x in queries]), f)
+    # the listing reads this summary only, it is written last so that only complete profiles are listed
+    with open(os.path.join(directory, pk + '.meta'), 'w') as f:
+        json.dump(dict(info, queries=len(queries)), f)
+    prune(directory)
+    return pk
+
+
+def prune(directory):
+    # only the latest FEEDS_PROFILE_KEEP profiles are kept, ids start with their creation time
+    keep = getattr(settings, 'FEEDS_PROFILE_KEEP', 100)
+    pks = sorted({x.split('.')[0] for x in os.listdir(directory) if PROFILE_ID.match(x.split('.')[0])}, reverse=True)
+    for pk in pks[keep:]:
+        for extension in ('.meta', '.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, pk + extension))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles():
+    directory = get_directory()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in sorted(os.listdir(directory), reverse=True):
+        if filename.endswith('.meta') and PROFILE_ID.match(filename[:-len('.meta')]):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return profiles
+
+
+def get_profile(pk):
+    if not PROFILE_ID.match(pk):
+        return None
+    try:
+        with open(os.path.join(get_directory(), pk + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def get_profile_path(pk):
+    if get_profile(pk) is None:
+        return None
+    return os.path.join(get_directory(), pk + '.prof')
+
+
+def get_stats(pk, sort='cumulative', limit=30):
+    output = io.StringIO()
+    stats = pstats.Stats(get_profile_path(pk), stream=output)
+    stats.sort_stats(sort).print_stats(limit)
+    return output.getvalue()
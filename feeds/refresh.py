@@ -0,0 +1,142 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max, Q
+from django.utils.timezone import now
+
+from feed_reader.transports import get_transport, use_transport
+from feeds.models import LinkRefresh, LoopRunLink
+
+# links fetched by a request of this process, waited for by the other requests for the same link
+in_flight = {}
+lock = threading.Lock()
+
+
+class Flight(threading.Event):
+    # set when the fetch of this process is over, or at once when another process turned out to fetch the link
+    elsewhere = False
+    refreshed = False
+
+
+def get_threshold():
+    return timedelta(seconds=getattr(settings, 'FEEDS_REFRESH_AFTER', 5 * 60))
+
+
+def get_budget():
+    return getattr(settings, 'FEEDS_REFRESH_BUDGET', 2)
+
+
+def get_fetched(links):
+    # the last time each link was fetched, by the loop or on demand
+    fetched = dict(LinkRefresh.objects.filter(link__in=links, fetched__isnull=False).values_list('link', 'fetched'))
+    looped = LoopRunLink.objects.filter(link__in=links, error="").values('link').annotate(
+        started=Max('run__started')).values_list('link', 'started')
+    for link_id, started in looped:
+        fetched[link_id] = max(started, fetched.get(link_id, started))
+    return fetched
+
+
+def get_stale(links):
+    fetched = get_fetched(links)
+    oldest = now() - get_threshold()
+    return [x for x in links if fetched.get(x.pk) is None or fetched[x.pk] < oldest]
+
+
+def claim(link):
+    # across processes a link is fetched by the request that set `started`; a claim older than two fetch
+    # timeouts belongs to a request that died and is taken over
+    LinkRefresh.objects.get_or_create(link=link)
+    expired = now() - timedelta(seconds=2 * getattr(settings, 'FEEDS_FETCH_TIMEOUT', 30))
+    return bool(LinkRefresh.objects.filter(link=link).filter(
+        Q(started__isnull=True) | Q(started__lt=expired)
+    ).update(started=now()))
+
+
+def release(link, fetched=True):
+    # failed fetches count as fetched too, so a broken feed is not retried by every request
+    update = {"started": None}
+    if fetched:
+        update["fetched"] = now()
+    LinkRefresh.objects.filter(link=link).update(**update)
+
+
+def start_fetch(link, fetch, timeout, flight):
+    # The fetch runs in a thread of its own, so that a request waits for it no longer than its budget. The claim is
+    # released when the fetch is over, whether the request still waits or not.
+    transport = get_transport()
+
+    def run():
+        try:
+            with use_transport(transport):
+                flight.refreshed = bool(fetch(link, timeout))
+        finally:
+            try:
+                release(link)
+            finally:
+                connection.close()
+                with lock:
+                    del in_flight[link.pk]
+                flight.set()
+    threading.Thread(target=run, daemon=True).start()
+
+
+def refresh_links(links, fetch, budget=None):
+    # Fetches the stale links through fetch(link, timeout), single-flight per link, and returns once they are
+    # refreshed or the budget (FEEDS_REFRESH_BUDGET seconds) is spent; unfinished links are reported as pending.
+    deadline = time.monotonic() + (get_budget() if budget is None else budget)
+    stale = get_stale(links)
+    refreshed, waiting, pending = [], [], []
+    for link in stale:
+        with lock:
+            flight = in_flight.get(link.pk)
+            leader = flight is None
+            if leader:
+                flight = in_flight[link.pk] = Flight()
+        if not leader:
+            waiting.append((link, flight, False))
+            continue
+        remaining = deadline - time.monotonic()
+        # the claim is made outside the lock, the flight already makes the other requests of this process wait
+        if not claim(link):
+            flight.elsewhere = True
+        elif remaining <= 0:
+            release(link, fetched=False)
+        else:
+            start_fetch(link, fetch, min(remaining, getattr(settings, 'FEEDS_FETCH_TIMEOUT', 30)), flight)
+            waiting.append((link, flight, True))
+            continue
+        with lock:
+            del in_flight[link.pk]
+        flight.set()
+        if flight.elsewhere:
+            waiting.append((link, None, False))
+        else:
+            pending.append(link)
+
+    for link, flight, fetching in waiting:
+        remaining = max(deadline - time.monotonic(), 0)
+        if flight is None or (flight.wait(remaining) and flight.elsewhere):
+            done = wait_for_release(link, deadline - time.monotonic())
+        else:
+            done = flight.wait(0)
+        if not done:
+            pending.append(link)
+        elif fetching and flight.refreshed:
+            refreshed.append(link)
+    return {"stale": [x.url for x in stale], "refreshed": [x.url for x in refreshed],
+            "pending": [x.url for x in pending]}
+
+
+def wait_for_release(link, timeout):
+    # the link is fetched by another process
+    deadline = time.monotonic() + timeout
+    interval = getattr(settings, 'FEEDS_POLL_INTERVAL', 1)
+    while LinkRefresh.objects.filter(link=link, started__isnull=False).exists():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+    return True
@@ -0,0 +1,95 @@
+import re
+
+from django.db import connection
+
+from feeds.models import Post
+
+TOKENS = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchBackend:
+    # Unindexed fallback for databases without a full-text backend: every term must appear in the title.
+
+    def index(self, item):
+        pass
+
+    def remove(self, item_id):
+        pass
+
+    def search(self, user, query, after=None, limit=50):
+        posts = Post.objects.filter(feed__user=user)
+        for term in TOKENS.findall(query):
+            posts = posts.filter(item__title__icontains=term)
+        if after is not None:
+            posts = posts.filter(id__gt=after[1])
+        return [(x, 0.0) for x in posts.order_by('id').values_list('id', flat=True)[:limit]]
+
+
+class SQLiteSearchBackend(SearchBackend):
+    # Item titles are mirrored into the feeds_item_fts FTS5 table, keyed by item id and ranked by bm25.
+
+    def index(self, item):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO feeds_item_fts(rowid, title) VALUES (%s, %s)", [item.pk, item.title])
+
+    def remove(self, item_id):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM feeds_item_fts WHERE rowid = %s", [item_id])
+
+    def search(self, user, query, after=None, limit=50):
+        terms = " ".join('"{}"'.format(x) for x in TOKENS.findall(query))
+        if not terms:
+            return []
+        sql = ("SELECT p.id, bm25(feeds_item_fts) FROM feeds_item_fts "
+               "JOIN feeds_post p ON p.item_id = feeds_item_fts.rowid JOIN feeds_feed f ON f.id = p.feed_id "
+               "WHERE feeds_item_fts MATCH %s AND f.user_id = %s")
+        params = [terms, user.pk]
+        if after is not None:
+            sql += " AND (bm25(feeds_item_fts) > %s OR (bm25(feeds_item_fts) = %s AND p.id > %s))"
+            params += [after[0], after[0], after[1]]
+        sql += " ORDER BY 2, 1 LIMIT %s"
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [limit])
+            return cursor.fetchall()
+
+
+class PostgresSearchBackend(SearchBackend):
+    # Served by the GIN index on to_tsvector('simple', feeds_item.title), which Postgres keeps in sync by itself.
+    # Scores are negated ts_rank values so that, like bm25, lower is better.
+
+    score = "-ts_rank(to_tsvector('simple', i.title), plainto_tsquery('simple', %s))"
+
+    def search(self, user, query, after=None, limit=50):
+        query = " ".join(TOKENS.findall(query))
+        if not query:
+            return []
+        sql = ("SELECT p.id, {} FROM feeds_item i JOIN feeds_post p ON p.item_id = i.id "
+               "JOIN feeds_feed f ON f.id = p.feed_id "
+               "WHERE to_tsvector('simple', i.title) @@ plainto_tsquery('simple', %s) AND f.user_id = %s"
+               ).format(self.score)
+        params = [query, query, user.pk]
+        if after is not None:
+            sql += " AND ({0} > %s OR ({0} = %s AND p.id > %s))".format(self.score)
+            params += [query, after[0], query, after[0], after[1]]
+        sql += " ORDER BY 2, 1 LIMIT %s"
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [limit])
+            return cursor.fetchall()
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_backend():
+    return BACKENDS.get(connection.vendor, SearchBackend)()
+
+
+def index_item(sender, instance, **kwargs):
+    get_backend().index(instance)
+
+
+def remove_item(sender, instance, **kwargs):
+    get_backend().remove(instance.pk)
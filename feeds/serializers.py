@@ -1,8 +1,12 @@
+import json
+
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.encoding import smart_text
-from rest_framework import serializers
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
 
-from feeds.models import Feed, Post, Link, FeedLink
+from feeds.links import get_link
+from feeds.models import ArchivedPost, DiscoveryJob, Feed, LoopRun, LoopRunLink, Post, Link, FeedLink
 
 
 class CreatableSlugRelatedField(serializers.SlugRelatedField):
@@ -15,9 +19,18 @@ class CreatableSlugRelatedField(serializers.SlugRelatedField):
             self.fail('invalid')
 
 
+class LinkField(CreatableSlugRelatedField):
+    def to_internal_value(self, data):
+        if isinstance(data, Link):
+            return data
+        if not isinstance(data, str):
+            self.fail('invalid')
+        return get_link(data)
+
+
 class FeedLinkSerializer(serializers.ModelSerializer):
 
-    link = CreatableSlugRelatedField(queryset=Link.objects, slug_field="url")
+    link = LinkField(queryset=Link.objects, slug_field="url")
 
     class Meta:
         model = FeedLink
@@ -31,16 +44,64 @@ class LinkSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def create(self, validated_data):
-        item, _ = Link.objects.get_or_create(**validated_data)
-        return item
+        return get_link(validated_data['url'])
 
 
 class PostSerializer(serializers.ModelSerializer):
+    title = serializers.CharField(source='item.title', read_only=True)
+    url = serializers.CharField(source='item.url', read_only=True)
+    post_date = serializers.DateTimeField(source='item.post_date', read_only=True)
 
     class Meta:
         model = Post
+        fields = ('id', 'title', 'url', 'post_date', 'add_date', 'view', 'seen', 'mentioned', 'feed')
+
+
+class ArchivedPostSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ArchivedPost
         fields = '__all__'
 
+
+class TimelinePostSerializer(PostSerializer):
+    feed_name = serializers.CharField(source='feed.name', read_only=True)
+
+    class Meta(PostSerializer.Meta):
+        fields = PostSerializer.Meta.fields + ('feed_name',)
+
+
+class DiscoveryJobSerializer(serializers.ModelSerializer):
+    url = serializers.URLField(max_length=2047)
+    result = serializers.SerializerMethodField()
+
+    class Meta:
+        model = DiscoveryJob
+        fields = ('id', 'kind', 'url', 'status', 'result', 'error', 'created', 'finished')
+        read_only_fields = ('status', 'error', 'created', 'finished')
+
+    def get_result(self, obj):
+        return json.loads(obj.result) if obj.result else None
+
+
+class LoopRunLinkSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = LoopRunLink
+        fields = '__all__'
+
+
+class LoopRunSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = LoopRun
+        fields = '__all__'
+
+
+class LoopRunDetailSerializer(LoopRunSerializer):
+    links = LoopRunLinkSerializer(many=True, read_only=True)
+
+
 class FeedSerializer(serializers.ModelSerializer):
     links = FeedLinkSerializer(many=True, read_only=True)
     count = serializers.SerializerMethodField()
@@ -54,7 +115,7 @@ class FeedSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def create(self, validated_data):
-        position = len(Feed.objects.filter(user=validated_data['user']))
+        position = Feed.objects.filter(user=validated_data['user']).count()
         validated_data['position'] = position
         feed = super().create(validated_data)
         link_serializer = LinkSerializer(data=self.initial_data)
@@ -69,5 +130,51 @@ class FeedSerializer(serializers.ModelSerializer):
         return feed
 
     def get_count(self, obj):
+        if 'unread_counts' in self.context:
+            return self.context['unread_counts'].get(obj.pk, 0)
         return len(Post.objects.filter(feed=obj, view=False))
 
+
+VALUES_FIELDS = (serializers.IntegerField, serializers.CharField, serializers.BooleanField,
+                 serializers.PrimaryKeyRelatedField)
+
+
+def datetime_representation():
+    field = serializers.DateTimeField()
+    timezone = field.default_timezone()
+    if timezone is None or api_settings.DATETIME_FORMAT is None or api_settings.DATETIME_FORMAT.lower() != ISO_8601:
+        return field.to_representation
+
+    def to_representation(value):
+        value = value.astimezone(timezone).isoformat()
+        if value.endswith('+00:00'):
+            return value[:-6] + 'Z'
+        return value
+    return to_representation
+
+
+def values_representation(serializer_class, queryset):
+    # Same output as serializer_class(queryset, many=True).data, built from .values_list() rows.
+    # Returns None when the serializer has fields this shortcut does not reproduce.
+    fields = [(name, field) for name, field in serializer_class().fields.items() if not field.write_only]
+    converters = []
+    for name, field in fields:
+        if isinstance(field, serializers.DateTimeField) and not hasattr(field, 'format'):
+            converters.append(datetime_representation())
+        elif isinstance(field, VALUES_FIELDS) and field.source != '*':
+            converters.append(None)
+        else:
+            return None
+
+    names = [name for name, _ in fields]
+    dates = [(index, convert) for index, convert in enumerate(converters) if convert is not None]
+    rows = queryset.values_list(*[field.source.replace('.', '__') for _, field in fields])
+    data = []
+    for row in rows.iterator():
+        if dates:
+            row = list(row)
+            for index, convert in dates:
+                if row[index] is not None:
+                    row[index] = convert(row[index])
+        data.append(dict(zip(names, row)))
+    return data
@@ -1,23 +1,68 @@
-from datetime import datetime
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from io import StringIO
+from unittest import skipUnless
 from unittest.mock import patch, Mock
+from urllib.parse import parse_qsl, urlsplit
 
 from binascii import b2a_base64
+from collections import deque
+from django.contrib import admin
+from django.contrib.admin.utils import lookup_field
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 from freezegun import freeze_time
 import pytz
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
 from rest_framework import status
-from urllib.error import URLError
-
-
-from feeds.models import Feed, FeedLink, Link, Post
+from urllib.error import HTTPError, URLError
+
+
+from feeds import discovery, profiling, refresh
+from feeds.changes import compact_changes
+from feeds.instrumentation import count_queries, duplicated_queries, measure_queries
+from feeds.links import get_link, merge_links, normalize_url
+from feeds.metrics import prometheus_client
+from feeds.models import (ArchivedPost, DeferredLink, DiscoveryJob, Feed, FeedLink, Item, Link, LinkRefresh, LoopRun,
+                          Post, PostChange, Subscription)
+from feeds.notify import _latest, _state, notify, poll, wait_for_changes
+from feeds.renderers import msgpack
+from feeds.serializers import PostSerializer
 from feeds.views import get_posts
 from feed_reader.feed_reader import FeedDownloader
+from feed_reader.transports import (MemoryTransport, RecordingTransport, ReplayTransport, Response, Transport,
+                                    Urllib3Transport, UrllibTransport, get_transport, recorded_urls, use_transport)
 from feeds.fixtures import test_sites
 
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+
+def add_post(feed_id, title, date, view=False):
+    item = Item.objects.create(title=title, url="http://news/{}.html".format(title), post_date=date)
+    return Post.objects.create(feed_id=feed_id, item=item, add_date=date, view=view)
+
 
 def feed_creator(name, link, items):
     head = """
@@ -43,6 +88,28 @@ def feed_creator(name, link, items):
     return head.format(feed_items)
 
 
+# the links of the get_posts fixture
+LOOP_LINKS = ("http://test.com/rss/feed.xml", "http://test.com/rss/feed2.xml")
+
+
+def serve_feed(url, items, name="Feed1"):
+    # the loop finds the feed at `url`, every other link is unreachable
+    return use_transport(MemoryTransport({url: feed_creator(name, url, items)}))
+
+
+def run_loop():
+    # a loop over the get_posts fixture where the second link is unreachable
+    with freeze_time("2018-01-31T13:00:01"):
+        with use_transport(MemoryTransport({
+            "http://test.com/rss/feed.xml": feed_creator("Feed1", "http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]),
+            "http://test.com/rss/feed2.xml": URLError("unreachable"),
+        })):
+            return get_posts()
+
+
 def add_feed(user, name, url, position, reg_exp="", post_limit=20):
     feed = Feed.objects.create(name=name, user=user, position=position, postLimit=post_limit)
     link, _ = Link.objects.get_or_create(url=url)
@@ -96,6 +163,12 @@ class FeedTests(TestCase):
         assert queryset[0].position == 0
         # assert FeedLink.objects.filter(link__url="http://test.url/rss.xml", feed__user=self.user).exists()
 
+    def test_delete_feed_keeps_other_users(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.delete(reverse("feeds-detail", args=(1,)), format='json')
+        assert len([x for x in queries if x['sql'].startswith('UPDATE "feeds_feed"')]) == 1
+        assert Feed.objects.get(pk=5).position == 1
+
     def test_reorder_feeds(self):
         result = self.client.put(reverse("feeds-reorder"), data={"oldPosition": 0, "newPosition": 1}, format='json')
         assert result.status_code == status.HTTP_204_NO_CONTENT
@@ -116,12 +189,10 @@ class FeedTests(TestCase):
         link = Link.objects.create(url="http://test.com/rss/feed.xml")
         FeedLink.objects.create(link=link, feed=Feed.objects.get(pk=1), reg_exp="")
         with freeze_time("2018-01-31T13:00:01Z"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
-                        ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
                 result = self.client.get(reverse("feeds-loop"), format='json')
         assert result.data['added'] == 2
 
@@ -177,6 +248,56 @@ class FeedLinkTests(TestCase):
         assert FeedLink.objects.get(feed__name="Feed1", link__url="http://test3.xml").position == 1
         assert FeedLink.objects.get(feed__name="Feed1", link__url="http://test.xml").position == 0
 
+    def test_delete_feed_link_keeps_other_feeds(self):
+        other = FeedLink.objects.create(link=Link.objects.get(pk=1), feed=Feed.objects.get(pk=3), position=2)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.delete(reverse("links-detail", kwargs={"feed": "Feed1", "position": 0}), format='json')
+        assert len([x for x in queries if x['sql'].startswith('UPDATE "feeds_feedlink"')]) == 1
+        assert FeedLink.objects.get(pk=other.pk).position == 2
+        assert list(FeedLink.objects.filter(feed=1).values_list('position', flat=True)) == [0, 1]
+
+
+class LinkTests(TestCase):
+    fixtures = ['feeds', "feed_links"]
+
+    def test_normalize_url(self):
+        assert normalize_url("HTTPS://Test.com:443/feed/?utm_source=x&id=1#top") == "https://test.com/feed?id=1"
+        assert normalize_url("http://test.com:8080/feed/") == "http://test.com:8080/feed"
+        assert normalize_url("htt://test.com/") == "htt://test.com/"
+
+    def test_get_link(self):
+        assert get_link("HTTPS://TEST.xml/").pk == 1
+        assert get_link(" http://test4.xml/?utm_medium=rss").url == "http://test4.xml/?utm_medium=rss"
+        assert get_link("http://test4.xml").url == "http://test4.xml/?utm_medium=rss"
+        assert Link.objects.count() == 4
+
+    def test_dedupe_links(self):
+        duplicate = Link.objects.create(url="https://test.xml/")
+        FeedLink.objects.create(link=duplicate, feed=Feed.objects.get(pk=1), position=3)
+        FeedLink.objects.create(link=duplicate, feed=Feed.objects.get(pk=3), position=0)
+        FeedLink.objects.create(link=Link.objects.create(url="http://TEST2.xml?fbclid=1"), feed=Feed.objects.get(pk=3),
+                                position=1)
+        call_command('dedupe_links', stdout=StringIO())
+        assert sorted(Link.objects.values_list('url', flat=True)) == ["http://test2.xml", "http://test3.xml",
+                                                                      "https://test.xml/"]
+        assert list(FeedLink.objects.filter(feed=1).values_list('position', flat=True)) == [0, 1, 2]
+        assert list(FeedLink.objects.filter(feed=3).values_list('link__url', flat=True)) == ["https://test.xml/",
+                                                                                             "http://test2.xml"]
+
+    def test_merge_links_followed_twice(self):
+        # feed 1 follows both the link and its https variant, and got the same entry from both
+        link = Link.objects.get(pk=1)
+        duplicate = Link.objects.create(url="https://test.xml/")
+        FeedLink.objects.create(link=duplicate, feed=Feed.objects.get(pk=1), position=3)
+        date = datetime(2018, 1, 31, 11, tzinfo=pytz.utc)
+        for x in (link, duplicate):
+            item = Item.objects.create(link=x, title="Post1", url="https://test.com/feed/Post1", post_date=date)
+            Post.objects.create(feed_id=1, item=item, add_date=date, view=x == duplicate)
+        merge_links(link, [duplicate])
+        assert FeedLink.objects.filter(feed=1, link=link).count() == 1
+        assert list(Post.objects.filter(feed=1).values_list('item__link', 'view')) == [(1, True)]
+        assert Item.objects.filter(url="https://test.com/feed/Post1").count() == 1
+
 
 class PostTests(TestCase):
     fixtures = ['feeds', "feed_links", "posts"]
@@ -214,6 +335,432 @@ class PostTests(TestCase):
         assert result.data['view'] == True
         assert Post.objects.filter(view=False).count() == 1
 
+    def test_list_matches_serializer(self):
+        Item.objects.filter(post=2).update(title="Zażółć \u2028 \"gęślą\"")
+        result = self.client.get(reverse("posts-list"), format='json')
+        posts = PostSerializer(Post.objects.filter(feed__user=self.user), many=True).data
+        assert result.content == JSONRenderer().render({"count": 3, "results": posts})
+
+    def test_read_other_users_post(self):
+        self.client.force_authenticate(User.objects.get(username='user2'))
+        result = self.client.patch(reverse("posts-detail", args=(1,)), data={"view": True}, format='json')
+        assert result.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_read_feed_posts(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = self.client.put(reverse("posts-read"), data={"feed": 1}, format='json')
+        assert len([x for x in queries if x['sql'].startswith('UPDATE "feeds_post"')]) == 1
+        assert result.status_code == status.HTTP_200_OK
+        assert result.data['updated'] == 2
+        assert Post.objects.filter(view=False).count() == 0
+        assert sorted(PostChange.objects.filter(user=self.user).values_list('post', flat=True))[-2:] == [2, 3]
+
+    def test_read_posts_by_ids_and_date(self):
+        before = datetime(2018, 1, 25, 20, 5, 1)
+        result = self.client.put(
+            reverse("posts-read"),
+            data={"ids": [1, 2, 3], "before": int(before.timestamp())},
+            format='json'
+        )
+        assert result.data['updated'] == 2
+        result = self.client.put(reverse("posts-read"), data={"ids": [1, 2]}, format='json')
+        assert result.data['updated'] == 0
+
+    def test_read_other_users_feed_posts(self):
+        self.client.force_authenticate(User.objects.get(username='user2'))
+        result = self.client.put(reverse("posts-read"), data={"feed": 1}, format='json')
+        assert result.data['updated'] == 0
+        assert Post.objects.filter(view=False).count() == 2
+
+    def test_read_posts_wrongly_specified(self):
+        result = self.client.put(reverse("posts-read"), data={}, format='json')
+        assert result.status_code == status.HTTP_400_BAD_REQUEST
+        result = self.client.put(reverse("posts-read"), data={"ids": ["x"]}, format='json')
+        assert result.status_code == status.HTTP_400_BAD_REQUEST
+        result = self.client.put(reverse("posts-read"), data={"before": 1e20}, format='json')
+        assert result.status_code == status.HTTP_400_BAD_REQUEST
+
+
+class ChangesTests(TestCase):
+    fixtures = ['feeds', "posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.get(username='user1')
+        self.client.force_authenticate(self.user)
+
+    def test_changes(self):
+        post = add_post(1, "Post4", "2018-01-25T20:07:00Z")
+        add_post(3, "Other", "2018-01-25T20:07:00Z")
+        result = self.client.get(reverse("posts-changes"), format='json')
+        assert result.status_code == status.HTTP_200_OK
+        assert [x['title'] for x in result.data['posts']] == ["Post1", "Post2", "Post3", "Post4"]
+        assert result.data['deleted'] == []
+        assert not result.data['more']
+        cursor = result.data['cursor']
+
+        self.client.put(reverse("posts-read"), data={"feed": 1}, format='json')
+        Post.objects.get(pk=3).delete()
+        result = self.client.get(reverse("posts-changes"), data={"since": cursor}, format='json')
+        assert [x['id'] for x in result.data['posts']] == [1, 2, post.pk]
+        assert all(x['view'] for x in result.data['posts'])
+        assert result.data['deleted'] == [3]
+
+        result = self.client.get(reverse("posts-changes"), data={"since": result.data['cursor']}, format='json')
+        assert result.data['posts'] == []
+        assert result.data['deleted'] == []
+
+    def test_changes_in_batches(self):
+        cursor = self.client.get(reverse("posts-changes"), format='json').data['cursor']
+        for x in (3, 1, 2, 1):
+            Post.objects.get(pk=x).save()
+        result = self.client.get(reverse("posts-changes"), data={"since": cursor, "limit": 2}, format='json')
+        assert [x['id'] for x in result.data['posts']] == [1, 3]
+        assert result.data['more']
+        result = self.client.get(reverse("posts-changes"), data={"since": result.data['cursor'], "limit": 2},
+                                 format='json')
+        assert [x['id'] for x in result.data['posts']] == [1, 2]
+        assert not result.data['more']
+
+    def test_changes_wrong_cursor(self):
+        result = self.client.get(reverse("posts-changes"), data={"since": "x"}, format='json')
+        assert result.status_code == status.HTTP_400_BAD_REQUEST
+        result = self.client.get(reverse("posts-changes"), data={"limit": -5}, format='json')
+        assert result.status_code == status.HTTP_200_OK
+        assert len(result.data['posts']) == 1
+
+    def test_compact_changes(self):
+        cursor = self.client.get(reverse("posts-changes"), format='json').data['cursor']
+        for x in (3, 1, 2, 1, 3):
+            Post.objects.get(pk=x).save()
+        compact_changes([self.user.pk])
+        assert sorted(PostChange.objects.filter(id__gt=cursor).values_list('post', flat=True)) == [1, 2, 3]
+        result = self.client.get(reverse("posts-changes"), data={"since": cursor}, format='json')
+        assert [x['id'] for x in result.data['posts']] == [1, 2, 3]
+
+
+class LiveUpdateTests(TestCase):
+    fixtures = ['feeds', "posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.get(username='user1')
+        self.client.force_authenticate(self.user)
+
+    def test_wait_for_pending_changes(self):
+        result = self.client.get(reverse("posts-wait"), format='json')
+        assert result.status_code == status.HTTP_200_OK
+        assert result.data['posts'] == [1, 2, 3]
+        assert result.data['feeds'] == [1]
+        result = self.client.get(reverse("posts-wait"), data={"since": result.data['cursor'], "timeout": 0},
+                                 format='json')
+        assert result.data['posts'] == []
+
+    @override_settings(FEEDS_POLL_INTERVAL=10)
+    def test_wait_woken_by_notify(self):
+        changes = {"cursor": 5, "posts": [4], "feeds": [1]}
+        threading.Timer(0.1, notify).start()
+        started = time.monotonic()
+        with patch("feeds.notify.pending_changes", Mock(side_effect=[{"cursor": 4, "posts": [], "feeds": []},
+                                                                     changes])):
+            result = self.client.get(reverse("posts-wait"), data={"since": 4, "timeout": 5}, format='json')
+        assert time.monotonic() - started < 5
+        assert result.data == changes
+
+    @override_settings(FEEDS_POLL_INTERVAL=0.1)
+    def test_waiters_share_polls(self):
+        unchanged = {"cursor": 4, "posts": [], "feeds": []}
+        with patch("feeds.notify.pending_changes", Mock(return_value=unchanged)) as pending, \
+                patch("feeds.notify.latest_changes", Mock(return_value=[])) as latest:
+            waiters = [threading.Thread(target=wait_for_changes, args=(self.user, 4, 0.5)) for _ in range(5)]
+            for waiter in waiters:
+                waiter.start()
+            for waiter in waiters:
+                waiter.join()
+        assert pending.call_count == 5
+        assert 1 <= latest.call_count <= 6
+
+    @override_settings(FEEDS_POLL_INTERVAL=10)
+    def test_wait_woken_by_poll(self):
+        changes = {"cursor": 5, "posts": [4], "feeds": [1]}
+        with patch.dict("feeds.notify._state", polled=0.0, last=None), patch.dict("feeds.notify._latest", clear=True), \
+                patch("feeds.notify.pending_changes", Mock(side_effect=[{"cursor": 4, "posts": [], "feeds": []},
+                                                                       changes])), \
+                patch("feeds.notify.latest_changes", Mock(return_value=[(self.user.pk, 5)])):
+            assert wait_for_changes(self.user, 4, 5) == changes
+
+    def test_poll_ignores_future_cursor(self):
+        with patch.dict("feeds.notify._state", last=None), patch.dict("feeds.notify._latest", clear=True):
+            poll(10 ** 9)
+            newest = PostChange.objects.latest('id').id
+            assert _state["last"] == newest
+            Post.objects.get(pk=1).save()
+            poll(10 ** 9)
+            assert _latest[self.user.pk] == _state["last"] > newest
+
+    def test_wrong_timeout(self):
+        for timeout in ("nan", "inf", "-1"):
+            result = self.client.get(reverse("posts-wait"), data={"timeout": timeout}, format='json')
+            assert result.status_code == status.HTTP_400_BAD_REQUEST
+            result = self.client.get(reverse("posts-stream"), data={"timeout": timeout},
+                                     HTTP_ACCEPT='text/event-stream')
+            assert result.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_stream(self):
+        result = self.client.get(reverse("posts-stream"), data={"timeout": 0.2}, HTTP_ACCEPT='text/event-stream')
+        assert result.status_code == status.HTTP_200_OK
+        assert result['Content-Type'] == 'text/event-stream'
+        event = b"".join(result.streaming_content).decode().split("\n\n")[0].split("\n")
+        changes = json.loads(event[1][len("data: "):])
+        assert event[0] == "id: {}".format(changes['cursor'])
+        assert changes['posts'] == [1, 2, 3]
+
+
+class SearchTests(TestCase):
+    fixtures = ['feeds', "posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.get(username='user1')
+        self.client.force_authenticate(self.user)
+        for feed_id, title in ((1, "Python release notes"), (2, "Python Python Python"), (3, "Python for user2"),
+                               (2, "Release party")):
+            add_post(feed_id, title, "2018-01-25T20:07:00Z")
+
+    def search(self, **data):
+        return self.client.get(reverse("posts-search"), data=data, format='json')
+
+    def test_search(self):
+        result = self.search(q="python")
+        assert result.status_code == status.HTTP_200_OK
+        assert [x['title'] for x in result.data['results']] == ["Python Python Python", "Python release notes"]
+        assert result.data['next'] is None
+        assert [x['title'] for x in self.search(q="python release").data['results']] == ["Python release notes"]
+        assert [x['title'] for x in self.search(q="post1").data['results']] == ["Post1"]
+
+    def test_search_pages(self):
+        result = self.search(q="python", limit=1)
+        assert [x['title'] for x in result.data['results']] == ["Python Python Python"]
+        result = self.search(q="python", limit=1, after=result.data['next'])
+        assert [x['title'] for x in result.data['results']] == ["Python release notes"]
+        assert result.data['next'] is None
+
+    def test_index_follows_changes(self):
+        item = Item.objects.get(title="Release party")
+        item.title = "Python party"
+        item.save()
+        Post.objects.get(item__title="Python release notes").delete()
+        assert [x['title'] for x in self.search(q="python").data['results']] == ["Python Python Python",
+                                                                                 "Python party"]
+        assert self.search(q="release").data['results'] == []
+
+    def test_search_wrong_cursor(self):
+        assert self.search(q="python", after="x").status_code == status.HTTP_400_BAD_REQUEST
+
+
+class ArchiveTests(TestCase):
+    fixtures = ['feeds', "posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.get(username='user1')
+        self.client.force_authenticate(self.user)
+        for x in range(30):
+            date = datetime(2017, 1, 1 + x, tzinfo=pytz.UTC)
+            add_post(1, "Old{}".format(x), date, view=x % 2 == 0)
+
+    def test_archive_posts(self):
+        call_command('archive_posts', batch_size=3, stdout=StringIO())
+        assert set(ArchivedPost.objects.values_list('title', flat=True)) == {"Old{}".format(x) for x in range(0, 13, 2)}
+        assert Post.objects.count() == 26
+        assert not Post.objects.filter(item__title="Old0").exists()
+        call_command('archive_posts', stdout=StringIO())
+        assert ArchivedPost.objects.count() == 7
+
+    def test_read_through_archive(self):
+        call_command('archive_posts', stdout=StringIO())
+        assert self.client.get(reverse("posts-list"), format='json').data['count'] == 26
+        result = self.client.get(reverse("posts-list"), data={"archive": "true"}, format='json')
+        assert result.data['count'] == 33
+        assert result.data['results'][-1]['title'] == "Old12"
+        assert result.data['results'][-1].keys() == result.data['results'][0].keys()
+        result = self.client.get(reverse("posts-list"), data={"archive": "true", "new": True}, format='json')
+        assert result.data['count'] == 17
+
+
+class TimelineTests(TestCase):
+    fixtures = ['feeds', "posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.get(username='user1')
+        self.client.force_authenticate(self.user)
+        for feed_id, title, add_date in ((2, "Post4", "2018-01-25T20:07:00Z"), (3, "Other", "2018-01-25T20:08:00Z")):
+            add_post(feed_id, title, add_date)
+
+    def test_get_timeline(self):
+        with self.assertNumQueries(1):
+            result = self.client.get(reverse("timeline-list"), format='json')
+        assert result.status_code == status.HTTP_200_OK
+        assert [x['title'] for x in result.data['results']] == ["Post3", "Post4", "Post2", "Post1"]
+        assert result.data['results'][1]['feed'] == 2
+        assert result.data['results'][1]['feed_name'] == "Feed2"
+
+    def test_get_new_timeline_posts(self):
+        result = self.client.get(reverse("timeline-list"), data={"new": True}, format='json')
+        assert result.status_code == status.HTTP_200_OK
+        assert [x['title'] for x in result.data['results']] == ["Post4", "Post2", "Post1"]
+
+    def test_timeline_pages(self):
+        result = self.client.get(reverse("timeline-list"), data={"page_size": 3}, format='json')
+        assert [x['title'] for x in result.data['results']] == ["Post3", "Post4", "Post2"]
+        result = self.client.get(result.data['next'], format='json')
+        assert [x['title'] for x in result.data['results']] == ["Post1"]
+        assert result.data['next'] is None
+
+    def test_posts_copy_feed_user(self):
+        assert Post.objects.get(item__title="Other").user.username == "user2"
+        assert Post.objects.filter(user=self.user).count() == 4
+
+    @skipUnless(connection.vendor == 'sqlite', "the plan is checked on sqlite")
+    def test_timeline_is_one_scan(self):
+        posts = Post.objects.filter(user=self.user).order_by('-add_date', '-id')[:50]
+        sql, params = posts.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = " ".join(str(x[-1]) for x in cursor.fetchall())
+        assert "feeds_post_user_add_date_id" in plan
+        assert "TEMP B-TREE" not in plan
+
+
+class ConditionalTests(TestCase):
+    fixtures = ['feeds', "get_posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.get(username='user3')
+        self.client.force_authenticate(self.user)
+
+    def test_not_modified(self):
+        result = self.client.get(reverse("feeds-list"), format='json')
+        etag = result['ETag']
+        with self.assertNumQueries(1):
+            result = self.client.get(reverse("feeds-list"), format='json', HTTP_IF_NONE_MATCH=etag)
+        assert result.status_code == status.HTTP_304_NOT_MODIFIED
+        etag = self.client.get(reverse("posts-detail", args=(1,)), format='json')['ETag']
+        result = self.client.get(reverse("posts-detail", args=(1,)), format='json', HTTP_IF_NONE_MATCH=etag)
+        assert result.status_code == status.HTTP_304_NOT_MODIFIED
+
+    def test_not_modified_needs_object(self):
+        etag = self.client.get(reverse("posts-detail", args=(1,)), format='json')['ETag']
+        feed = Feed.objects.create(name="Other", user=User.objects.get(username='user1'), position=9)
+        other = add_post(feed.pk, "Other post", now())
+        for pk in (other.pk, 9999):
+            result = self.client.get(reverse("posts-detail", args=(pk,)), format='json', HTTP_IF_NONE_MATCH=etag)
+            assert result.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_modified_by_write(self):
+        etag = self.client.get(reverse("feeds-list"), format='json')['ETag']
+        self.client.patch(reverse("posts-detail", args=(1,)), data={"view": False}, format='json')
+        result = self.client.get(reverse("feeds-list"), format='json', HTTP_IF_NONE_MATCH=etag)
+        assert result.status_code == status.HTTP_200_OK
+        assert result['ETag'] != etag
+        assert 'Last-Modified' in result
+
+    def test_modified_by_loop(self):
+        etag = self.client.get(reverse("posts-list"), format='json')['ETag']
+        self.client.force_authenticate(User.objects.get(username='user1'))
+        other_etag = self.client.get(reverse("posts-list"), format='json')['ETag']
+        with freeze_time("2018-01-31T13:00:01"):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+            ]):
+                get_posts()
+        result = self.client.get(reverse("posts-list"), format='json', HTTP_IF_NONE_MATCH=other_etag)
+        assert result.status_code == status.HTTP_304_NOT_MODIFIED
+        self.client.force_authenticate(self.user)
+        result = self.client.get(reverse("posts-list"), format='json', HTTP_IF_NONE_MATCH=etag)
+        assert result.status_code == status.HTTP_200_OK
+
+
+class CacheTests(TestCase):
+    fixtures = ['feeds', "posts"]
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.get(username='user1')
+        self.client.force_authenticate(self.user)
+
+    def test_cached_feed_list(self):
+        result = self.client.get(reverse("feeds-list"), format='json')
+        with self.assertNumQueries(1):
+            cached = self.client.get(reverse("feeds-list"), format='json')
+        assert cached.data == result.data
+        assert cached.data[0]['count'] == 2
+        admin = User.objects.create(username='admin', is_staff=True)
+        self.client.force_authenticate(admin)
+        result = self.client.get(reverse("feeds-cache-stats"), format='json')
+        assert result.data == {"hits": 1, "misses": 2}
+
+    def test_unread_counts(self):
+        result = self.client.get(reverse("feeds-counts"), format='json')
+        assert result.data == {1: 2}
+        self.client.put(reverse("posts-read"), data={"ids": [1]}, format='json')
+        result = self.client.get(reverse("feeds-counts"), format='json')
+        assert result.data == {1: 1}
+        result = self.client.get(reverse("feeds-list"), format='json')
+        assert result.data[0]['count'] == 1
+
+    def test_invalidated_by_loop(self):
+        link = Link.objects.create(url="http://test.com/rss/feed.xml")
+        FeedLink.objects.create(link=link, feed=Feed.objects.get(pk=1), reg_exp="")
+        self.client.get(reverse("feeds-list"), format='json')
+        with freeze_time("2018-01-31T13:00:01"):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post4", "https://test.com/feed/Post4", "2018-01-31T11:00:00"),
+            ]):
+                get_posts()
+        result = self.client.get(reverse("feeds-list"), format='json')
+        assert result.data[0]['count'] == 3
+
+
+class EncodingTests(TestCase):
+    fixtures = ['feeds', "posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.get(username='user1')
+        self.client.force_authenticate(self.user)
+
+    def test_gzip(self):
+        plain = self.client.get(reverse("posts-list"), format='json')
+        result = self.client.get(reverse("posts-list"), format='json', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        assert result['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in result['Vary']
+        assert gzip.decompress(result.content) == plain.content
+        result = self.client.get(reverse("posts-list"), format='json', HTTP_ACCEPT_ENCODING='gzip',
+                                 HTTP_IF_NONE_MATCH=result['ETag'])
+        assert result.status_code == status.HTTP_304_NOT_MODIFIED
+
+    def test_gzip_stream(self):
+        for x in range(500):
+            add_post(1, "Post {}".format(x), "2018-01-25T20:00:00Z")
+        plain = self.client.get(reverse("posts-list"), format='json')
+        result = self.client.get(reverse("posts-list"), format='json', HTTP_ACCEPT_ENCODING='gzip')
+        assert result.streaming
+        assert result['Content-Type'] == plain['Content-Type']
+        assert gzip.decompress(b"".join(result.streaming_content)) == plain.content
+
+    @skipUnless(msgpack, "msgpack is not installed")
+    def test_msgpack(self):
+        plain = self.client.get(reverse("feeds-list"), format='json')
+        result = self.client.get(reverse("feeds-list"), HTTP_ACCEPT='application/msgpack')
+        assert result['Content-Type'] == 'application/msgpack'
+        assert msgpack.unpackb(result.content, raw=False) == json.loads(plain.content.decode())
+        result = self.client.get(reverse("posts-list"), HTTP_ACCEPT='application/msgpack')
+        assert msgpack.unpackb(result.content, raw=False)['count'] == 3
+
 
 class DiscoverTests(TestCase):
     fixtures = ['feeds']
@@ -227,7 +774,7 @@ class DiscoverTests(TestCase):
         self.feed_url = b2a_base64("http://test.com/feed/".encode())
         self.wrong_feed_url = b2a_base64("htt://test.com/feed/".encode())
 
-    @patch("urllib.request.urlopen", Mock(return_value=StringIO(test_sites.SITE)))
+    @use_transport(MemoryTransport({"http://test.com": test_sites.SITE}))
     def test_scan(self):
         result = self.client.get(reverse("discover-scan"), data={"url": self.url}, format='json')
         assert result.status_code == status.HTTP_200_OK
@@ -235,7 +782,7 @@ class DiscoverTests(TestCase):
         assert "http://test.com/feed/" in result.data
         assert "http://test.com/feed2/" in result.data
 
-    @patch("urllib.request.urlopen", Mock(return_value=StringIO(test_sites.EMPTY_SITE)))
+    @use_transport(MemoryTransport({"http://test.com": test_sites.EMPTY_SITE}))
     def test_no_links(self):
         result = self.client.get(reverse("discover-scan"), data={"url": self.url}, format='json')
         assert result.status_code == status.HTTP_200_OK
@@ -245,20 +792,20 @@ class DiscoverTests(TestCase):
         result = self.client.get(reverse("discover-scan"), data={"url": self.wrong_url}, format='json')
         assert result.status_code == status.HTTP_404_NOT_FOUND
 
-    @patch("urllib.request.urlopen", Mock(return_value=StringIO(test_sites.FEED)))
+    @use_transport(MemoryTransport({"http://test.com/feed/": test_sites.FEED}))
     def test_extract(self):
         result = self.client.get(reverse("discover-extract"), data={"url": self.feed_url}, format='json')
         assert result.data['name'] == "Feed1"
         assert result.data['url'] == "http://test.com/feed/"
 
-    @patch("urllib.request.urlopen", Mock(return_value=StringIO(test_sites.FEED_WITHOUT_TITLE)))
+    @use_transport(MemoryTransport({"http://test.com/feed/": test_sites.FEED_WITHOUT_TITLE}))
     def test_extract_feed_without_title(self):
         result = self.client.get(reverse("discover-extract"), data={"url": self.feed_url}, format='json')
         assert result.status_code == status.HTTP_200_OK
         assert result.data['name'] == "http://test.com/feed/"
         assert result.data['url'] == "http://test.com/feed/"
 
-    @patch("urllib.request.urlopen", Mock(return_value=StringIO(test_sites.NO_FEEDS)))
+    @use_transport(MemoryTransport({"http://test.com/feed/": test_sites.NO_FEEDS}))
     def test_extract_empty_feed(self):
         result = self.client.get(reverse("discover-extract"), data={"url": self.feed_url}, format='json')
         assert result.status_code == status.HTTP_404_NOT_FOUND
@@ -268,13 +815,87 @@ class DiscoverTests(TestCase):
         assert result.status_code == status.HTTP_404_NOT_FOUND
 
 
+class DiscoveryJobTests(TestCase):
+    fixtures = ['feeds']
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.get(username='user1'))
+
+    def post(self, kind, url):
+        return self.client.post(reverse("discover-jobs-list"), data={"kind": kind, "url": url}, format='json')
+
+    def test_job(self):
+        result = self.post("scan", "http://test.com")
+        assert result.status_code == status.HTTP_201_CREATED
+        assert result.data['status'] == "pending"
+        assert self.post("scan", "http://test.com").data['id'] == result.data['id']
+
+        with use_transport(MemoryTransport({"http://test.com": test_sites.SITE})) as transport:
+            call_command('run_discovery', once=True, workers=1, stdout=StringIO())
+        assert transport.requests == [("http://test.com", 10)]
+
+        job = self.client.get(reverse("discover-jobs-detail", kwargs={"pk": result.data['id']}), format='json').data
+        assert job['status'] == "done"
+        assert job['result'] == ["http://test.com/feed/", "http://test.com/feed2/"]
+        assert self.post("scan", "http://test.com").status_code == status.HTTP_200_OK
+        with override_settings(FEEDS_DISCOVERY_TTL=0):
+            assert self.post("scan", "http://test.com").status_code == status.HTTP_201_CREATED
+
+    @use_transport(MemoryTransport({"http://test.com/feed/": URLError("timed out")}))
+    def test_failed_job(self):
+        job_id = self.post("extract", "http://test.com/feed/").data['id']
+        call_command('run_discovery', once=True, workers=1, stdout=StringIO())
+        job = self.client.get(reverse("discover-jobs-detail", kwargs={"pk": job_id}), data={"wait": 5}, format='json')
+        assert job.data['status'] == "failed"
+        assert "timed out" in job.data['error']
+        assert self.post("extract", "http://test.com/feed/").status_code == status.HTTP_201_CREATED
+
+    @use_transport(MemoryTransport({"http://test.com": test_sites.SITE}))
+    def test_unexpected_error_fails_job(self):
+        job_id = self.post("scan", "http://test.com").data['id']
+        with patch("feeds.discovery.DISCOVERERS", {"scan": Mock(side_effect=AttributeError)}):
+            call_command('run_discovery', once=True, workers=1, stdout=StringIO())
+        job = DiscoveryJob.objects.get(pk=job_id)
+        assert job.status == "failed"
+        assert job.error == "AttributeError"
+        assert job.active is None
+
+    def test_concurrent_requests_share_job(self):
+        job, created = discovery.get_job("scan", "http://test.com")
+        assert created
+        # the other request did not see the job yet
+        with patch("feeds.discovery.DiscoveryJob.objects.filter", side_effect=[DiscoveryJob.objects.none(),
+                                                                                 DiscoveryJob.objects.all()]):
+            assert discovery.get_job("scan", "http://test.com") == (job, False)
+        assert DiscoveryJob.objects.count() == 1
+
+    @override_settings(FEEDS_POLL_INTERVAL=0.01)
+    def test_wait_for_pending_job(self):
+        job_id = self.post("scan", "http://test.com").data['id']
+        result = self.client.get(reverse("discover-jobs-detail", kwargs={"pk": job_id}), data={"wait": 0.05},
+                                 format='json')
+        assert result.data['status'] == "pending"
+
+    def test_wrong_wait(self):
+        job_id = self.post("scan", "http://test.com").data['id']
+        for wait in ("nan", "inf", "-1", "soon"):
+            result = self.client.get(reverse("discover-jobs-detail", kwargs={"pk": job_id}), data={"wait": wait},
+                                     format='json')
+            assert result.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_invalid_job(self):
+        assert self.post("scan", "not a url").status_code == status.HTTP_400_BAD_REQUEST
+        assert self.post("crawl", "http://test.com").status_code == status.HTTP_400_BAD_REQUEST
+
+
 class TestFeedDownloader(TestCase):
     fixtures = ['feeds', "feed_links"]
 
     def setUp(self):
         self.url = "http://test.xml"
 
-    @patch("urllib.request.urlopen", Mock(return_value=StringIO(test_sites.FEED)))
+    @use_transport(MemoryTransport({"http://test.xml": test_sites.FEED}))
     def test_get_posts(self):
         downloader = FeedDownloader(self.url)
         posts = downloader.get_posts()
@@ -286,7 +907,7 @@ class TestFeedDownloader(TestCase):
         assert posts[1].url == 'https://test.com/feed/Post2'
         assert posts[1].post_date == datetime(2018, 1, 30, 10, 0, 1, tzinfo=pytz.UTC)
 
-    @patch("urllib.request.urlopen", Mock(return_value=StringIO(test_sites.FEED)))
+    @use_transport(MemoryTransport({"http://test.xml": test_sites.FEED}))
     def test_get_posts_respect_limit(self):
         Feed.objects.all().update(postLimit=1)
         downloader = FeedDownloader(self.url)
@@ -297,161 +918,853 @@ class TestFeedDownloader(TestCase):
         assert posts[0].post_date == datetime(2018, 1, 31, 10, tzinfo=pytz.UTC)
 
 
+class StandInSite(BaseHTTPRequestHandler):
+    pages = {
+        "/feed.xml": (200, test_sites.FEED),
+        "/moved.xml": (301, "/feed.xml"),
+        "/moved-twice.xml": (308, "/moved.xml"),
+        "/temporary.xml": (302, "/moved.xml"),
+        "/missing.xml": (404, "missing"),
+    }
+
+    def do_GET(self):
+        code, content = self.pages[self.path]
+        self.send_response(code)
+        if 300 <= code < 400:
+            self.send_header("Location", content)
+            content = ""
+        self.send_header("Content-Length", str(len(content.encode())))
+        self.end_headers()
+        self.wfile.write(content.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TransportTests(TestCase):
+    fixtures = ['feeds', "get_posts"]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def serve(self):
+        server = HTTPServer(("127.0.0.1", 0), StandInSite)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return "http://127.0.0.1:{}".format(server.server_address[1])
+
+    def open(self, transport, url):
+        return transport.open(urllib.request.Request(url, headers={'User-Agent': 'feed-reader'}), 5)
+
+    def check_network_transport(self, transport):
+        site = self.serve()
+        response = self.open(transport, site + "/feed.xml")
+        assert response.read() == test_sites.FEED.encode()
+        assert not getattr(response, 'permanent_redirect', False)
+        response = self.open(transport, site + "/moved-twice.xml")
+        assert response.geturl() == site + "/feed.xml"
+        assert response.permanent_redirect
+        assert not self.open(transport, site + "/temporary.xml").permanent_redirect
+        with self.assertRaises(HTTPError) as error:
+            self.open(transport, site + "/missing.xml")
+        assert error.exception.code == 404
+        with self.assertRaises(URLError):
+            self.open(transport, "http://127.0.0.1:1/feed.xml")
+
+    def test_urllib_transport(self):
+        self.check_network_transport(UrllibTransport())
+
+    @skipUnless(urllib3, "urllib3 is not installed")
+    def test_urllib3_transport(self):
+        self.check_network_transport(Urllib3Transport())
+
+    def test_record_replay(self):
+        memory = MemoryTransport({
+            "http://test.com/rss/feed.xml": Response("http://test.com/rss/moved.xml", feed_creator(
+                "Feed1", "http://test.com/rss/feed.xml",
+                [("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00")]
+            ), permanent_redirect=True),
+            "http://test.com/rss/feed2.xml": Response("http://test.com/rss/feed2.xml", "gone", status=410),
+            "http://test.com/rss/feed3.xml": URLError(socket.timeout("timed out")),
+        })
+        recorder = RecordingTransport(self.directory, memory)
+        with self.assertRaises(HTTPError):
+            self.open(recorder, "http://test.com/rss/feed2.xml")
+        with self.assertRaises(URLError):
+            self.open(recorder, "http://test.com/rss/feed3.xml")
+        recorded = self.open(recorder, "http://test.com/rss/feed.xml")
+        assert recorded_urls(self.directory) == ["http://test.com/rss/feed.xml"]
+
+        replay = ReplayTransport(self.directory)
+        response = self.open(replay, "http://test.com/rss/feed.xml")
+        assert (response.read(), response.geturl(), response.permanent_redirect) == \
+            (recorded.read(), "http://test.com/rss/moved.xml", True)
+        with self.assertRaises(HTTPError) as error:
+            self.open(replay, "http://test.com/rss/feed2.xml")
+        assert error.exception.code == 410
+        with self.assertRaises(URLError) as error:
+            self.open(replay, "http://test.com/rss/feed3.xml")
+        assert isinstance(error.exception.reason, socket.timeout)
+        with self.assertRaises(URLError):
+            self.open(replay, "http://test.com/rss/unknown.xml")
+
+        with freeze_time("2018-01-31T13:00:01"):
+            with use_transport(replay):
+                result = get_posts()
+        assert result["added"] == 2
+        errors = {x.url: x.error for x in LoopRun.objects.get(pk=result["run"]).links.all()}
+        assert errors["http://test.com/rss/feed2.xml"] == "HTTP Error 410: Gone"
+        assert Link.objects.filter(url="http://test.com/rss/moved.xml").exists()
+
+    def test_configured_transport(self):
+        with override_settings(FEEDS_TRANSPORT="feed_reader.transports.ReplayTransport",
+                               FEEDS_TRANSPORT_OPTIONS={"directory": self.directory}):
+            assert isinstance(get_transport(), ReplayTransport)
+            assert get_transport() is get_transport()
+            with use_transport(MemoryTransport()) as transport:
+                assert get_transport() is transport
+        assert isinstance(get_transport(), UrllibTransport)
+
+    def test_override_is_per_thread(self):
+        seen = []
+        with use_transport(MemoryTransport()) as transport:
+            thread = threading.Thread(target=lambda: seen.append(get_transport()))
+            thread.start()
+            thread.join()
+            assert get_transport() is transport
+        assert isinstance(seen[0], UrllibTransport)
+
+
+class GeneratedFeeds(Transport):
+    # answers every url with the feed made by feed(url)
+
+    def __init__(self, feed):
+        self.feed = feed
+
+    def open(self, req, timeout=None):
+        return Response(req.full_url, self.feed(req.full_url))
+
+
+class StandInHub(Transport):
+    url = "http://hub.test/"
+
+    def __init__(self, client, feeds):
+        self.client = client
+        self.feeds = feeds
+        self.fetches = 0
+        self.subscriptions = {}
+
+    def open(self, req, timeout=None):
+        if req.full_url != self.url:
+            if req.full_url not in self.feeds:
+                raise URLError("unknown feed")
+            self.fetches += 1
+            return Response(req.full_url, self.feeds[req.full_url])
+        params = dict(parse_qsl(req.data.decode()))
+        callback = urlsplit(params['hub.callback']).path
+        self.subscriptions[params['hub.topic']] = (callback, params['hub.secret'])
+        result = self.client.get(callback, {"hub.mode": params['hub.mode'], "hub.topic": params['hub.topic'],
+                                            "hub.challenge": "challenge", "hub.lease_seconds": 5 * 24 * 60 * 60})
+        assert result.content == b"challenge"
+        return Response(req.full_url)
+
+    def publish(self, topic, body, secret=None):
+        callback, subscribed_secret = self.subscriptions[topic]
+        signature = hmac.new((secret or subscribed_secret).encode(), body.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(callback, body, content_type="application/rss+xml",
+                                HTTP_X_HUB_SIGNATURE="sha256=" + signature)
+
+
+@override_settings(FEEDS_WEBSUB_CALLBACK="http://testserver")
+class WebSubTests(TestCase):
+    fixtures = ['feeds', "get_posts"]
+    topic = "http://test.com/rss/feed.xml"
+
+    def feed(self, items):
+        return feed_creator("Feed1", self.topic, items).replace(
+            '<rss version="2.0">', '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">'
+        ).replace(
+            "<description>Feed</description>",
+            '<description>Feed</description><atom:link rel="hub" href="{}"/>'
+            '<atom:link rel="self" href="{}"/>'.format(StandInHub.url, self.topic)
+        )
+
+    @freeze_time("2018-01-31T13:00:01")
+    def test_subscribe_and_push(self):
+        hub = StandInHub(APIClient(), {
+            self.topic: self.feed([("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00")])
+        })
+        with use_transport(hub):
+            assert get_posts()['added'] == 2
+            assert Subscription.objects.get(link=1).lease_expires is not None
+            get_posts()
+        assert hub.fetches == 1
+
+        body = self.feed([("Post2", "https://test.com/feed/Post2", "2018-01-31T14:00:00")])
+        assert hub.publish(self.topic, body).status_code == status.HTTP_204_NO_CONTENT
+        assert set(Post.objects.filter(item__title="Post2").values_list('feed', flat=True)) == {3, 4}
+
+        body = self.feed([("Forged", "https://test.com/feed/Forged", "2018-01-31T15:00:00")])
+        assert hub.publish(self.topic, body, secret="forged").status_code == status.HTTP_204_NO_CONTENT
+        assert not Post.objects.filter(item__title="Forged").exists()
+
+    def verify(self, subscription, **params):
+        params = dict({"hub.mode": "subscribe", "hub.topic": self.topic, "hub.challenge": "x"}, **params)
+        return APIClient().get(reverse("websub-callback", kwargs={"token": subscription.token}), params)
+
+    def subscription(self, **kwargs):
+        return Subscription.objects.create(link=Link.objects.get(pk=1), hub=StandInHub.url, topic=self.topic,
+                                           secret="secret", **kwargs)
+
+    def test_verify_unknown_topic(self):
+        subscription = self.subscription(pending="subscribe", pending_until=now() + timedelta(hours=1))
+        result = self.verify(subscription, **{"hub.topic": "http://other"})
+        assert result.status_code == status.HTTP_404_NOT_FOUND
+        assert Subscription.objects.get(pk=subscription.pk).lease_expires is None
+
+    def test_verify_needs_intent(self):
+        subscription = self.subscription()
+        assert self.verify(subscription).status_code == status.HTTP_404_NOT_FOUND
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        subscription.pending, subscription.pending_until = "subscribe", now() - timedelta(seconds=1)
+        subscription.save()
+        assert self.verify(subscription).status_code == status.HTTP_404_NOT_FOUND
+        subscription.pending_until = now() + timedelta(hours=1)
+        subscription.save()
+        assert self.verify(subscription, **{"hub.mode": "unsubscribe"}).status_code == status.HTTP_404_NOT_FOUND
+        assert Subscription.objects.get(pk=subscription.pk).lease_expires is None
+        result = APIClient().get(reverse("websub-callback", kwargs={"token": "guess"}), {"hub.topic": self.topic})
+        assert result.status_code == status.HTTP_404_NOT_FOUND
+
+    @override_settings(FEEDS_WEBSUB_LEASE=60)
+    def test_verify_clamps_lease(self):
+        subscription = self.subscription(pending="subscribe", pending_until=now() + timedelta(hours=1))
+        result = self.verify(subscription, **{"hub.lease_seconds": 10 ** 30})
+        assert result.status_code == status.HTTP_200_OK
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        assert subscription.lease_expires <= now() + timedelta(seconds=60)
+        assert subscription.pending == ""
+        assert self.verify(subscription).status_code == status.HTTP_404_NOT_FOUND
+
+    def test_receive_unparsable(self):
+        subscription = self.subscription(lease_expires=now() + timedelta(days=1))
+        body = "<rss><channel>"
+        signature = hmac.new(b"secret", body.encode(), hashlib.sha256).hexdigest()
+        result = APIClient().post(reverse("websub-callback", kwargs={"token": subscription.token}), body,
+                                  content_type="application/rss+xml", HTTP_X_HUB_SIGNATURE="sha256=" + signature)
+        assert result.status_code == status.HTTP_204_NO_CONTENT
+
+    @freeze_time("2018-01-31T13:00:01")
+    def test_pending_subscription_backs_off(self):
+        # the hub never verifies
+        transport = MemoryTransport({
+            StandInHub.url: "",
+            self.topic: self.feed([("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00")]),
+        })
+        with use_transport(transport):
+            get_posts()
+            get_posts()
+            assert [x for x, _ in transport.requests].count(StandInHub.url) == 1
+            with freeze_time("2018-01-31T14:00:02"):
+                get_posts()
+                assert [x for x, _ in transport.requests].count(StandInHub.url) == 2
+                subscription = Subscription.objects.get(link=1)
+                assert subscription.attempts == 2
+                assert subscription.pending_until == now() + timedelta(hours=2)
+
+
+class LoopRunTests(TestCase):
+    fixtures = ['feeds', "get_posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+
+    def test_run_is_recorded(self):
+        run = LoopRun.objects.get(pk=run_loop()["run"])
+        assert run.added == 4
+        links = {x.url: x for x in run.links.all()}
+        assert links["http://test.com/rss/feed.xml"].items == 2
+        assert links["http://test.com/rss/feed.xml"].feed_links == 2
+        assert links["http://test.com/rss/feed.xml"].size > 0
+        assert links["http://test.com/rss/feed.xml"].queries > 0
+        assert links["http://test.com/rss/feed2.xml"].error == "<urlopen error unreachable>"
+
+    @override_settings(FEEDS_LOOP_HISTORY=2)
+    def test_runs_endpoints(self):
+        runs = [run_loop()["run"] for _ in range(3)]
+        result = self.client.get(reverse("runs-list"), format='json')
+        assert [x['id'] for x in result.data['results']] == runs[:0:-1]
+        result = self.client.get(reverse("runs-detail", kwargs={"pk": runs[-1]}), format='json')
+        assert len(result.data['links']) == 2
+        result = self.client.get(reverse("runs-slowest"), data={"limit": 3}, format='json')
+        assert len(result.data) == 3
+        assert [x['duration'] for x in result.data] == sorted([x['duration'] for x in result.data], reverse=True)
+
+    def test_slowest_limits(self):
+        run_loop()
+        result = self.client.get(reverse("runs-slowest"), data={"runs": -1, "limit": 0}, format='json')
+        assert result.status_code == status.HTTP_200_OK
+        assert len(result.data) == 1
+
+    def test_runs_require_admin(self):
+        self.client.force_authenticate(User.objects.get(username='user1'))
+        assert self.client.get(reverse("runs-list"), format='json').status_code == status.HTTP_403_FORBIDDEN
+
+
+class ProfilingTests(TestCase):
+    fixtures = ['feeds', "get_posts"]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.settings = override_settings(FEEDS_PROFILE_DIR=self.directory, FEEDS_PROFILE_SECRET="s3cret")
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.client = APIClient()
+
+    def test_header_gated(self):
+        self.client.force_authenticate(User.objects.get(username='user1'))
+        self.client.get(reverse("posts-list"), format='json')
+        self.client.get(reverse("posts-list"), format='json', HTTP_X_FEEDS_PROFILE="wrong")
+        assert profiling.list_profiles() == []
+        self.client.get(reverse("posts-list"), format='json', HTTP_X_FEEDS_PROFILE="s3cret")
+        profiles = profiling.list_profiles()
+        assert [x['name'] for x in profiles] == ["PostView.get"]
+        assert profiles[0]['queries'] > 0
+
+    @override_settings(FEEDS_PROFILE_KEEP=2)
+    def test_retention(self):
+        self.client.force_authenticate(User.objects.get(username='user1'))
+        for _ in range(3):
+            self.client.get(reverse("posts-list"), format='json', HTTP_X_FEEDS_PROFILE="s3cret")
+        with patch("feeds.profiling.get_profile", Mock(side_effect=AssertionError)):
+            profiles = profiling.list_profiles()
+        assert len(profiles) == 2
+        assert len(os.listdir(self.directory)) == 6
+        assert profiling.get_profile(profiles[0]['id'])['queries']
+
+    @override_settings(FEEDS_PROFILE_RATE=1)
+    def test_sampled_loop(self):
+        run_loop()
+        assert [x['name'] for x in profiling.list_profiles()] == ["get_posts"]
+
+    @override_settings(FEEDS_PROFILE_RATE=1)
+    @use_transport(MemoryTransport({"http://test.com/rss/feed.xml": test_sites.FEED}))
+    def test_sampled_download(self):
+        downloader = FeedDownloader("http://test.com/rss/feed.xml")
+        assert len(downloader.parse(downloader.fetch())) == 2
+        assert sorted(x['name'] for x in profiling.list_profiles()) == ["FeedDownloader.fetch", "FeedDownloader.parse"]
+
+    @override_settings(FEEDS_PROFILE_RATE=1)
+    def test_profiles_endpoints(self):
+        run_loop()
+        pk = profiling.list_profiles()[0]['id']
+        self.client.force_authenticate(User.objects.get(username='user1'))
+        assert self.client.get(reverse("profiles-list"), format='json').status_code == status.HTTP_403_FORBIDDEN
+
+        self.client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+        result = self.client.get(reverse("profiles-list"), format='json')
+        assert [x['id'] for x in result.data] == [pk]
+        result = self.client.get(reverse("profiles-detail", kwargs={"pk": pk}), format='json')
+        assert "sync_link" in result.data['stats']
+        assert any("feeds_link" in x['sql'] for x in result.data['queries'])
+        result = self.client.get(reverse("profiles-download", kwargs={"pk": pk}))
+        assert b"".join(result.streaming_content)
+        result = self.client.get(reverse("profiles-detail", kwargs={"pk": "missing"}), format='json')
+        assert result.status_code == status.HTTP_404_NOT_FOUND
+
+
+class MetricsEndpointTests(TestCase):
+
+    def test_metrics_not_installed(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+        with patch("feeds.metrics.prometheus_client", None):
+            result = client.get(reverse("metrics-list"))
+        assert result.status_code == status.HTTP_501_NOT_IMPLEMENTED
+        assert b"prometheus_client is not installed" in result.content
+
+
+@skipUnless(prometheus_client, "prometheus_client is not installed")
+class MetricsTests(TestCase):
+    fixtures = ['feeds', "get_posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+
+    def sample(self, name, **labels):
+        return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_loop_metrics(self):
+        added = self.sample("feeds_loop_posts_total", action="added")
+        failed = self.sample("feeds_fetch_responses_total", host="test.com", status="error")
+        fetched = self.sample("feeds_fetch_seconds_count", host="test.com")
+        run_loop()
+        assert self.sample("feeds_loop_posts_total", action="added") == added + 4
+        assert self.sample("feeds_fetch_responses_total", host="test.com", status="error") == failed + 1
+        assert self.sample("feeds_fetch_seconds_count", host="test.com") == fetched + 2
+
+        result = self.client.get(reverse("metrics-list"))
+        assert result.status_code == status.HTTP_200_OK
+        assert result['Content-Type'] == prometheus_client.CONTENT_TYPE_LATEST
+        assert b'feeds_fetch_seconds_bucket{host="test.com"' in result.content
+        assert b'feeds_loop_posts_total{action="added"}' in result.content
+
+    def test_request_metrics(self):
+        requests = self.sample("feeds_request_seconds_count", route="runs-list", method="GET")
+        self.client.get(reverse("runs-list"), format='json')
+        assert self.sample("feeds_request_seconds_count", route="runs-list", method="GET") == requests + 1
+
+    def test_metrics_require_admin(self):
+        self.client.force_authenticate(User.objects.get(username='user1'))
+        assert self.client.get(reverse("metrics-list")).status_code == status.HTTP_403_FORBIDDEN
+        with override_settings(FEEDS_METRICS_PUBLIC=True):
+            assert self.client.get(reverse("metrics-list")).status_code == status.HTTP_200_OK
+
+
+class QueryBudgetMixin:
+    # Query counts must not grow with the amount of data beyond the declared budget: budget + per_size * size.
+    sizes = (1, 5, 20)
+
+    def assertQueryBudget(self, action, prepare, budget, per_size=0):
+        results = measure_queries(action, prepare, self.sizes)
+        over = [size for size, queries in results.items() if queries.count > budget + per_size * size]
+        if over:
+            queries = results[over[-1]]
+            self.fail("Queries by data size: {}, budget {} + {} per size. Duplicated queries at size {}:\n{}".format(
+                {size: x.count for size, x in results.items()}, budget, per_size, over[-1],
+                "\n".join("{} x {}".format(count, signature) for signature, count in duplicated_queries(queries.queries))
+            ))
+
+
+class InstrumentationTests(TestCase):
+
+    def test_count_beyond_debug_log(self):
+        with patch.object(connections[DEFAULT_DB_ALIAS], 'queries_log', deque(maxlen=3)):
+            with count_queries(capture=True) as outer:
+                for x in range(5):
+                    User.objects.filter(pk=x).exists()
+                with count_queries() as inner:
+                    User.objects.count()
+        assert (outer.count, inner.count) == (6, 1)
+        assert len(outer.queries) == 6
+        assert 'COUNT' in outer.queries[-1]['sql']
+
+    @override_settings(DEBUG=False)
+    def test_count_without_logging(self):
+        db = connections[DEFAULT_DB_ALIAS]
+        logged = len(db.queries_log)
+        with count_queries() as queries:
+            User.objects.count()
+        assert queries.count == 1
+        assert len(db.queries_log) == logged
+        assert not db.queries_logged
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    fixtures = ['feeds']
+
+    def setUp(self):
+        self.user = User.objects.get(username='user1')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_feeds(self, count, posts=3, followers=1):
+        users = [self.user] + [User.objects.create(username="follower{}".format(x)) for x in range(followers - 1)]
+        feeds = []
+        for x in range(count):
+            link = Link.objects.create(url="http://test.com/rss/budget{}.xml".format(x))
+            for user in users:
+                feed = Feed.objects.create(name="Budget {}".format(x), user=user, position=100 + x)
+                FeedLink.objects.create(feed=feed, link=link, reg_exp="")
+                for y in range(posts):
+                    add_post(feed.pk, "Budget {} {}".format(x, y), datetime(2018, 1, 1, y, tzinfo=pytz.utc), y % 2 == 0)
+                feeds.append(feed)
+        cache.clear()
+        return feeds
+
+    def test_feeds_list(self):
+        self.assertQueryBudget(lambda: self.client.get(reverse("feeds-list"), format='json'),
+                               lambda size: self.add_feeds(size), budget=6)
+
+    def test_posts_list(self):
+        feeds = []
+        self.assertQueryBudget(
+            lambda: self.client.get(reverse("posts-list"), data={"name": feeds[-1].pk, "new": "true"}, format='json'),
+            lambda size: feeds.extend(self.add_feeds(1, posts=size)), budget=2)
+
+    def test_post_update(self):
+        feeds = []
+        self.assertQueryBudget(
+            lambda: self.client.patch(reverse("posts-detail", kwargs={"pk": feeds[-1].post_set.first().pk}),
+                                      data={"view": True}, format='json'),
+            lambda size: feeds.extend(self.add_feeds(1, posts=size)), budget=8)
+
+    def test_timeline(self):
+        self.assertQueryBudget(lambda: self.client.get(reverse("timeline-list"), format='json'),
+                               lambda size: self.add_feeds(size), budget=1)
+
+    def loop(self, entries):
+        items = [("Entry {}".format(x), "https://test.com/budget/{}".format(x), "2018-01-31T11:{:02}:00".format(x))
+                 for x in range(entries)]
+        with freeze_time("2018-01-31T13:00:01"):
+            with use_transport(GeneratedFeeds(lambda url: feed_creator("Budget", url, items))):
+                get_posts()
+
+    # a link is reconciled with its followers at once; what is left is the prune query of every feed and the item
+    # (and its search index row) created for every new entry
+    def test_loop_followers(self):
+        self.assertQueryBudget(lambda: self.loop(5), lambda size: self.add_feeds(1, posts=0, followers=size),
+                               budget=38, per_size=1)
+
+    def test_loop_entries(self):
+        entries = []
+        self.assertQueryBudget(lambda: self.loop(entries[-1]),
+                               lambda size: (entries.append(size), self.add_feeds(1, posts=0)), budget=30, per_size=2)
+
+
+class AdminTests(QueryBudgetMixin, TestCase):
+    fixtures = ['feeds']
+
+    def setUp(self):
+        self.user = User.objects.get(username='user1')
+        self.admin = User.objects.create(username='admin', is_staff=True, is_superuser=True)
+
+    def changelist(self, model, **params):
+        model_admin = admin.site._registry[model]
+        request = RequestFactory().get("/", params)
+        request.user = self.admin
+        list_display = model_admin.get_list_display(request)
+        changelist = ChangeList(
+            request, model, list_display, model_admin.get_list_display_links(request, list_display),
+            model_admin.get_list_filter(request), model_admin.date_hierarchy, model_admin.get_search_fields(request),
+            model_admin.get_list_select_related(request), model_admin.list_per_page, model_admin.list_max_show_all,
+            model_admin.list_editable, model_admin
+        )
+        # the values of every column, as the changelist template shows them
+        rows = [[lookup_field(name, obj, model_admin)[2] for name in list_display] for obj in changelist.result_list]
+        return changelist, rows
+
+    def add_posts(self, feeds, posts=3):
+        for x in range(feeds):
+            feed = Feed.objects.create(name="Admin {}".format(x), user=self.user, position=100 + x)
+            link = Link.objects.create(url="http://test.com/rss/admin{}.xml".format(x))
+            FeedLink.objects.create(feed=feed, link=link, reg_exp="")
+            for y in range(posts):
+                add_post(feed.pk, "Admin {} {}".format(x, y), datetime(2018, 1, 1, y, tzinfo=pytz.utc))
+
+    def test_changelists(self):
+        for model in (Post, FeedLink, Feed, Item):
+            with self.subTest(model=model.__name__):
+                self.assertQueryBudget(lambda: self.changelist(model), self.add_posts, budget=3)
+        self.assertQueryBudget(lambda: self.changelist(Post, view="0", add_date__year="2018"),
+                               self.add_posts, budget=3)
+
+    def test_estimated_count(self):
+        self.add_posts(2, posts=5)
+        Post.objects.filter(pk__in=Post.objects.order_by('id').values_list('id', flat=True)[:3]).delete()
+        with patch("feeds.admin.ESTIMATE_THRESHOLD", 0):
+            with CaptureQueriesContext(connection) as queries:
+                changelist, rows = self.changelist(Post)
+            assert changelist.result_count == Post.objects.order_by('-id').first().pk
+            assert not any("COUNT(" in x['sql'] for x in queries.captured_queries)
+            changelist, rows = self.changelist(Post, view="0")
+            assert changelist.result_count == Post.objects.count()
+        changelist, rows = self.changelist(Post)
+        assert changelist.result_count == Post.objects.count()
+
+
+@override_settings(FEEDS_POLL_INTERVAL=0.01)
+# the fetches of on demand refreshes run in threads with database connections of their own
+class RefreshTests(TransactionTestCase):
+    fixtures = ['feeds', "get_posts"]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.get(username='user2'))
+        self.link = Link.objects.get(url="http://test.com/rss/feed.xml")
+        self.transport = MemoryTransport({"http://test.com/rss/feed.xml": feed_creator(
+            "Feed1", "http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ])})
+
+    def get_posts(self, **params):
+        with use_transport(self.transport):
+            return self.client.get(reverse("posts-list"), data=dict({"name": 3, "refresh": "true"}, **params),
+                                   format='json')
+
+    def test_refresh_stale_feed(self):
+        result = self.get_posts()
+        assert result['X-Feeds-Refresh'] == "done"
+        assert sorted(x['title'] for x in result.data['results']) == ["Post1", "Post2"]
+        assert self.get_posts()['X-Feeds-Refresh'] == "done"
+        assert len(self.transport.requests) == 1
+
+        LinkRefresh.objects.update(fetched=LinkRefresh.objects.get().fetched - timedelta(minutes=10))
+        self.get_posts()
+        assert len(self.transport.requests) == 2
+        with use_transport(self.transport):
+            result = self.client.get(reverse("feeds-detail", kwargs={"pk": 3}), data={"refresh": "1"}, format='json')
+        assert result['X-Feeds-Refresh'] == "done"
+        assert len(self.transport.requests) == 2
+
+    def test_loop_run_is_fresh(self):
+        with use_transport(self.transport):
+            get_posts()
+        self.get_posts()
+        assert len(self.transport.requests) == 2
+
+    def test_refresh_needs_feed(self):
+        assert self.client.get(reverse("posts-list"), data={"refresh": "true"}, format='json').status_code == 400
+        assert self.get_posts(name=1).status_code == status.HTTP_404_NOT_FOUND
+
+    def test_coalesced_in_process(self):
+        fetch = Mock(return_value=True)
+        event = refresh.in_flight[self.link.pk] = refresh.Flight()
+        try:
+            result = refresh.refresh_links([self.link], fetch, budget=0.05)
+            assert result["pending"] == [self.link.url]
+            threading.Timer(0.05, event.set).start()
+            result = refresh.refresh_links([self.link], fetch, budget=5)
+            assert result["pending"] == []
+        finally:
+            del refresh.in_flight[self.link.pk]
+        assert not fetch.called
+
+    def test_claimed_by_other_process(self):
+        fetch = Mock(return_value=True)
+        LinkRefresh.objects.create(link=self.link, started=now())
+        assert refresh.refresh_links([self.link], fetch, budget=0.05)["pending"] == [self.link.url]
+        assert not fetch.called
+        LinkRefresh.objects.update(started=now() - timedelta(minutes=5))
+        assert refresh.refresh_links([self.link], fetch, budget=1)["refreshed"] == [self.link.url]
+        assert fetch.call_count == 1
+        assert LinkRefresh.objects.get().started is None
+
+    def test_budget_spent(self):
+        fetch = Mock(return_value=True)
+        assert refresh.refresh_links([self.link], fetch, budget=0)["pending"] == [self.link.url]
+        assert not fetch.called
+        assert LinkRefresh.objects.get().started is None
+
+    def test_budget_bounds_slow_fetch(self):
+        done = threading.Event()
+        fetch = Mock(side_effect=lambda link, timeout: done.wait(5))
+        started = time.monotonic()
+        assert refresh.refresh_links([self.link], fetch, budget=0.1)["pending"] == [self.link.url]
+        assert time.monotonic() - started < 1
+        # the fetch goes on and releases the link when it is over
+        assert refresh.refresh_links([self.link], fetch, budget=0.1)["pending"] == [self.link.url]
+        done.set()
+        while self.link.pk in refresh.in_flight:
+            time.sleep(0.01)
+        assert fetch.call_count == 1
+        assert LinkRefresh.objects.get().started is None
+
+    def test_refresh_follows_permanent_redirect(self):
+        self.transport.responses[self.link.url] = Response(
+            "http://test.com/rss/moved.xml", self.transport.responses[self.link.url], permanent_redirect=True)
+        assert self.get_posts()['X-Feeds-Refresh'] == "done"
+        assert FeedLink.objects.get(feed=3).link.url == "http://test.com/rss/moved.xml"
+
+
 class TestGetPosts(TestCase):
     fixtures = ['feeds', "get_posts"]
 
     def test_loop(self):
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                    ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
-                    ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
-                ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
                 result = get_posts()
         assert result['added'] == 4
 
+    def test_loop_without_news_changes_nothing(self):
+        counts = []
+        for _ in range(3):
+            with freeze_time("2018-01-31T13:00:01"):
+                with serve_feed("http://test.com/rss/feed.xml", [
+                    ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ]):
+                    get_posts()
+            counts.append(PostChange.objects.count())
+        assert counts[1] == counts[2]
+
+    def test_loop_attaches_unlinked_items(self):
+        date = datetime(2018, 1, 31, 11, tzinfo=pytz.utc)
+        item = Item.objects.create(title="Post1", url="https://test.com/feed/Post1", post_date=date)
+        Post.objects.create(feed_id=3, item=item, add_date=date, view=True)
+        orphan = Item.objects.create(title="Gone", url="https://test.com/feed/Gone", post_date=date)
+        with freeze_time("2018-01-31T13:00:01"):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+            ]):
+                get_posts()
+        assert Item.objects.get(pk=item.pk).link_id == 1
+        assert Post.objects.get(feed=4).item_id == item.pk
+        assert not Item.objects.filter(pk=orphan.pk).exists()
+
+    def test_loop_shares_items(self):
+        with freeze_time("2018-01-31T13:00:01"):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
+                get_posts()
+        assert Post.objects.filter(feed__in=[3, 4]).count() == 4
+        assert Item.objects.filter(link=1).count() == 2
+
+    def test_loop_follows_permanent_redirect(self):
+        # both links moved to the same place
+        response = Response("http://test.com/rss/feed2.xml/", feed_creator("Feed2", "http://test.com/rss/feed2.xml", [
+            ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+        ]), permanent_redirect=True)
+        with freeze_time("2018-01-31T13:00:01"):
+            with use_transport(MemoryTransport({
+                "http://test.com/rss/feed.xml": response, "http://test.com/rss/feed2.xml": response
+            })):
+                get_posts()
+        # the link is fetched from where the feed moved, not from a normalized url redirected again every run
+        assert list(Link.objects.values_list('url', flat=True)) == ["http://test.com/rss/feed2.xml/"]
+        assert FeedLink.objects.filter(link=2).count() == 3
+
+    def test_loop_budget(self):
+        with use_transport(MemoryTransport()) as transport:
+            result = get_posts(budget=0)
+        assert transport.requests == []
+        assert result["deferred"] == ["http://test.com/rss/feed.xml", "http://test.com/rss/feed2.xml"]
+        assert DeferredLink.objects.count() == 2
+        assert Post.objects.get(pk=1).seen
+
+    def test_loop_deferred_first(self):
+        DeferredLink.objects.create(link=Link.objects.get(pk=2))
+        with use_transport(MemoryTransport({
+            url: feed_creator("Feed1", url, []) for url in LOOP_LINKS
+        })) as transport:
+            result = get_posts()
+        assert transport.requests == [("http://test.com/rss/feed2.xml", 30), ("http://test.com/rss/feed.xml", 30)]
+        assert result["deferred"] == []
+        assert not DeferredLink.objects.exists()
+
     def test_loop_check_reg_exp(self):
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
-                        ("News1", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("News1", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
                 result = get_posts()
         assert result['added'] == 3
 
     def test_loop_update_url(self):
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
-                        ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
                 get_posts()
 
         with freeze_time("2018-01-31T15:00:00"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1_up", "2018-01-31T16:00:00"),
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1_up", "2018-01-31T16:00:00"),
+            ]):
                 result = get_posts()
         assert result["updated"] == 2
 
     def test_loop_update_title(self):
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
-                        ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
                 get_posts()
 
         with freeze_time("2018-01-31T15:00:00"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1.1", "https://test.com/feed/Post1", "2018-01-31T14:00:00"),
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1.1", "https://test.com/feed/Post1", "2018-01-31T14:00:00"),
+            ]):
                 result = get_posts()
         assert result["updated"] == 2
 
     def test_loop_update_title_of_old_watched_video(self):
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
-                        ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
                 get_posts()
-                Post.objects.filter(title='Post1').update(view=True)
+                Post.objects.filter(item__title='Post1').update(view=True)
 
         with freeze_time("2018-01-31T15:00:00"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1.1", "https://test.com/feed/Post1", "2018-01-31T14:00:00"),
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1.1", "https://test.com/feed/Post1", "2018-01-31T14:00:00"),
+            ]):
                 result = get_posts()
         assert result["updated"] == 2
 
     def test_loop_update_older_then_last_add(self):
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
-                        ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
                 get_posts()
 
         with freeze_time("2018-01-31T15:00:00"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1_up", "2018-01-31T12:30:00"),
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1_up", "2018-01-31T12:30:00"),
+            ]):
                 result = get_posts()
         assert result["updated"] == 0
         assert result["added"] == 0
 
     def test_loop_add_new(self):
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
-                        ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
                 get_posts()
 
         with freeze_time("2018-01-31T15:00:00"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post3", "https://test.com/feed/Post3", "2018-01-31T14:00:00"),
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post3", "https://test.com/feed/Post3", "2018-01-31T14:00:00"),
+            ]):
                 result = get_posts()
         assert result["added"] == 2
 
     def test_loop_try_add_older(self):
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
-                        ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post1", "https://test.com/feed/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed/Post2", "2018-01-31T12:00:00")
+            ]):
                 get_posts()
 
         with freeze_time("2018-01-31T15:00:00"):
-            with patch("urllib.request.urlopen", Mock(return_value=StringIO(
-                    feed_creator("Feed1", "http://test.com/rss/feed.xml", [
-                        ("Post3", "https://test.com/feed/Post3", "2018-01-31T12:00:00"),
-                    ])
-            ))):
+            with serve_feed("http://test.com/rss/feed.xml", [
+                ("Post3", "https://test.com/feed/Post3", "2018-01-31T12:00:00"),
+            ]):
                 result = get_posts()
 
         assert result["updated"] == 0
         assert result["added"] == 0
 
     def test_loop_add_to_full_feed(self):
-        def mock_feeds(link):
-            return StringIO({
-                "http://test.com/rss/feed2.xml":
-                    feed_creator("Feed2", "http://test.com/rss/feed2.xml", [
-                        ("Post1", "https://test.com/feed2/Post1", "2018-01-31T11:00:00"),
-                        ("Post2", "https://test.com/feed2/Post2", "2018-01-31T12:00:00")
-                    ])
-            }.get(link.full_url, test_sites.EMPTY_FEED))
-
+        feeds = MemoryTransport({
+            "http://test.com/rss/feed.xml": test_sites.EMPTY_FEED,
+            "http://test.com/rss/feed2.xml": feed_creator("Feed2", "http://test.com/rss/feed2.xml", [
+                ("Post1", "https://test.com/feed2/Post1", "2018-01-31T11:00:00"),
+                ("Post2", "https://test.com/feed2/Post2", "2018-01-31T12:00:00")
+            ]),
+        })
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", Mock(side_effect=mock_feeds)):
+            with use_transport(feeds):
                 result = get_posts()
         assert result["added"] == 2
         assert result["deleted"] == 1
@@ -459,9 +1772,12 @@ class TestGetPosts(TestCase):
     def test_broken_links(self):
 
         with freeze_time("2018-01-31T13:00:01"):
-            with patch("urllib.request.urlopen", side_effect=URLError('Broken link')):
+            with use_transport(MemoryTransport({
+                url: URLError('Broken link') for url in LOOP_LINKS
+            })):
                 result = get_posts()
 
         assert result["updated"] == 0
         assert result["added"] == 0
         assert result["deleted"] == 0
+
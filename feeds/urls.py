@@ -1,19 +1,27 @@
 from django.conf.urls import include, url
-from rest_framework.routers import DefaultRouter
 
-from feeds.views import DiscoverView, FeedView, LinkView, PostView
+from feeds.compression import CompressedRouter
+from feeds.metrics import instrument
+from feeds.views import (DiscoverView, DiscoveryJobView, FeedView, LinkView, LoopRunView, MetricsView, PostView,
+                         ProfileView, TimelineView, WebSubView)
 
-router = DefaultRouter()
+router = CompressedRouter()
 
 router.register(r"feeds", FeedView, base_name='feeds')
 router.register(r"posts", PostView, base_name='posts')
 router.register(r"discover", DiscoverView, base_name="discover")
+router.register(r"discover/jobs", DiscoveryJobView, base_name="discover-jobs")
+router.register(r"timeline", TimelineView, base_name="timeline")
+router.register(r"runs", LoopRunView, base_name="runs")
+router.register(r"metrics", MetricsView, base_name="metrics")
+router.register(r"profiles", ProfileView, base_name="profiles")
 
-posts_router = DefaultRouter()
+posts_router = CompressedRouter()
 posts_router.register(r"links", LinkView, base_name='links')
 
 
-urlpatterns = [
+urlpatterns = instrument([
     url(r'', include(router.urls)),
     url(r'^feeds/(?P<feed>[^/.]+)/', include(posts_router.urls)),
-]
+    url(r'^websub/(?P<token>[0-9a-zA-Z]+)/$', WebSubView.as_view({'get': 'verify', 'post': 'receive'}), name='websub-callback'),
+])
@@ -0,0 +1,23 @@
+from django.db.models import F
+from django.utils.timezone import now
+
+from feeds.models import UserVersion
+
+
+def get_version(user):
+    version = UserVersion.objects.filter(user=user).first()
+    if version is None:
+        return UserVersion(user=user, version=0, modified=None)
+    return version
+
+
+def bump_versions(user_ids):
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    modified = now()
+    UserVersion.objects.filter(user_id__in=user_ids).update(version=F('version') + 1, modified=modified)
+    existing = UserVersion.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True)
+    UserVersion.objects.bulk_create(
+        UserVersion(user_id=user_id, version=1, modified=modified) for user_id in user_ids - set(existing)
+    )
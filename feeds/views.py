@@ -1,43 +1,101 @@
+import json
+import logging
+import math
 import re
-from copy import deepcopy
+import time
 from datetime import datetime
 from urllib.error import URLError
 
-from django.db.models import F, Q
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Prefetch, Q
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.utils.timezone import now, make_aware
 from rest_framework import status
-from rest_framework.decorators import list_route
-from rest_framework.permissions import AllowAny
+from rest_framework.decorators import detail_route, list_route
+from rest_framework.generics import get_object_or_404
+from rest_framework.mixins import CreateModelMixin, ListModelMixin, RetrieveModelMixin
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
-from rest_framework.viewsets import ViewSet, ModelViewSet
+from rest_framework.viewsets import GenericViewSet, ViewSet, ModelViewSet, ReadOnlyModelViewSet
 
 from feed_reader.feed_reader import scan_url, extract_feeds, FeedDownloader
+from feeds import cache, discovery, metrics, profiling, refresh, websub
+from feeds.changes import compact_changes, record_changes
 from feeds.filters import PostFilterSet
-from feeds.models import Feed, Post, FeedLink, Link
-from feeds.pagination import CountPagination
-from feeds.serializers import FeedSerializer, PostSerializer, FeedLinkSerializer
-
-
-class FeedView(ModelViewSet):
+from feeds.instrumentation import count_queries
+from feeds.links import move_link
+from feeds.mixins import CachedListMixin, ConditionalMixin, ValuesListMixin
+from feeds.models import (ArchivedPost, DeferredLink, DiscoveryJob, Feed, Item, LoopRun, LoopRunLink, Post, PostChange,
+                          FeedLink, Link, Subscription)
+from feeds.notify import notify, wait_for_changes
+from feeds.pagination import CountPagination, LoopRunPagination, TimelinePagination
+from feeds.profiling import ProfiledMixin
+from feeds.renderers import RENDERER_CLASSES, EventStreamRenderer, PlainTextRenderer
+from feeds.search import get_backend
+from feeds.serializers import (ArchivedPostSerializer, DiscoveryJobSerializer, FeedSerializer, PostSerializer,
+                               FeedLinkSerializer, LoopRunDetailSerializer, LoopRunLinkSerializer, LoopRunSerializer,
+                               TimelinePostSerializer, values_representation)
+from feeds.versions import bump_versions, get_version
+
+logger = logging.getLogger(__name__)
+
+
+class FeedView(ProfiledMixin, ConditionalMixin, CachedListMixin, ModelViewSet):
     queryset = Feed.objects.all().order_by("position")
     serializer_class = FeedSerializer
+    renderer_classes = RENDERER_CLASSES
 
     def get_queryset(self):
-        return Feed.objects.filter(user=self.request.user).order_by("position")
+        return Feed.objects.filter(user=self.request.user).order_by("position").prefetch_related(
+            'links__link', Prefetch('post_set', queryset=Post.objects.select_related('item'))
+        )
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action == 'list':
+            context['unread_counts'] = self.get_unread_counts()
+        return context
+
+    def get_unread_counts(self):
+        version = getattr(self, 'user_version', None) or get_version(self.request.user)
+        return cache.get_or_set("counts", version, lambda: dict(
+            Post.objects.filter(feed__user=self.request.user, view=False)
+            .values_list('feed').annotate(count=Count('id')).order_by()
+        ))
+
+    def retrieve(self, request, *args, **kwargs):
+        result = refresh_requested(request) and refresh_feed(self.get_object())
+        return with_refresh_header(super().retrieve(request, *args, **kwargs), result)
+
+    @list_route()
+    def counts(self, request):
+        return Response(self.get_unread_counts())
+
+    @list_route(permission_classes=(IsAdminUser,))
+    def cache_stats(self, request):
+        return Response(cache.stats())
 
     @list_route(permission_classes=(AllowAny,))
     def loop(self, request, **kwargs):
-        return Response(get_posts())
-
+        try:
+            budget = float(request.GET["budget"]) if "budget" in request.GET else None
+        except ValueError:
+            return Response({"detail": "Wrong budget."}, status=400)
+        limit = getattr(settings, 'FEEDS_LOOP_BUDGET', None)
+        if limit is not None:
+            budget = limit if budget is None else min(budget, limit)
+        return Response(get_posts(budget))
+
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         feed = self.get_object()
         result = super().destroy(request, *args, **kwargs)
-        for feed in Feed.objects.filter(user=self.request.user, position__gt=feed.position):
-            feed.position -= 1
-            feed.save()
+        Feed.objects.filter(user=self.request.user, position__gt=feed.position).update(position=F('position') - 1)
         return result
 
     @list_route(methods=('put',))
+    @transaction.atomic
     def reorder(self, request):
         user = request.user
         old_pos = int(request.data.get("oldPosition", -1))
@@ -59,37 +117,235 @@ class FeedView(ModelViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class LinkView(ModelViewSet):
+class LinkView(ConditionalMixin, ModelViewSet):
     queryset = FeedLink.objects.all()
     serializer_class = FeedLinkSerializer
+    renderer_classes = RENDERER_CLASSES
     lookup_field = "position"
 
     def get_queryset(self):
         return self.queryset.filter(feed__name=self.kwargs.get('feed'), feed__user=self.request.user)
 
+    @transaction.atomic
     def create(self, request, feed, *args, **kwargs):
         user = request.user
-        position = len(self.queryset.filter(feed__name=feed))
-        feed_obj = Feed.objects.get(name=feed, user=user)
+        feed_obj = Feed.objects.select_for_update().get(name=feed, user=user)
         request.data['feed'] = feed_obj.pk
-        request.data['position'] = position
+        request.data['position'] = FeedLink.objects.filter(feed=feed_obj).count()
         return super().create(request, feed, *args, **kwargs)
 
+    @transaction.atomic
     def destroy(self, request, feed, position, *args, **kwargs):
+        feed_link = self.get_object()
         result = super().destroy(request, feed, position, *args, **kwargs)
-        for fl in FeedLink.objects.filter(position__gt=position):
-            fl.position -= 1
-            fl.save()
+        FeedLink.objects.filter(feed=feed_link.feed_id, position__gt=feed_link.position).update(
+            position=F('position') - 1
+        )
         return result
 
 
-class PostView(ModelViewSet):
+class PostView(ProfiledMixin, ConditionalMixin, ValuesListMixin, ModelViewSet):
     queryset = Post.objects.all()
     serializer_class = PostSerializer
+    renderer_classes = RENDERER_CLASSES
     http_method_names = ("get", "put", "patch")
     filter_class = PostFilterSet
     pagination_class = CountPagination
 
+    def get_queryset(self):
+        return self.queryset.filter(feed__user=self.request.user).select_related('item')
+
+    def list(self, request, *args, **kwargs):
+        result = None
+        if refresh_requested(request):
+            try:
+                feed = get_object_or_404(Feed, pk=int(request.GET.get("name", "")), user=request.user)
+            except ValueError:
+                return Response({"detail": "Refresh needs a feed name."}, status=400)
+            result = refresh_feed(feed)
+        response = with_refresh_header(super().list(request, *args, **kwargs), result)
+        if request.GET.get("archive") in ("true", "1") and response.status_code == status.HTTP_200_OK:
+            archived = PostFilterSet(request.query_params, queryset=ArchivedPost.objects.filter(
+                feed__user=request.user)).qs.order_by('id')
+            posts = values_representation(ArchivedPostSerializer, archived)
+            if posts is None:
+                posts = ArchivedPostSerializer(archived, many=True).data
+            response.data = {"count": response.data["count"] + len(posts), "results": response.data["results"] + posts}
+        return response
+
+    @list_route(methods=('put',))
+    def read(self, request):
+        feed = request.data.get("feed")
+        ids = request.data.get("ids")
+        before = request.data.get("before")
+        if feed is None and ids is None and before is None:
+            return Response({"detail": "No posts specified."}, status=400)
+
+        posts = self.get_queryset().filter(view=False)
+        try:
+            if feed is not None:
+                posts = posts.filter(feed_id=int(feed))
+            if ids is not None:
+                posts = posts.filter(id__in=[int(x) for x in ids])
+            if before is not None:
+                posts = posts.filter(add_date__lte=make_aware(datetime.fromtimestamp(float(before))))
+        except (TypeError, ValueError, OverflowError, OSError):
+            return Response({"detail": "Wrongly specified posts."}, status=400)
+        with transaction.atomic():
+            record_changes(posts)
+            updated = posts.update(view=True)
+        return Response({"updated": updated})
+
+    @list_route(methods=('get',))
+    def changes(self, request):
+        try:
+            since = int(request.GET.get("since", 0))
+            limit = max(min(int(request.GET.get("limit", 500)), 1000), 1)
+        except ValueError:
+            return Response({"detail": "Wrong cursor."}, status=400)
+
+        changes = list(PostChange.objects.filter(user=request.user, id__gt=since).order_by('id')[:limit + 1])
+        more = len(changes) > limit
+        changes = changes[:limit]
+        ids = {x.post for x in changes}
+        posts = self.get_queryset().filter(id__in=ids).order_by('id')
+        return Response({
+            "cursor": changes[-1].id if changes else since,
+            "more": more,
+            "posts": PostSerializer(posts, many=True).data,
+            "deleted": sorted(ids - {x.id for x in posts}),
+        })
+
+    @list_route(methods=('get',))
+    def search(self, request):
+        query = request.GET.get("q", "")
+        try:
+            after = request.GET.get("after")
+            if after is not None:
+                score, id_ = after.split(":")
+                after = (float(score), int(id_))
+            limit = max(min(int(request.GET.get("limit", 50)), 200), 1)
+        except ValueError:
+            return Response({"detail": "Wrong cursor."}, status=400)
+
+        found = get_backend().search(request.user, query, after, limit + 1)
+        posts = self.get_queryset().in_bulk([x for x, _ in found[:limit]])
+        return Response({
+            "results": [PostSerializer(posts[x]).data for x, _ in found[:limit] if x in posts],
+            "next": "{!r}:{}".format(found[limit - 1][1], found[limit - 1][0]) if len(found) > limit else None,
+        })
+
+    @list_route(methods=('get',))
+    def wait(self, request):
+        try:
+            since = int(request.GET.get("since", 0))
+            timeout = get_seconds(request.GET.get("timeout", 30), 60)
+        except ValueError:
+            return Response({"detail": "Wrong cursor."}, status=400)
+        return Response(wait_for_changes(request.user, since, timeout))
+
+    @list_route(methods=('get',), renderer_classes=(EventStreamRenderer,))
+    def stream(self, request):
+        try:
+            since = int(request.META.get("HTTP_LAST_EVENT_ID") or request.GET.get("since", 0))
+            timeout = get_seconds(request.GET.get("timeout", 300), 300)
+        except ValueError:
+            return Response("retry: 1000\n\n", status=400)
+        user = request.user
+
+        def events(cursor):
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                changes = wait_for_changes(user, cursor, min(15, deadline - time.monotonic()))
+                if changes["cursor"] == cursor:
+                    yield ": keep-alive\n\n"
+                else:
+                    cursor = changes["cursor"]
+                    yield "id: {}\ndata: {}\n\n".format(cursor, json.dumps(changes))
+
+        response = StreamingHttpResponse(events(since), content_type=EventStreamRenderer.media_type)
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+class TimelineView(ListModelMixin, GenericViewSet):
+    queryset = Post.objects.all()
+    serializer_class = TimelinePostSerializer
+    renderer_classes = RENDERER_CLASSES
+    filter_class = PostFilterSet
+    pagination_class = TimelinePagination
+
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user).select_related('feed', 'item')
+
+
+class LoopRunView(ReadOnlyModelViewSet):
+    queryset = LoopRun.objects.all()
+    serializer_class = LoopRunSerializer
+    permission_classes = (IsAdminUser,)
+    pagination_class = LoopRunPagination
+
+    def get_serializer_class(self):
+        if self.action == 'retrieve':
+            return LoopRunDetailSerializer
+        return self.serializer_class
+
+    def get_queryset(self):
+        if self.action == 'retrieve':
+            return self.queryset.prefetch_related('links')
+        return self.queryset
+
+    @list_route(methods=('get',))
+    def slowest(self, request):
+        try:
+            runs = max(min(int(request.GET.get("runs", 10)), 100), 1)
+            limit = max(min(int(request.GET.get("limit", 20)), 100), 1)
+        except ValueError:
+            return Response({"detail": "Wrong limit."}, status=400)
+        recent = LoopRun.objects.order_by('-id').values_list('id', flat=True)[:runs]
+        links = LoopRunLink.objects.filter(run__in=list(recent)).order_by('-duration')[:limit]
+        return Response(LoopRunLinkSerializer(links, many=True).data)
+
+
+class ProfileView(ViewSet):
+    permission_classes = (IsAdminUser,)
+
+    def list(self, request):
+        return Response(profiling.list_profiles())
+
+    def retrieve(self, request, pk=None):
+        profile = profiling.get_profile(pk)
+        if profile is None:
+            raise Http404
+        sort = request.GET.get("sort", "cumulative")
+        if sort not in ("cumulative", "tottime", "calls"):
+            return Response({"detail": "Wrong sort."}, status=400)
+        profile["stats"] = profiling.get_stats(pk, sort)
+        return Response(profile)
+
+    @detail_route(methods=('get',))
+    def download(self, request, pk=None):
+        path = profiling.get_profile_path(pk)
+        if path is None:
+            raise Http404
+        response = FileResponse(open(path, 'rb'), content_type='application/octet-stream')
+        response['Content-Disposition'] = 'attachment; filename="{}.prof"'.format(pk)
+        return response
+
+
+class MetricsView(ViewSet):
+    renderer_classes = (PlainTextRenderer,)
+
+    def get_permissions(self):
+        if getattr(settings, 'FEEDS_METRICS_PUBLIC', False):
+            return [AllowAny()]
+        return [IsAdminUser()]
+
+    def list(self, request):
+        if not metrics.prometheus_client:
+            return Response("prometheus_client is not installed", status=status.HTTP_501_NOT_IMPLEMENTED)
+        return HttpResponse(metrics.render(), content_type=metrics.prometheus_client.CONTENT_TYPE_LATEST)
+
 
 class DiscoverView(ViewSet):
 
@@ -99,7 +355,7 @@ class DiscoverView(ViewSet):
         if "url" in request.GET:
             url = request.GET["url"]
             try:
-                x = scan_url(url)
+                x = scan_url(url, discovery.get_timeout())
             except URLError:
                 return Response({"detail": "Wrong URL."}, status=404)
         return Response(x, status=200)
@@ -110,7 +366,7 @@ class DiscoverView(ViewSet):
         if "url" in request.GET:
             url = request.GET["url"]
             try:
-                x = extract_feeds(url)
+                x = extract_feeds(url, discovery.get_timeout())
             except URLError:
                 return Response({"detail": "Wrong URL."}, status=404)
         if x:
@@ -118,99 +374,399 @@ class DiscoverView(ViewSet):
         return Response({"detail": "No feeds"}, status=404)
 
 
-def get_posts():
+class DiscoveryJobView(CreateModelMixin, RetrieveModelMixin, GenericViewSet):
+    queryset = DiscoveryJob.objects.all()
+    serializer_class = DiscoveryJobSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        job, created = discovery.get_job(serializer.validated_data['kind'], serializer.validated_data['url'])
+        return Response(self.get_serializer(job).data,
+                        status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+    def retrieve(self, request, *args, **kwargs):
+        job = self.get_object()
+        try:
+            timeout = get_seconds(request.GET.get("wait", 0), 30)
+        except ValueError:
+            return Response({"detail": "Wrong wait."}, status=400)
+        return Response(self.get_serializer(discovery.wait_for_job(job, timeout)).data)
+
+
+class WebSubView(ViewSet):
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+    renderer_classes = (PlainTextRenderer,)
+
+    def perform_content_negotiation(self, request, force=False):
+        # hubs expect the challenge as is, whatever they accept
+        renderer = self.get_renderers()[0]
+        return renderer, renderer.media_type
+
+    def verify(self, request, token):
+        subscription = get_object_or_404(Subscription, token=token)
+        challenge = websub.verify(subscription, request.query_params)
+        if challenge is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(challenge)
+
+    def receive(self, request, token):
+        subscription = get_object_or_404(Subscription.objects.select_related('link'), token=token)
+        body = request.body
+        # content with a missing or wrong signature, or that does not parse, is acknowledged and dropped
+        if websub.check_signature(subscription, body, request.META.get('HTTP_X_HUB_SIGNATURE', '')):
+            try:
+                newest_posts = FeedDownloader(subscription.link.url).parse(body)
+            except Exception:
+                logger.exception("Parsing content pushed for %s failed", subscription.link.url)
+                newest_posts = None
+            if newest_posts is not None:
+                with transaction.atomic():
+                    push_posts(subscription.link, newest_posts)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@profiling.profiled('get_posts')
+def get_posts(budget=None):
     updated = 0
     deleted = 0
     added = 0
 
-    seen = []
+    if budget is None:
+        budget = getattr(settings, 'FEEDS_LOOP_BUDGET', None)
+    deadline = time.monotonic() + budget if budget is not None else None
+    timeout = getattr(settings, 'FEEDS_FETCH_TIMEOUT', 30)
+
+    started = now()
+    loop_started = time.monotonic()
+    seen = set()
     broken_links = []
-    links = Link.objects.all()
+    pushed_links = []
+    deferred_links = []
+    changed_users = set()
+    done = set()
+    stats = []
+    # links deferred by an earlier run that ran out of time go first
+    links = Link.objects.select_related('subscription').order_by(F('deferral__deferred').asc(nulls_last=True), 'id')
     for link in links:
-
-        try:
-            downloader = FeedDownloader(link.url)
-            newest_posts = downloader.get_posts()
-        except URLError:
-            newest_posts = []
-            broken_links += [link.url]
-        except Exception as e:
-            print(e)
-            broken_links += [link.url]
-
-        for feedLink in link.feedlink_set.all():
-            oldest_post_date = get_oldest_post_date(feedLink.feed)
-            for id_, post in enumerate(newest_posts):
-                seen += [post.url]
-                new_ = True
-
-                # check if post matches regexp and it's id is lower than the post limit
-                if re.match(feedLink.reg_exp, post.title) and id_ < feedLink.feed.postLimit:
-                    posts = Post.objects.filter(Q(title=post.title) | Q(url=post.url), feed=feedLink.feed)
-                    # post is new
-                    if len(posts) == 0 and post.post_date >= oldest_post_date:
-                        new_post = deepcopy(post)
-                        new_post.feed = feedLink.feed
-                        new_post.save()
-                        if new_:
-                            new_ = False
-                            added += 1
-                    else:
-                        if len(posts) == 1:
-                            p = posts[0]
-                            # unwatched old post was updated
-                            if p.add_date < post.post_date and not p.view:
-                                p.post_date = post.post_date
-                                if post.post_date > now():
-                                    p.add_date = post.post_date
-                                else:
-                                    p.add_date = now()
-                                p.title = post.title
-                                p.url = post.url
-                                p.save()
-                                if new_:
-                                    new_ = False
-                                    updated += 1
-                            # old post updated with a new title
-                            if p.title != post.title and post.post_date > p.add_date:
-                                p.add_date = now()
-                                p.post_date = post.post_date
-                                p.title = post.title
-                                p.save()
-                                if new_:
-                                    new_ = False
-                                    updated += 1
-
-    for feed in Feed.objects.all():
-        if not any([x.link.url in broken_links for x in feed.links.all()]):
+        if link.pk in done:
+            continue
+        # new items of links with an active WebSub subscription are pushed to websub_callback
+        if websub.is_subscribed(link):
+            pushed_links += [link.url]
+            continue
+        if deadline is not None and time.monotonic() >= deadline:
+            deferred_links += [link]
+            continue
+        done.add(link.pk)
+        link_stats = LoopRunLink(url=link.url)
+        link_started = time.monotonic()
+
+        with count_queries() as queries:
+            fetched = False
+            error = None
+            try:
+                downloader = FeedDownloader(link.url, timeout)
+                stream = downloader.fetch()
+                link_stats.size = len(stream)
+                link_stats.fetch_time = time.monotonic() - link_started
+                fetched = True
+                metrics.observe_fetch(link.url, link_stats.fetch_time, metrics.get_status(response=downloader),
+                                      link_stats.size)
+                newest_posts = downloader.parse(stream)
+                link_stats.parse_time = time.monotonic() - link_started - link_stats.fetch_time
+                metrics.observe_parse(link_stats.parse_time)
+                if downloader.moved_to:
+                    link = move_link(link, downloader.moved_to)
+                    done.add(link.pk)
+                if downloader.hub:
+                    websub.subscribe(link, downloader.hub, downloader.topic)
+            except URLError as e:
+                error = e
+            except Exception as e:
+                print(e)
+                error = e
+            if error is not None:
+                newest_posts = []
+                broken_links += [link.url]
+                link_stats.error = str(error)[:255]
+                if not fetched:
+                    link_stats.fetch_time = time.monotonic() - link_started
+                    metrics.observe_fetch(link.url, link_stats.fetch_time, metrics.get_status(error=error), 0)
+
+            seen.update(x.url for x in newest_posts)
+            reconcile_started = time.monotonic()
+            with transaction.atomic():
+                result = sync_link(link, newest_posts)
+            link_stats.reconcile_time = time.monotonic() - reconcile_started
+        added += result['added']
+        updated += result['updated']
+        changed_users.update(result['users'])
+
+        link_stats.link = link
+        link_stats.items = len(newest_posts)
+        link_stats.feed_links = result['feed_links']
+        link_stats.queries = queries.count
+        link_stats.duration = time.monotonic() - link_started
+        stats += [link_stats]
+
+    DeferredLink.objects.filter(link__in=done).delete()
+    already_deferred = set(DeferredLink.objects.values_list('link_id', flat=True))
+    DeferredLink.objects.bulk_create(DeferredLink(link=x) for x in deferred_links if x.pk not in already_deferred)
+    skipped_links = broken_links + pushed_links + [x.url for x in deferred_links]
+
+    prune_started = time.monotonic()
+
+    for feed in Feed.objects.prefetch_related('links__link'):
+        if not any([x.link.url in skipped_links for x in feed.links.all()]):
             limit = feed.postLimit
 
-            posts = Post.objects.filter(feed=feed)
+            posts = list(Post.objects.filter(feed=feed).select_related('item').order_by("item__post_date"))
             for post in posts:
-                if post.url not in seen:
+                if post.item.url not in seen and post.seen:
+                    changed_users.add(feed.user_id)
                     post.seen = False
                     post.save()
             count = len(posts)
 
-            posts = Post.objects.filter(feed=feed).order_by("post_date")
             for post in posts:
                 if not post.seen and post.view and count > limit:
                     count -= 1
                     post.delete()
                     deleted += 1
-
-    return {"added": added, "updated": updated, "deleted": deleted}
-
-
-def get_oldest_post_date(feed):
-    pre = Post.objects.filter(feed=feed).order_by("-add_date")[:2*feed.postLimit]
-    post = Post.objects.filter(feed=feed).order_by("-add_date")[2*feed.postLimit:]
+                    changed_users.add(feed.user_id)
+
+    # items left without posts by this run: those of the links it synced and those never attached to a link
+    Item.objects.filter(Q(link__in=done) | Q(link=None), post=None).delete()
+    prune_time = time.monotonic() - prune_started
+
+    bump_versions(changed_users)
+    if changed_users:
+        compact_changes(changed_users)
+        transaction.on_commit(notify)
+    metrics.count_posts(added, updated, deleted)
+
+    run = LoopRun.objects.create(started=started, duration=time.monotonic() - loop_started, prune_time=prune_time,
+                                 added=added, updated=updated, deleted=deleted, deferred=len(deferred_links))
+    for link_stats in stats:
+        link_stats.run = run
+    LoopRunLink.objects.bulk_create(stats)
+    history = LoopRun.objects.order_by('-id').values_list('id', flat=True)[getattr(settings, 'FEEDS_LOOP_HISTORY', 100):]
+    LoopRun.objects.filter(id__in=list(history)).delete()
+    return {"added": added, "updated": updated, "deleted": deleted, "deferred": [x.url for x in deferred_links],
+            "run": run.pk}
+
+
+def get_seconds(value, limit):
+    # a duration from the query string, nan and infinity would never time out
+    seconds = float(value)
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(value)
+    return min(seconds, limit)
+
+
+def refresh_requested(request):
+    return request.GET.get("refresh") in ("true", "1")
+
+
+def refresh_feed(feed):
+    # refreshes the links of the feed not fetched for FEEDS_REFRESH_AFTER seconds, within FEEDS_REFRESH_BUDGET
+    return refresh.refresh_links([x.link for x in feed.links.select_related('link')], refresh_link)
+
+
+def refresh_link(link, timeout):
+    # like the loop, follows the feed where it moved and subscribes to its hub
+    try:
+        downloader = FeedDownloader(link.url, timeout)
+        newest_posts = downloader.parse(downloader.fetch())
+        if downloader.moved_to:
+            link = move_link(link, downloader.moved_to)
+        if downloader.hub:
+            websub.subscribe(link, downloader.hub, downloader.topic)
+    except (OSError, ValueError):
+        logger.exception("Refreshing %s failed", link.url)
+        return False
+    with transaction.atomic():
+        push_posts(link, newest_posts)
+    return True
+
+
+def with_refresh_header(response, result):
+    if result:
+        response['X-Feeds-Refresh'] = "pending" if result["pending"] else "done"
+    return response
+
+
+def push_posts(link, newest_posts):
+    result = sync_link(link, newest_posts)
+    metrics.count_posts(result['added'], result['updated'])
+    bump_versions(result['users'])
+    if result['users']:
+        transaction.on_commit(notify)
+    return result
+
+
+def sync_link(link, newest_posts):
+    added = 0
+    updated = 0
+    changed_users = set()
+    changed_items = set()
+
+    # items are shared by every feed following the link, their content is written once after all feeds are done
+    items = get_link_items(link, newest_posts)
+    item_updates = {}
+    # the posts of all following feeds are loaded at once and matched in memory, new ones are inserted together
+    feed_links = list(link.feedlink_set.select_related('feed'))
+    feed_posts = get_feed_posts([x.feed_id for x in feed_links])
+    new_posts = []
+
+    for feedLink in feed_links:
+        feed = feedLink.feed
+        posts = feed_posts.get(feed.pk, [])
+        oldest_post_date = get_oldest_post_date(posts, feed.postLimit)
+        index = PostIndex(posts)
+        for id_, post in enumerate(newest_posts):
+            new_ = True
+
+            # check if post matches regexp and it's id is lower than the post limit
+            if re.match(feedLink.reg_exp, post.title) and id_ < feed.postLimit:
+                posts = index.find(post.title, post.url)
+                # post is new
+                if len(posts) == 0 and post.post_date >= oldest_post_date:
+                    item = get_link_item(link, items, item_updates, post)
+                    p = Post(feed=feed, user_id=feed.user_id, item=item, add_date=now(), view=False)
+                    new_posts.append(p)
+                    index.add(p)
+                    changed_users.add(feed.user_id)
+                    if new_:
+                        new_ = False
+                        added += 1
+                else:
+                    if len(posts) == 1:
+                        p = posts[0]
+                        title = p.item.title
+                        # unwatched old post was updated
+                        if p.add_date < post.post_date and not p.view:
+                            if post.post_date > now():
+                                p.add_date = post.post_date
+                            else:
+                                p.add_date = now()
+                            index.replace(p, get_link_item(link, items, item_updates, post))
+                            title = post.title
+                            changed_users.add(feed.user_id)
+                            if new_:
+                                new_ = False
+                                updated += 1
+                        # old post updated with a new title
+                        if title != post.title and post.post_date > p.add_date:
+                            p.add_date = now()
+                            index.replace(p, get_link_item(link, items, item_updates, post))
+                            changed_users.add(feed.user_id)
+                            if new_:
+                                new_ = False
+                                updated += 1
+        for p in index.changed:
+            if p.pk is not None:
+                p.save()
+
+    if new_posts:
+        Post.objects.bulk_create(new_posts)
+        # bulk_create skips the post_save signal that logs changes, and returns no ids on every database
+        record_changes(Post.objects.filter(feed__in={x.feed_id for x in new_posts},
+                                           item__in={x.item_id for x in new_posts}))
+
+    for item, post in item_updates.values():
+        item.title = post.title
+        item.url = post.url
+        item.post_date = post.post_date
+        item.save()
+        changed_items.add(item.pk)
+
+    if changed_items:
+        # posts of other feeds sharing an updated item changed as well
+        posts = Post.objects.filter(item__in=changed_items)
+        record_changes(posts)
+        changed_users.update(posts.values_list('feed__user_id', flat=True).distinct())
+    return {"added": added, "updated": updated, "users": changed_users, "feed_links": len(feed_links)}
+
+
+class PostIndex:
+    # The posts of a feed by item title and url, as the loop matches entries to posts by either.
+
+    def __init__(self, posts):
+        self.keys = {}
+        self.changed = []
+        for post in posts:
+            self.add(post)
+
+    def add(self, post):
+        for key in (("title", post.item.title), ("url", post.item.url)):
+            self.keys.setdefault(key, []).append(post)
+
+    def remove(self, post):
+        for key in (("title", post.item.title), ("url", post.item.url)):
+            self.keys[key] = [x for x in self.keys.get(key, []) if x is not post]
+
+    def find(self, title, url):
+        found = []
+        for post in self.keys.get(("title", title), []) + self.keys.get(("url", url), []):
+            if not any(x is post for x in found):
+                found.append(post)
+        return found
+
+    def replace(self, post, item):
+        self.remove(post)
+        post.item = item
+        self.add(post)
+        if not any(x is post for x in self.changed):
+            self.changed.append(post)
+
+
+def get_feed_posts(feed_ids):
+    posts = {}
+    for post in Post.objects.filter(feed__in=feed_ids).select_related('item').order_by("-add_date", "-id"):
+        posts.setdefault(post.feed_id, []).append(post)
+    return posts
+
+
+def get_link_items(link, entries):
+    # Items backfilled without a link (their feed had several) are found through the posts of the link's feeds and
+    # attached to it.
+    items = list(Item.objects.filter(Q(link=link) | Q(link=None, post__feed__links__link=link)).filter(
+        Q(url__in=[x.url for x in entries]) | Q(title__in=[x.title for x in entries])
+    ).distinct().order_by(F('link').desc(nulls_last=True), 'id'))
+    unlinked = [x.pk for x in items if x.link_id is None]
+    if unlinked:
+        Item.objects.filter(id__in=unlinked, link=None).update(link=link)
+    by_url, by_title = {}, {}
+    for item in items:
+        by_url.setdefault(item.url, item)
+        by_title.setdefault(item.title, item)
+    return by_url, by_title
+
+
+def get_link_item(link, items, item_updates, entry):
+    by_url, by_title = items
+    item = by_url.get(entry.url) or by_title.get(entry.title)
+    if item is None:
+        item = Item.objects.create(link=link, title=entry.title, url=entry.url, post_date=entry.post_date)
+        by_url[item.url] = by_title[item.title] = item
+    elif (item.title, item.url, item.post_date) != (entry.title, entry.url, entry.post_date):
+        item_updates[item.pk] = (item, entry)
+    return item
+
+
+def get_oldest_post_date(posts, limit):
+    # posts are ordered by add_date, newest first
+    pre = posts[:2*limit]
+    post = posts[2*limit:]
     if len(pre) == 0:
         return make_aware(datetime.fromtimestamp(0))
     if len(post) == 0:
-        return pre.last().add_date
+        return pre[-1].add_date
     else:
-        oldest = pre.last().add_date
+        oldest = pre[-1].add_date
         for p in post:
             if p.view:
                 oldest = p.add_date
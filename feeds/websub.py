@@ -0,0 +1,103 @@
+import hashlib
+import hmac
+import urllib.request
+from datetime import timedelta
+from urllib.error import URLError
+from urllib.parse import urlencode, urljoin
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.utils.crypto import get_random_string
+from django.utils.timezone import now
+
+from feed_reader import feed_reader
+from feeds.models import Subscription
+
+SIGNATURE_ALGORITHMS = ('sha1', 'sha256', 'sha384', 'sha512')
+
+
+def get_lease():
+    return getattr(settings, 'FEEDS_WEBSUB_LEASE', 10 * 24 * 60 * 60)
+
+
+def get_retry(attempts):
+    # how long a request to the hub waits for its verification before it is sent again
+    retry = getattr(settings, 'FEEDS_WEBSUB_RETRY', 60 * 60)
+    return timedelta(seconds=min(retry * 2 ** min(attempts, 10), getattr(settings, 'FEEDS_WEBSUB_MAX_RETRY', 24 * 60 * 60)))
+
+
+def is_subscribed(link):
+    # subscriptions close to the end of their lease are polled and renewed
+    subscription = getattr(link, 'subscription', None)
+    renew = timedelta(seconds=getattr(settings, 'FEEDS_WEBSUB_RENEW', 24 * 60 * 60))
+    return subscription is not None and subscription.lease_expires is not None and \
+        subscription.lease_expires > now() + renew
+
+
+def subscribe(link, hub, topic, mode='subscribe'):
+    base = getattr(settings, 'FEEDS_WEBSUB_CALLBACK', None)
+    if not base:
+        return None
+    subscription, created = Subscription.objects.get_or_create(
+        link=link, defaults={'hub': hub, 'topic': topic, 'secret': get_random_string(40)}
+    )
+    if not created and (subscription.hub, subscription.topic) != (hub, topic):
+        subscription.hub, subscription.topic, subscription.secret = hub, topic, get_random_string(40)
+        subscription.lease_expires = subscription.pending_until = None
+        subscription.attempts = 0
+    elif subscription.pending_until is not None and subscription.pending_until > now():
+        # the last request is still waiting for the hub
+        return None
+
+    # the intent is stored before the request, hubs may verify it before they answer
+    subscription.pending = mode
+    subscription.pending_until = now() + get_retry(subscription.attempts)
+    subscription.attempts += 1
+    subscription.save()
+    data = {
+        'hub.callback': urljoin(base, reverse('websub-callback', kwargs={'token': subscription.token})),
+        'hub.mode': mode,
+        'hub.topic': topic,
+        'hub.secret': subscription.secret,
+        'hub.lease_seconds': get_lease(),
+    }
+    req = urllib.request.Request(hub, data=urlencode(data).encode(), headers={'User-Agent': 'feed-reader'})
+    try:
+        feed_reader.open_url(req, getattr(settings, 'FEEDS_FETCH_TIMEOUT', 30))
+    except URLError:
+        return None
+    return subscription
+
+
+def verify(subscription, params):
+    # Answers the hub's intent verification, returns the challenge to echo or None to refuse. Only the request
+    # last sent to the hub can be verified, and only until it expires.
+    mode = params.get('hub.mode')
+    if params.get('hub.topic') != subscription.topic or not subscription.pending or \
+            subscription.pending_until is None or subscription.pending_until <= now():
+        return None
+    if mode == 'subscribe' == subscription.pending:
+        try:
+            lease = int(params.get('hub.lease_seconds', ''))
+        except ValueError:
+            lease = get_lease()
+        subscription.lease_expires = now() + timedelta(seconds=max(0, min(lease, get_lease())))
+    elif mode == 'unsubscribe' == subscription.pending or (mode == 'denied' and subscription.pending == 'subscribe'):
+        subscription.lease_expires = None
+    else:
+        return None
+    subscription.pending = ""
+    if mode != 'denied':
+        # a denied subscription keeps waiting before it is requested again
+        subscription.pending_until = None
+        subscription.attempts = 0
+    subscription.save()
+    return params.get('hub.challenge', '')
+
+
+def check_signature(subscription, body, signature):
+    algorithm, _, digest = signature.partition('=')
+    if algorithm not in SIGNATURE_ALGORITHMS:
+        return False
+    expected = hmac.new(subscription.secret.encode(), body, getattr(hashlib, algorithm)).hexdigest()
+    return hmac.compare_digest(expected, digest)
@@ -10,7 +10,7 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='django_feeds',
     version='0.2.4',
-    packages=find_packages(),
+    packages=find_packages(exclude=('benchmarks',)),
     install_requires=[
         "beautifulsoup4==4.4.1",
         "Django==1.11.29",
@@ -20,6 +20,10 @@ setup(
         "djangorestframework==3.9.1",
         "django-filter==1.0.2",
     ],
+    extras_require={
+        "msgpack": ["msgpack>=0.6"],
+        "metrics": ["prometheus_client>=0.7"],
+    },
     tests_require=[
         "freezegun==0.3.9",
         "pytz==2015.7",